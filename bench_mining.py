@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+""" Compare the mining backends on this host.
+
+For every backend and difficulty this reports the sustained hashrate, the
+latency from cancelling a search to the first hash on a new header, and the
+CPU use in cores. """
+
+import argparse
+from os import urandom
+from threading import Event, Thread
+import time
+
+from shitcoin.crypto import HASH_LEN
+from shitcoin.mining import BACKENDS, create_backend
+
+# Every hash is below this target
+EASY_TARGET = (1 << (8 * HASH_LEN)) - 1
+
+
+def measure_latency(backend, rounds):
+    """ Cancel a running search, like the miner does on a new block, and
+    time until the first hash on a new header is done. """
+    latencies = []
+    for _ in range(rounds):
+        cancel = Event()
+        thread = Thread(target=backend.search,
+                        args=(urandom(73), 1, 0, backend.chunk_size,
+                              cancel.is_set))
+        thread.start()
+        time.sleep(0.05)
+
+        start = time.perf_counter()
+        cancel.set()
+        thread.join()
+        backend.search(urandom(73), EASY_TARGET, 0, backend.chunk_size)
+        latencies.append(time.perf_counter() - start)
+    return sum(latencies) / len(latencies)
+
+
+def measure_hashrate(backend, diff, duration):
+    """ Mine on random headers for some time.
+
+    Returns:
+        Tuple (hashes per second, blocks found, CPU cores used)
+    """
+    target = 1 << (8 * HASH_LEN - diff)
+    blocks = 0
+    nonce = 0
+    prefix = urandom(73)
+
+    start_hashes = backend.get_hash_count()
+    start_cpu = time.thread_time() + backend.get_cpu_time()
+    start = time.perf_counter()
+    end = start + duration
+    while time.perf_counter() < end:
+        found = backend.search(prefix, target, nonce, backend.chunk_size,
+                               lambda: time.perf_counter() >= end)
+        nonce += backend.chunk_size
+        if found is not None:
+            # New block, new header
+            blocks += 1
+            prefix = urandom(73)
+            nonce = 0
+    elapsed = time.perf_counter() - start
+    hashes = backend.get_hash_count() - start_hashes
+    cpu = time.thread_time() + backend.get_cpu_time() - start_cpu
+    return hashes / elapsed, blocks, cpu / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--backends', default=','.join(BACKENDS),
+                        help='comma separated backends (default: all)')
+    parser.add_argument('--diffs', default='16,20',
+                        help='comma separated difficulties (default: 16,20)')
+    parser.add_argument('--duration', type=float, default=5.,
+                        help='seconds to mine per difficulty (default: 5)')
+    parser.add_argument('--processes', type=int, default=None,
+                        help='processes of the multiprocess backend '
+                             '(default: all cores)')
+    parser.add_argument('--rounds', type=int, default=10,
+                        help='latency measurements per backend (default: 10)')
+    args = parser.parse_args()
+
+    print('%-14s %5s %14s %8s %12s %6s'
+          % ('backend', 'diff', 'H/s', 'blocks', 'latency ms', 'cores'))
+    for name in args.backends.split(','):
+        backend = create_backend(name, args.processes)
+        backend.start()
+        try:
+            # Wait until workers are up
+            backend.search(urandom(73), EASY_TARGET, 0, backend.chunk_size)
+
+            latency = measure_latency(backend, args.rounds)
+            for diff in args.diffs.split(','):
+                hashrate, blocks, cores = measure_hashrate(
+                    backend, int(diff), args.duration)
+                print('%-14s %5s %14.0f %8i %12.2f %6.2f'
+                      % (name, diff, hashrate, blocks, latency * 1000, cores))
+        finally:
+            backend.stop()
+
+
+if __name__ == '__main__':
+    main()
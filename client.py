@@ -2,8 +2,9 @@
 
 from binascii import hexlify, unhexlify
 from datetime import datetime
+import json
 import logging
-import socket
+import socketserver
 from sys import argv
 from threading import Thread
 from time import sleep
@@ -11,8 +12,18 @@ import traceback
 
 from shitcoin.crypto import NO_PUBKEY, NO_HASH
 from shitcoin.blockchain import Blockchain
+from shitcoin.exceptions import IndexDisabled
 from shitcoin.miner import Miner
 from shitcoin.mock_p2p import P2P
+from shitcoin import metrics, profiling
+from shitcoin.settings import (
+    METRICS_HOST,
+    METRICS_PORT,
+    PROFILE_LOG,
+    RPC_HOST,
+    RPC_JSON_PORT,
+    RPC_PORT
+)
 from shitcoin.validation import get_next_diff
 from shitcoin.wallet import Wallet, NotEnoughFunds
 
@@ -20,163 +31,437 @@ from shitcoin.wallet import Wallet, NotEnoughFunds
 log = logging.getLogger(__name__)
 
 
+class RPCServer(socketserver.ThreadingTCPServer):
+    """ Serves every connection in its own thread """
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 64
+
+    def __init__(self, addr, handler, rpc):
+        self.rpc = rpc
+        super().__init__(addr, handler)
+
+
+class TextHandler(socketserver.StreamRequestHandler):
+    """ Space separated commands for humans, e.g. with nc """
+    def handle(self):
+        log.info('RPC connection from %r' % (self.client_address,))
+        self.server.rpc.text_session(self.rfile, self.request)
+
+
+class JSONHandler(socketserver.StreamRequestHandler):
+    """ One JSON request or batch of requests per line for scripts """
+    def handle(self):
+        log.info('JSON RPC connection from %r' % (self.client_address,))
+        for line in self.rfile:
+            if line.strip():
+                self.wfile.write(self.server.rpc.handle_json(line) + b'\n')
+
+
 class RPC:
-    """ Awesome RPC interface. Totally ignores locking """
+    """ Awesome RPC interface. Every connection is served in its own thread,
+    so the node parts it calls, the blockchain, the mempool and the wallet,
+    have to do their own locking.
+
+    The text interface on RPC_PORT takes one command per line, see the
+    welcome message. The JSON interface on RPC_JSON_PORT takes one request
+    per line, like {"id": 1, "method": "send", "params": [addr, amount]}, and
+    answers with one line {"id": 1, "result": ...} or {"id": 1, "error":
+    ...}. A line can also hold a list of requests, which is answered with a
+    list of responses. Transactions of all requests in a list are passed to
+    the miner together.
+    """
     def __init__(self, blockchain, miner, wallet, p2p):
         self.blockchain = blockchain
         self.miner = miner
         self.wallet = wallet
         self.p2p = p2p
 
-        self.rpc_sock = socket.socket()
-        self.rpc_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.rpc_sock.bind(('127.0.0.1', 7839))
-        self.rpc_sock.listen(1)
-        log.info('RPC server is listening on port 7839')
-
-        self.rpc_thread = Thread(target=RPC.rpc_loop, name='rpc', args=(self,),
-                                 daemon=True)
-        self.rpc_thread.start()
+        # JSON methods returning a result
+        self.methods = {
+            'new_address': self.new_address,
+            'get_balance': self.get_balance,
+            'get_addresses': self.get_addresses,
+            'get_height': self.get_height,
+            'get_transaction': self.get_transaction,
+            'get_history': self.get_history,
+            'get_peers': self.p2p.get_peers,
+            'get_queue_stats': self.p2p.get_queue_stats,
+            'get_hashrate': self.miner.get_hashrate,
+            'start_mining': self.start_mining,
+            'stop_mining': self.miner.stop_mining,
+            'rescan': self.wallet.rescan,
+        }
+        # JSON methods returning transactions to send, their result is the
+        # list of txids
+        self.tx_methods = {
+            'send': self.create_transaction,
+            'sendmany': self.create_payouts,
+            'consolidate': self.consolidate,
+        }
+
+        self.servers = [
+            RPCServer((RPC_HOST, RPC_PORT), TextHandler, self),
+            RPCServer((RPC_HOST, RPC_JSON_PORT), JSONHandler, self),
+        ]
+        for server in self.servers:
+            log.info('RPC server is listening on port %i'
+                     % server.server_address[1])
+            Thread(target=server.serve_forever, name='rpc',
+                   daemon=True).start()
+
+    def text_session(self, rfile, cli_sock):
+        cli_sock.send(b"Welcome to your shitcoin client's RPC interface.\n"
+                      b'Commands:\n'
+                      b'q: quit\n'
+                      b'send <addr> <amount>: Send some currency\n'
+                      b'sendmany <addr> <amount> [<addr> <amount> ...]: '
+                      b'Pay many addresses\n'
+                      b'new_address: Generate new address\n'
+                      b'show_balance [address]: Show your balance\n'
+                      b'show_wallet: Show owned balances by address\n'
+                      b'consolidate [max_inputs]: Merge small utxos\n'
+                      b'rescan: Rebuild the wallet from the blockchain\n'
+                      b'start_mining <addr>: Start mining to address\n'
+                      b'stop_mining: Stop mining\n'
+                      b'show_hashrate: Show miners hashrate\n'
+                      b'show_net: Show peers and network queues\n'
+                      b'tx <txid>: Find a transaction\n'
+                      b'history <addr>: Show payments of an address\n'
+                      b'ascii <limit> [<start_height>] [summary]: '
+                      b'Ascii art blockchain\n')
 
-    def rpc_loop(self):
         while True:
-            buf = b''
-            cli_sock, cli_addr = self.rpc_sock.accept()
-            log.info('RPC connection from %s' % cli_addr.__repr__())
-            cli_sock.send(b"Welcome to your shitcoin client's RPC interface.\n"
-                          b'Commands:\n'
-                          b'q: quit\n'
-                          b'send <addr> <amount>: Send some currency\n'
-                          b'new_address: Generate new address\n'
-                          b'show_balance [address]: Show your balance\n'
-                          b'show_wallet: Show owned balances by address\n'
-                          b'start_mining <addr>: Start mining to address\n'
-                          b'stop_mining: Stop mining\n'
-                          b'show_hashrate: Show miners hashrate\n'
-                          b'ascii <limit>: Ascii art blockchain\n')
-
-            while True:
-                cli_sock.send(b'>> ')
-
-                while b'\n' not in buf:
-                    buf += cli_sock.recv(1024)
-                line = buf[:buf.find(b'\n')]
-                buf = buf[buf.find(b'\n')+1:]
-                args = line.strip().split(b' ')
-                cmd = args[0]
-
-                try:
-                    if cmd == b'q':
-                        cli_sock.close()
-                        break
-
-                    elif cmd == b'send':
-                        try:
-                            tx = self.wallet.create_transaction(
-                                {unhexlify(args[1]): int(args[2])})
-                            self.miner.add_transaction(tx)
-                            self.p2p.broadcast_transaction(tx)
-                        except NotEnoughFunds:
-                            cli_sock.send(b'insufficient funds.\n')
-                        else:
-                            cli_sock.send(b'Transaction sent to miners.\n')
-
-                    elif cmd == b'new_address':
-                        addr = self.wallet.new_address()
-                        cli_sock.send(b'%s\n' % hexlify(addr))
-
-                    elif cmd == b'show_balance':
-                        if len(args) > 1:
-                            balance = self.wallet.get_balance(args[1])
-                        else:
-                            balance = self.wallet.get_balance()
-                        cli_sock.send(b'%i\n' % balance)
-
-                    elif cmd == b'show_wallet':
-                        for addr in self.wallet.get_addresses():
-                            cli_sock.send(b'%s: %i\n'
-                                          % (hexlify(addr),
-                                             self.wallet.get_balance(addr)))
-
-                    elif cmd == b'start_mining':
-                        addr = unhexlify(args[1])
-                        if len(addr) != 32:
-                            raise Exception('Bad address')
-                        self.miner.set_reward_address(addr)
-                        self.miner.start_mining()
-
-                    elif cmd == b'stop_mining':
-                        self.miner.stop_mining()
-
-                    elif cmd == b'show_hashrate':
-                        hashrate = self.miner.get_hashrate()
-                        seconds_per_block = (
-                            (2 ** get_next_diff(self.blockchain.get_head()))
-                            / hashrate)
-                        cli_sock.send(b'Hashrate is %.2f kH/s '
-                                      b'(~ %.2f s per block)\n'
-                                      % (hashrate / 1000, seconds_per_block))
-
-                    elif cmd == b'ascii':
-                        msg = self.asciiart(int(args[1]))
-                        cli_sock.send(msg)
-                    else:
-                        cli_sock.send(b'Unknown command.\n')
-                except Exception:
-                    with cli_sock.makefile('w') as f:
-                        traceback.print_exc(file=f)
-
-    def asciiart(self, limit):
-        msg = b''
-
-        # make list of last limit blocks
-        blocks = []
-        cur = self.blockchain.head
-        for _ in range(limit):
-            blocks.append(cur)
-            if cur.get_parent() != cur:
-                cur = cur.get_parent()
-            else:
-                # break at genesis, which is parent of itself
+            cli_sock.send(b'>> ')
+
+            line = rfile.readline()
+            if not line:
                 break
-        blocks.reverse()
-
-        for blk in blocks:
-            msg += b'BLK %i %s\n' % (blk.get_height(), hexlify(blk.get_hash()))
-            msg += b'- prev_hash: %s\n' % hexlify(blk.prev_hash)
-            msg += b'- merkle_root: %s\n' % hexlify(blk.merkle_root)
-            msg += (b'- timestamp: %s\n'
-                    % datetime.fromtimestamp(blk.timestamp)
-                    .strftime('%Y-%m-%d %H:%M:%S').encode('utf-8'))
-            msg += b'- diff: %i\n' % blk.diff
-            msg += b'- nonce: %08x\n' % blk.nonce
+            args = line.strip().split(b' ')
+            cmd = args[0]
+
+            try:
+                if cmd == b'q':
+                    break
+
+                elif cmd == b'send':
+                    try:
+                        tx = self.wallet.create_transaction(
+                            {unhexlify(args[1]): int(args[2])})
+                    except NotEnoughFunds:
+                        cli_sock.send(b'insufficient funds.\n')
+                    else:
+                        self.send_transactions([tx])
+                        cli_sock.send(b'Transaction sent to miners.\n')
+
+                elif cmd == b'sendmany':
+                    payouts = [(unhexlify(addr), int(amount))
+                               for addr, amount
+                               in zip(args[1::2], args[2::2])]
+                    try:
+                        txs = self.wallet.create_payouts(payouts)
+                    except NotEnoughFunds:
+                        cli_sock.send(b'insufficient funds.\n')
+                    else:
+                        self.send_transactions(txs)
+                        cli_sock.send(b'%i transactions sent to miners.\n'
+                                      % len(txs))
 
+                elif cmd == b'consolidate':
+                    if len(args) > 1:
+                        tx = self.wallet.consolidate(int(args[1]))
+                    else:
+                        tx = self.wallet.consolidate()
+                    if tx is None:
+                        cli_sock.send(b'Nothing to consolidate.\n')
+                    else:
+                        self.send_transactions([tx])
+                        cli_sock.send(b'Merging %i utxos.\n'
+                                      % len(tx.inputs))
+
+                elif cmd == b'rescan':
+                    def progress(done, total):
+                        cli_sock.send(b'Scanned %i of %i blocks\n'
+                                      % (done, total))
+                    result = self.wallet.rescan(progress)
+                    cli_sock.send(b'%i blocks, %i outputs received, '
+                                  b'%i spent, %i unspent\n'
+                                  % (result['blocks'], result['received'],
+                                     result['spent'], result['unspent']))
+
+                elif cmd == b'new_address':
+                    addr = self.wallet.new_address()
+                    cli_sock.send(b'%s\n' % hexlify(addr))
+
+                elif cmd == b'show_balance':
+                    if len(args) > 1:
+                        balance = self.wallet.get_balance(args[1])
+                    else:
+                        balance = self.wallet.get_balance()
+                    cli_sock.send(b'%i\n' % balance)
+
+                elif cmd == b'show_wallet':
+                    for addr in self.wallet.get_addresses():
+                        cli_sock.send(b'%s: %i\n'
+                                      % (hexlify(addr),
+                                         self.wallet.get_balance(addr)))
+
+                elif cmd == b'start_mining':
+                    self.start_mining(args[1])
+
+                elif cmd == b'stop_mining':
+                    self.miner.stop_mining()
+
+                elif cmd == b'show_hashrate':
+                    hashrate = self.miner.get_hashrate()
+                    seconds_per_block = (
+                        (2 ** get_next_diff(self.blockchain.get_head()))
+                        / hashrate)
+                    cli_sock.send(b'Hashrate is %.2f kH/s '
+                                  b'(~ %.2f s per block)\n'
+                                  % (hashrate / 1000, seconds_per_block))
+                    worker_rates = self.miner.get_worker_hashrates()
+                    if len(worker_rates) > 1:
+                        for i, rate in enumerate(worker_rates):
+                            cli_sock.send(b'- worker %i: %.2f kH/s\n'
+                                          % (i, rate / 1000))
+
+                elif cmd == b'show_net':
+                    for host, port, inbound in self.p2p.get_peers():
+                        cli_sock.send(b'peer %s:%i %s\n'
+                                      % (host.encode(), port,
+                                         b'in' if inbound else b'out'))
+                    stats = self.p2p.get_queue_stats()
+                    for name, value in sorted(stats.items()):
+                        cli_sock.send(b'%s: %i\n' % (name.encode(), value))
+
+                elif cmd == b'tx':
+                    found = self.blockchain.get_transaction(
+                        unhexlify(args[1]))
+                    if found is None:
+                        cli_sock.send(b'Not in the blockchain.\n')
+                    else:
+                        blk, pos = found
+                        cli_sock.send(b'block %s height %i position %i\n'
+                                      % (hexlify(blk.get_hash()),
+                                         blk.get_height(), pos))
+
+                elif cmd == b'history':
+                    history = self.blockchain.get_history(
+                        unhexlify(args[1]))
+                    for height, txid, amount in history:
+                        cli_sock.send(b'%i %s %+i\n'
+                                      % (height, hexlify(txid), amount))
+
+                elif cmd == b'ascii':
+                    summary = b'summary' in args[2:]
+                    numbers = [arg for arg in args[2:] if arg != b'summary']
+                    start = int(numbers[0]) if numbers else None
+                    for chunk in self.asciiart(int(args[1]), start, summary):
+                        cli_sock.sendall(chunk)
+                else:
+                    cli_sock.send(b'Unknown command.\n')
+            except IndexDisabled:
+                cli_sock.send(b'The chain index is disabled.\n')
+            except Exception:
+                with cli_sock.makefile('w') as f:
+                    traceback.print_exc(file=f)
+
+    def handle_json(self, line):
+        """ Answer a line of the JSON interface.
+
+        Args:
+            line: bytes of a request or a list of requests
+
+        Returns:
+            bytes of the response or the list of responses
+        """
+        try:
+            requests = json.loads(line)
+        except ValueError as e:
+            return json.dumps({'id': None, 'error': str(e)}).encode()
+        batch = isinstance(requests, list)
+        if not batch:
+            requests = [requests]
+
+        responses = []
+        sends = []  # tuples (response, list of transactions)
+        for request in requests:
+            response = {'id': None}
+            responses.append(response)
+            try:
+                response['id'] = request.get('id')
+                method = request['method']
+                params = request.get('params', [])
+                if method in self.tx_methods:
+                    sends.append((response, self.tx_methods[method](*params)))
+                elif method in self.methods:
+                    response['result'] = self.methods[method](*params)
+                else:
+                    response['error'] = 'Unknown method %s' % method
+            except NotEnoughFunds:
+                response['error'] = 'insufficient funds'
+            except IndexDisabled:
+                response['error'] = 'chain index disabled'
+            except Exception as e:
+                response['error'] = repr(e)
+
+        if sends:
+            added = self.send_transactions(
+                [tx for _, txs in sends for tx in txs])
+            added = set(map(id, added))
+            for response, txs in sends:
+                rejected = sum(1 for tx in txs if id(tx) not in added)
+                if rejected:
+                    response['error'] = ('%i of %i transactions rejected'
+                                         % (rejected, len(txs)))
+                else:
+                    response['result'] = [hexlify(tx.get_txid()).decode()
+                                          for tx in txs]
+
+        return json.dumps(responses if batch else responses[0]).encode()
+
+    def create_transaction(self, addr, amount):
+        return [self.wallet.create_transaction({unhexlify(addr): amount})]
+
+    def create_payouts(self, payouts):
+        """ Args:
+            payouts: list of [addr, amount]
+        """
+        return self.wallet.create_payouts(
+            [(unhexlify(addr), amount) for addr, amount in payouts])
+
+    def consolidate(self, *args):
+        tx = self.wallet.consolidate(*args)
+        return [] if tx is None else [tx]
+
+    def new_address(self):
+        return hexlify(self.wallet.new_address()).decode()
+
+    def get_balance(self, addr=None):
+        if addr is None:
+            return self.wallet.get_balance()
+        return self.wallet.get_balance(unhexlify(addr))
+
+    def get_addresses(self):
+        return {hexlify(addr).decode(): self.wallet.get_balance(addr)
+                for addr in self.wallet.get_addresses()}
+
+    def get_height(self):
+        return self.blockchain.get_head().get_height()
+
+    def get_transaction(self, txid):
+        found = self.blockchain.get_transaction(unhexlify(txid))
+        if found is None:
+            return None
+        blk, pos = found
+        return {'block': hexlify(blk.get_hash()).decode(),
+                'height': blk.get_height(), 'position': pos}
+
+    def get_history(self, addr):
+        return [[height, hexlify(txid).decode(), amount]
+                for height, txid, amount
+                in self.blockchain.get_history(unhexlify(addr))]
+
+    def start_mining(self, addr):
+        addr = unhexlify(addr)
+        if len(addr) != 32:
+            raise Exception('Bad address')
+        self.miner.set_reward_address(addr)
+        self.miner.start_mining()
+
+    def send_transactions(self, txs):
+        """ Pass our transactions to the miner and the network
+
+        Returns:
+            list of the transactions accepted by the mempool
+        """
+        added = self.miner.add_transactions(txs)
+        for tx in added:
+            self.p2p.broadcast_transaction(tx)
+        added_ids = set(map(id, added))
+        for tx in txs:
+            if id(tx) not in added_ids:
+                # Rejected, the inputs can be used again
+                self.wallet.release(tx)
+        return added
+
+    def asciiart(self, limit, start=None, summary=False):
+        """ Render blocks of the longest chain. The output is produced block
+        by block, so it can be sent while rendering.
+
+        Args:
+            limit: Number of blocks
+            start: Height of the first block, None for the last limit blocks
+            summary: One line per block instead of all transactions
+
+        Returns:
+            Generator of bytes
+        """
+        if start is None:
+            start = max(self.blockchain.get_head().get_height() - limit + 1, 0)
+
+        prev = None
+        for height in range(start, start + limit):
+            blk = self.blockchain.get_block_at_height(height)
+            if blk is None:
+                break
+            if prev is not None and blk.get_parent() is not prev:
+                yield b'Chain reorganized at height %i, stopping.\n' % height
+                break
+            prev = blk
+
+            timestamp = (datetime.fromtimestamp(blk.timestamp)
+                         .strftime('%Y-%m-%d %H:%M:%S').encode('utf-8'))
+            if summary:
+                yield (b'BLK %i %s %s diff %i txs %i\n'
+                       % (height, hexlify(blk.get_hash()), timestamp,
+                          blk.diff, len(blk.txs)))
+                continue
+
+            lines = [
+                b'BLK %i %s\n' % (height, hexlify(blk.get_hash())),
+                b'- prev_hash: %s\n' % hexlify(blk.prev_hash),
+                b'- merkle_root: %s\n' % hexlify(blk.merkle_root),
+                b'- timestamp: %s\n' % timestamp,
+                b'- diff: %i\n' % blk.diff,
+                b'- nonce: %08x\n' % blk.nonce,
+            ]
             for tx in blk.txs:
-                msg += b'--TX %s\n' % hexlify(tx.get_txid())
+                lines.append(b'--TX %s\n' % hexlify(tx.get_txid()))
                 for inp in tx.inputs:
                     if inp.txid == NO_HASH:
-                        msg += (b'---- INP dummy 0 (%#x, %s...)\n'
-                                % (inp.index, hexlify(inp.signature)[:32]))
+                        lines.append(b'---- INP dummy 0 (%#x, %s...)\n'
+                                     % (inp.index,
+                                        hexlify(inp.signature)[:32]))
                     else:
-                        msg += (b'---- INP %s %i\n'
-                                % (hexlify(inp.spent_output.pubkey),
-                                   inp.spent_output.amount))
+                        lines.append(b'---- INP %s %i\n'
+                                     % (hexlify(inp.spent_output.pubkey),
+                                        inp.spent_output.amount))
                 for out in tx.outputs:
-                    msg += (b'---- OUT %s %i\n'
-                            % (hexlify(out.pubkey), out.amount))
-            msg += b'\n'
-        return msg
+                    lines.append(b'---- OUT %s %i\n'
+                                 % (hexlify(out.pubkey), out.amount))
+            lines.append(b'\n')
+            yield b''.join(lines)
 
 
 class Client:
-    def __init__(self, host, port):
-        self.blockchain = Blockchain()
-        self.wallet = Wallet(self.blockchain, autoload=False)
+    def __init__(self, host, port, peers=()):
+        self.blockchain = Blockchain(index=True)
         self.miner = Miner(self.blockchain, NO_PUBKEY)
+        self.wallet = Wallet(self.blockchain, autoload=False,
+                             mempool=self.miner.mempool)
 
-        self.p2p = P2P(self.blockchain, self.miner, host, port)
+        self.p2p = P2P(self.blockchain, self.miner, host, port, peers=peers)
         self.rpc = RPC(self.blockchain, self.miner, self.wallet, self.p2p)
 
+        metrics.register_node(self.blockchain, self.miner, self.p2p)
+        if METRICS_PORT is not None:
+            self.metrics = metrics.MetricsServer(METRICS_HOST, METRICS_PORT)
+            profiling.add_sink(profiling.MetricsSink())
+        if PROFILE_LOG:
+            profiling.add_sink(profiling.LogSink(logging.INFO))
+
     def main_loop(self):
         while True:
             self.poll_net()
@@ -189,11 +474,14 @@ class Client:
         for blk in blocks_received:
             # Remote blocks can cheat difficulty (lol sucks to be you)
             blk.reduce_diff = True
-            self.blockchain.add_block(blk)
+            if self.blockchain.add_block(blk):
+                # Relay to the other peers
+                self.p2p.broadcast_block(blk)
 
         txs_received = self.p2p.get_incoming_transactions()
-        for tx in txs_received:
-            self.miner.add_transaction(tx)
+        if txs_received:
+            for tx in self.miner.add_transactions(txs_received):
+                self.p2p.broadcast_transaction(tx)
 
     def poll_miner(self):
         mined_block = self.miner.get_mined_block()
@@ -206,7 +494,12 @@ if __name__ == '__main__':
     logging.basicConfig(level=10)
 
     if len(argv) < 3:
-        log.error('Usage: %s <host> <port>')
+        log.error('Usage: %s <host> <port> [<peer_host>:<peer_port> ...]')
+
+    peers = []
+    for peer in argv[3:]:
+        peer_host, peer_port = peer.rsplit(':', 1)
+        peers.append((peer_host, int(peer_port)))
 
-    cli = Client(argv[1], int(argv[2]))
+    cli = Client(argv[1], int(argv[2]), peers)
     cli.main_loop()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+""" Replay recorded P2P traffic into a fresh node and report how long each
+stage took.
+
+Record traffic by setting P2P_CAPTURE_PATH in shitcoin/settings.py. """
+
+import argparse
+import logging
+
+from shitcoin.replay import Replayer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('capture', help='capture file to replay')
+    parser.add_argument('--realtime', action='store_true',
+                        help='keep the recorded delays between packages '
+                             '(default: as fast as possible)')
+    parser.add_argument('--full-diff', action='store_true',
+                        help='do not accept blocks with reduced difficulty')
+    parser.add_argument('--verbose', action='store_true',
+                        help='log what the node does')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.WARNING)
+
+    replayer = Replayer(args.capture, not args.full_diff)
+    results = replayer.run(args.realtime)
+
+    print('%i packages (%i failed) in %.3f s, chain height %i'
+          % (results['packages'], results['errors'], results['elapsed'],
+             results['height']))
+    print('%-22s %8s %10s %10s %10s %10s %10s'
+          % ('stage', 'count', 'total ms', 'mean ms', 'p50 ms', 'p99 ms',
+             'max ms'))
+    for stage, t in results['stages'].items():
+        print('%-22s %8i %10.2f %10.3f %10.3f %10.3f %10.3f'
+              % (stage, t['count'], t['total'] * 1000, t['mean'] * 1000,
+                 t['p50'] * 1000, t['p99'] * 1000, t['max'] * 1000))
+
+
+if __name__ == '__main__':
+    main()
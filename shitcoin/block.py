@@ -11,6 +11,10 @@ from .settings import (
 )
 from .transaction import Transaction
 
+# Serialized size of a block header: prev_hash, merkle_root, timestamp, diff
+# and nonce
+HEADER_LEN = 2 * HASH_LEN + 8 + 1 + 8
+
 log = logging.getLogger(__name__)
 
 
@@ -65,12 +69,7 @@ class Block:
 
     @staticmethod
     def unserialize(buf):
-        blk = Block()
-        blk.prev_hash = buf.read(HASH_LEN)
-        blk.merkle_root = buf.read(HASH_LEN)
-        blk.timestamp = buf.read_u64()
-        blk.diff = buf.read_u8()
-        blk.nonce = buf.read_u64()
+        blk = Block.unserialize_header(buf)
         txcount = buf.read_u32()
         blk.txs = []
         for _ in range(txcount):
@@ -82,6 +81,17 @@ class Block:
                 out.block = blk
         return blk
 
+    @staticmethod
+    def unserialize_header(buf):
+        """ Read a block header. The block has no transactions. """
+        blk = Block()
+        blk.prev_hash = buf.read(HASH_LEN)
+        blk.merkle_root = buf.read(HASH_LEN)
+        blk.timestamp = buf.read_u64()
+        blk.diff = buf.read_u8()
+        blk.nonce = buf.read_u64()
+        return blk
+
     def serialize(self, buf=None):
         if buf is None:
             buf = SerializationBuffer()
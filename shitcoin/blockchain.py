@@ -3,6 +3,9 @@ import logging
 from threading import Lock
 
 from .block import GENESIS, GENESIS_HASH
+from .exceptions import IndexDisabled
+from .index import ChainIndex
+from .profiling import span
 from .utxoset import UTXOSet
 from .validation import validate_block
 
@@ -20,7 +23,14 @@ class Blockchain:
     Blockchain.get_head(). Any ancestor of the returned block is fixed, so can
     be read without problems.
     """
-    def __init__(self):
+    def __init__(self, index=False):
+        """ Creates a blockchain with only the genesis block.
+
+        Args:
+            index: Keep indexes of the transactions and the history of each
+                address in the main chain, see get_transaction and
+                get_history
+        """
         # Current state
         self.blocks_by_hash = {}
         self.utxos = UTXOSet()
@@ -29,6 +39,11 @@ class Blockchain:
         self.blocks_by_hash[GENESIS_HASH] = GENESIS
         self.unvalidated_blocks = {}
         self.head = GENESIS
+        self.main_chain = [GENESIS]  # blocks of the longest chain by height
+        self.index = None
+        if index:
+            self.index = ChainIndex()
+            self.index.connect_block(GENESIS)
 
         # Lock for the chain head and block lists
         self.lock = Lock()
@@ -48,33 +63,125 @@ class Blockchain:
             head = self.head
         return head
 
+    def get_block_at_height(self, height):
+        """ Get the block at some height of the longest chain.
+
+        Returns:
+            A Block or None, if the chain is not that long
+        """
+        with self.lock:
+            if 0 <= height < len(self.main_chain):
+                return self.main_chain[height]
+        return None
+
+    def get_transaction(self, txid):
+        """ Find a transaction in the longest chain. Needs the index.
+
+        Raises:
+            IndexDisabled: If the blockchain keeps no index
+
+        Returns:
+            tuple (Block, position in the block) or None, if it is not there
+        """
+        if self.index is None:
+            raise IndexDisabled('chain index disabled')
+        with self.lock:
+            location = self.index.get_transaction(txid)
+            if location is None:
+                return None
+            block_hash, pos = location
+            return self.blocks_by_hash[block_hash], pos
+
+    def get_history(self, pubkey):
+        """ Get the changes of the balance of an address in the longest
+        chain. Needs the index.
+
+        Raises:
+            IndexDisabled: If the blockchain keeps no index
+
+        Returns:
+            list of tuples (height, txid, amount), oldest first. Negative
+            amounts were paid by the address.
+        """
+        if self.index is None:
+            raise IndexDisabled('chain index disabled')
+        with self.lock:
+            return self.index.get_history(pubkey)
+
+    def get_block_locator(self):
+        """ Get hashes describing the longest chain to a peer, which does not
+        know where our chains fork. The first ten hashes are the newest
+        blocks, then the step between them doubles until the genesis block.
+        """
+        locator = []
+        with self.lock:
+            height = len(self.main_chain) - 1
+            step = 1
+            while height > 0:
+                locator.append(self.main_chain[height].get_hash())
+                if len(locator) >= 10:
+                    step *= 2
+                height -= step
+        locator.append(GENESIS_HASH)
+        return locator
+
+    def get_headers(self, locator, limit):
+        """ Get the blocks of the longest chain following the fork point with
+        a peer. The fork point is the first block in the locator, which is on
+        the longest chain.
+
+        Args:
+            locator: list of block hashes as from get_block_locator
+            limit: Maximum number of blocks to return
+
+        Returns:
+            List of Blocks
+        """
+        with self.lock:
+            fork_height = 0
+            for block_hash in locator:
+                blk = self.blocks_by_hash.get(block_hash)
+                if (blk is not None
+                        and self.main_chain[blk.get_height()] is blk):
+                    fork_height = blk.get_height()
+                    break
+            return self.main_chain[fork_height+1:fork_height+1+limit]
+
     def add_block(self, block):
         """ Add a block to the known blocks. If possible, it will be validated.
         If a new longest chain gets known, the head is switched to the new
-        chain. """
+        chain.
+
+        Returns:
+            True if the block was validated and stored. False if it was
+            known already, is invalid or is waiting for its parent.
+        """
         block_hash = block.get_hash()
         with self.lock:
             if (block_hash in self.blocks_by_hash
                     or block_hash in self.unvalidated_blocks):
                 # already known
-                return
+                return False
 
             try:
                 parent = self.blocks_by_hash[block.prev_hash]
             except KeyError:
-                # Store until we get the parent
+                # Store until we get the parent. P2P.receive_block asks the
+                # peer for the missing headers.
                 self.unvalidated_blocks[block_hash] = block
-                # TODO: The parent should be requested from other nodes
-                return
+                return False
 
         block.set_parent(parent)
 
         # Validate the block
-        with self.lock:
-            temp_utxos = self.utxos.copy()
-        if not validate_block(block, temp_utxos):
+        with span('add_block.utxo_copy', block):
+            with self.lock:
+                temp_utxos = self.utxos.copy()
+        with span('add_block.validate', block):
+            valid = validate_block(block, temp_utxos)
+        if not valid:
             log.debug('Invalid block!')
-            return
+            return False
 
         # add to verified blocks
         with self.lock:
@@ -86,8 +193,10 @@ class Blockchain:
             if block.get_height() > self.head.get_height():
                 swapped = True
                 old_head = self.head
-                self.utxos.move_on_chain(block)
-                self.head = block
+                with span('add_block.chain_switch', block):
+                    self.utxos.move_on_chain(block)
+                    self.head = block
+                    self.update_main_chain(block)
 
         if swapped:
             # Log if reorg
@@ -107,8 +216,9 @@ class Blockchain:
             with self.callback_lock:
                 # Avoid calling unknown functions while holding a lock...
                 callbacks = self.new_block_callbacks[:]
-            for func in callbacks:
-                func(self.head)
+            with span('add_block.callbacks', block):
+                for func in callbacks:
+                    func(self.head)
 
         # Check if other blocks can be validated now
         with self.lock:
@@ -121,6 +231,25 @@ class Blockchain:
         for b in retry_blocks.values():
             self.add_block(b)
 
+        return True
+
+    def update_main_chain(self, head):
+        """ Replace the blocks of the main chain after the fork point with the
+        new head. Must be called with the lock held. """
+        new_blocks = []
+        cur = head
+        while (cur.get_height() >= len(self.main_chain)
+               or self.main_chain[cur.get_height()] is not cur):
+            new_blocks.append(cur)
+            cur = cur.get_parent()
+        if self.index is not None:
+            for blk in reversed(self.main_chain[cur.get_height()+1:]):
+                self.index.disconnect_block(blk)
+            for blk in reversed(new_blocks):
+                self.index.connect_block(blk)
+        del self.main_chain[cur.get_height()+1:]
+        self.main_chain.extend(reversed(new_blocks))
+
     def register_new_block_callback(self, func):
         """ Register a function to be called, when the head of the blockchain
         changes.
@@ -0,0 +1,84 @@
+""" Capture files of P2P traffic. The recorder writes every package a node
+receives together with the time and the sending peer, so the traffic can be
+fed into a node again later, see replay.py.
+
+A capture file starts with MAGIC, followed by one record per package:
+varuint microseconds since the previous record, varuint peer number, varuint
+package length and the package. """
+import logging
+from threading import Lock
+import time
+
+from .serialize import SerializationBuffer
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'SHITCAP1'
+
+
+class FileBuffer(SerializationBuffer):
+    """ Reads from a file instead of a buffer in memory """
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, n):
+        data = self.f.read(n)
+        if len(data) < n:
+            raise EOFError()
+        return data
+
+
+class Recorder:
+    """ Writes received packages to a capture file. Can be used from any
+    thread. """
+    def __init__(self, path):
+        log.info('Recording received packages to %s' % path)
+        self.f = open(path, 'wb')
+        self.f.write(MAGIC)
+        self.last_time = time.perf_counter()
+        self.peer_ids = {}  # peer address -> number in the file
+        self.lock = Lock()
+
+    def record(self, peer, pkg):
+        """ Append a package received from a peer """
+        now = time.perf_counter()
+        with self.lock:
+            if self.f is None:
+                return
+            peer_id = self.peer_ids.setdefault(peer.addr,
+                                               len(self.peer_ids))
+            buf = SerializationBuffer()
+            buf.write_varuint(int((now - self.last_time) * 1000000))
+            buf.write_varuint(peer_id)
+            buf.write_varuint(len(pkg))
+            self.f.write(buf.get_bytes())
+            self.f.write(pkg)
+            self.last_time = now
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+
+def read_capture(path):
+    """ Read the records of a capture file. A truncated last record, e.g. from
+    a crashed node, is ignored.
+
+    Returns:
+        Generator of tuples (seconds since previous record, peer number,
+        package)
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a capture file' % path)
+        buf = FileBuffer(f)
+        while True:
+            try:
+                delay = buf.read_varuint() / 1000000
+                peer_id = buf.read_varuint()
+                pkg = buf.read(buf.read_varuint())
+            except EOFError:
+                return
+            yield delay, peer_id, pkg
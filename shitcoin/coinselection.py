@@ -0,0 +1,115 @@
+""" Coin selection. Picks the utxos a transaction spends, so that it has few
+inputs and, if possible, needs no change output. """
+from .exceptions import NotEnoughFunds
+
+# Maximum number of steps of the branch and bound search
+BNB_MAX_TRIES = 100000
+
+
+def branch_and_bound(amounts, target, max_excess, max_tries=BNB_MAX_TRIES):
+    """ Search for a subset of amounts, whose sum lies between target and
+    target + max_excess, so no change is needed. Among those, the one with
+    the fewest elements and then the smallest excess wins.
+
+    Args:
+        amounts: list of ints
+        target: Minimum sum
+        max_excess: Maximum sum above the target
+        max_tries: Give up after this many steps and return the best subset
+            found so far
+
+    Returns:
+        List of indexes into amounts or None, if there is no such subset
+    """
+    order = sorted(range(len(amounts)), key=lambda i: amounts[i],
+                   reverse=True)
+    values = [amounts[i] for i in order]
+
+    # remaining[pos] is the sum of all values from pos on
+    remaining = [0] * (len(values) + 1)
+    for pos in range(len(values) - 1, -1, -1):
+        remaining[pos] = remaining[pos + 1] + values[pos]
+
+    best = None
+    best_excess = None
+    included = []  # positions on the current path, which are taken
+    total = 0
+    pos = 0
+    for _ in range(max_tries):
+        backtrack = True
+        if target <= total <= target + max_excess:
+            excess = total - target
+            if (best is None or len(included) < len(best)
+                    or (len(included) == len(best) and excess < best_excess)):
+                best = included[:]
+                best_excess = excess
+        elif (total < target
+              and total + remaining[pos] >= target
+              and (best is None or len(included) < len(best))):
+            # Take the next value
+            included.append(pos)
+            total += values[pos]
+            pos += 1
+            backtrack = False
+
+        if backtrack:
+            if not included:
+                break
+            # Leave out the last taken value instead. Leaving it out and
+            # taking an equal one gives the same sums, so skip those too.
+            last = included.pop()
+            total -= values[last]
+            pos = last + 1
+            while pos < len(values) and values[pos] == values[last]:
+                pos += 1
+
+    if best is None:
+        return None
+    return [order[pos] for pos in best]
+
+
+def largest_first(amounts, target):
+    """ Take the largest amounts until the target is reached. This gives the
+    fewest elements, but usually some excess.
+
+    Returns:
+        List of indexes into amounts or None, if all together are too little
+    """
+    order = sorted(range(len(amounts)), key=lambda i: amounts[i],
+                   reverse=True)
+    selected = []
+    total = 0
+    for i in order:
+        if total >= target:
+            break
+        selected.append(i)
+        total += amounts[i]
+    if total < target:
+        return None
+    return selected
+
+
+def select_coins(utxos, target, min_change):
+    """ Pick utxos paying at least the target. A selection, which needs no
+    change, is preferred, else the largest utxos are used.
+
+    Args:
+        utxos: list of utxo dicts with an amount
+        target: Amount to pay including the fee
+        min_change: Excess below this is not worth a change output and goes
+            to the miner instead
+
+    Raises:
+        NotEnoughFunds: If the utxos are not enough
+
+    Returns:
+        List of the selected utxos
+    """
+    amounts = [utxo['amount'] for utxo in utxos]
+    if sum(amounts) < target:
+        raise NotEnoughFunds()
+
+    selected = branch_and_bound(amounts, target, min_change - 1)
+    if selected is None:
+        selected = largest_first(amounts, target)
+    return [utxos[i] for i in selected]
@@ -0,0 +1,162 @@
+""" Compact blocks. A new block is announced with its header and short ids of
+its transactions. The receiver rebuilds it from the transactions in its
+mempool and only has to ask for the ones it does not know. """
+import hashlib
+from os import urandom
+
+from . import crypto
+from .block import Block
+from .serialize import SerializationBuffer
+from .transaction import Transaction
+
+SHORT_ID_LEN = 6
+
+# Most transactions a compact block may announce. Even with the smallest
+# transactions, a block of BLOCK_MAX_SIZE bytes holds far fewer.
+MAX_BLOCK_TXS = 100000
+
+
+def get_short_id(key, txid):
+    """ Get the short id of a transaction. The key is different for every
+    compact block, so nobody can make transactions with colliding ids. """
+    return hashlib.sha256(key + txid).digest()[:SHORT_ID_LEN]
+
+
+class CompactBlock:
+    def __init__(self, header, salt, tx_count, prefilled, short_ids):
+        """ Creates a compact block.
+
+        Args:
+            header(Block): Block header without transactions
+            salt(int): Random u64 mixed into the short id key
+            tx_count: Number of transactions of the block
+            prefilled: dict index -> Transaction sent along
+            short_ids: dict index -> short id for all other transactions
+        """
+        self.header = header
+        self.salt = salt
+        self.tx_count = tx_count
+        self.prefilled = prefilled
+        self.short_ids = short_ids
+
+        # Serialized transactions of the block, as far as known
+        self.tx_bufs = [None] * tx_count
+        for index, tx in prefilled.items():
+            self.tx_bufs[index] = tx.serialize().get_bytes()
+
+    def get_hash(self):
+        return self.header.get_hash()
+
+    def get_key(self):
+        return self.get_hash() + self.salt.to_bytes(8, byteorder='big')
+
+    @staticmethod
+    def from_block(blk, known_txids):
+        """ Make a compact block. Transactions the receiver does not know,
+        like the coinbase, are sent along.
+
+        Args:
+            known_txids: Container of txids, the receiver has
+        """
+        header = Block.unserialize_header(blk.serialize_header())
+        compact = CompactBlock(header,
+                               int.from_bytes(urandom(8), byteorder='big'),
+                               len(blk.txs), {}, {})
+        key = compact.get_key()
+        for index, tx in enumerate(blk.txs):
+            txid = tx.get_txid()
+            if txid in known_txids:
+                compact.short_ids[index] = get_short_id(key, txid)
+            else:
+                compact.prefilled[index] = tx
+        return compact
+
+    @staticmethod
+    def unserialize(buf):
+        """ Read a compact block sent by a peer.
+
+        Raises:
+            ValueError: If the counts are out of range or the package is too
+                short for them
+        """
+        header = Block.unserialize_header(buf)
+        salt = buf.read_u64()
+        tx_count = buf.read_varuint()
+        if tx_count > MAX_BLOCK_TXS:
+            raise ValueError('Too many transactions: %i' % tx_count)
+        prefilled_count = buf.read_varuint()
+        if prefilled_count > tx_count:
+            raise ValueError('More prefilled transactions than transactions')
+        prefilled = {}
+        for _ in range(prefilled_count):
+            index = buf.read_varuint()
+            prefilled[index] = Transaction.unserialize(buf)
+        if any(index >= tx_count for index in prefilled):
+            raise ValueError('Prefilled transaction out of range')
+
+        # Check the short ids are all there before reading them
+        short_id_count = tx_count - len(prefilled)
+        if len(buf.get_bytes()) < short_id_count * SHORT_ID_LEN:
+            raise ValueError('Short ids are truncated')
+        short_ids = {}
+        for index in range(tx_count):
+            if index not in prefilled:
+                short_ids[index] = buf.read(SHORT_ID_LEN)
+        return CompactBlock(header, salt, tx_count, prefilled, short_ids)
+
+    def serialize(self, buf=None):
+        if buf is None:
+            buf = SerializationBuffer()
+
+        self.header.serialize_header(buf)
+        buf.write_u64(self.salt)
+        buf.write_varuint(self.tx_count)
+        buf.write_varuint(len(self.prefilled))
+        for index in sorted(self.prefilled):
+            buf.write_varuint(index)
+            self.prefilled[index].serialize(buf)
+        for index in sorted(self.short_ids):
+            buf.write(self.short_ids[index])
+        return buf
+
+    def fill_from_mempool(self, transactions):
+        """ Look up the transactions of the block by their short ids.
+
+        Args:
+            transactions: dict txid -> Transaction, like Mempool.transactions
+        """
+        key = self.get_key()
+        by_short_id = {}
+        for txid, tx in transactions.items():
+            short_id = get_short_id(key, txid)
+            # Colliding ids are useless, the transaction has to be requested
+            by_short_id[short_id] = None if short_id in by_short_id else tx
+
+        for index, short_id in self.short_ids.items():
+            tx = by_short_id.get(short_id)
+            if tx is not None:
+                self.tx_bufs[index] = tx.serialize().get_bytes()
+
+    def get_missing(self):
+        """ Get the indexes of the transactions, which are still unknown """
+        return [i for i, tx_buf in enumerate(self.tx_bufs) if tx_buf is None]
+
+    def fill(self, indexes, txs):
+        """ Add the transactions a peer sent for our missing indexes """
+        for index, tx in zip(indexes, txs):
+            self.tx_bufs[index] = tx.serialize().get_bytes()
+
+    def get_block(self):
+        """ Assemble the full block.
+
+        Returns:
+            The Block or None, if the transactions do not match the merkle
+            root, e.g. because of a short id collision.
+        """
+        if crypto.merkle_root(self.tx_bufs) != self.header.merkle_root:
+            return None
+
+        buf = self.header.serialize_header()
+        buf.write_u32(self.tx_count)
+        buf.write(b''.join(self.tx_bufs))
+        return Block.unserialize(buf)
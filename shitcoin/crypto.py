@@ -1,6 +1,10 @@
 import hashlib
+import multiprocessing
+
 import ed25519
 
+from .workers import get_worker_context
+
 
 PUBKEY_LEN = 32
 PRIVKEY_LEN = 64
@@ -11,6 +15,9 @@ NO_PUBKEY = b'\x00' * PUBKEY_LEN
 NO_HASH = b'\x00' * HASH_LEN
 NO_SIG = b'\x00' * SIG_LEN
 
+# Batches with fewer signatures are signed in the calling process
+SIGN_POOL_MIN = 1000
+
 
 def merkle_root(leaves):
     l = len(leaves)
@@ -42,9 +49,47 @@ def sign(msg, priv_key):
     return signer.sign(msg)
 
 
+def sign_batch(items, processes=None):
+    """ Sign many messages at once. Equal items are signed only once and
+    large batches are spread over a pool of worker processes.
+
+    Args:
+        items: iterable of tuples (msg, priv_key)
+        processes: Number of worker processes, all cores if None
+
+    Returns:
+        List of signatures in the order of the items
+    """
+    items = list(items)
+    unique = list(dict.fromkeys(items))
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes < 2 or len(unique) < SIGN_POOL_MIN:
+        sigs = [sign(msg, priv_key) for msg, priv_key in unique]
+    else:
+        with get_worker_context().Pool(processes) as pool:
+            sigs = pool.starmap(sign, unique, chunksize=64)
+
+    by_item = dict(zip(unique, sigs))
+    return [by_item[item] for item in items]
+
+
 def verify_sig(msg, pub_key, sig):
     try:
         ed25519.VerifyingKey(pub_key).verify(sig, msg)
         return True
     except ed25519.BadSignatureError:
         return False
+
+
+def verify_sig_batch(items):
+    """ Verify many signatures at once.
+
+    Args:
+        items: iterable of tuples (msg, pub_key, sig)
+
+    Returns:
+        List of booleans, True for each valid signature
+    """
+    verify = verify_sig
+    return [verify(msg, pub_key, sig) for msg, pub_key, sig in items]
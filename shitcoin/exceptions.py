@@ -8,3 +8,7 @@ class InvalidBlock(Exception):
 
 class NotEnoughFunds(Exception):
     pass
+
+
+class IndexDisabled(Exception):
+    pass
@@ -0,0 +1,65 @@
+""" Indexes over the main chain for explorer queries. They are kept up to date
+by the Blockchain as blocks are connected to and disconnected from the main
+chain. """
+from .crypto import NO_HASH
+
+
+class ChainIndex:
+    """ Maps txids to where they are in the main chain and pubkeys to the
+    changes of their balance. Not thread safe, the Blockchain only uses it
+    with its lock held. """
+    def __init__(self):
+        self.txs = {}  # txid -> (block hash, position in block)
+        self.history = {}  # pubkey -> list of (height, txid, delta)
+
+    def connect_block(self, blk):
+        """ Add a block appended to the main chain """
+        block_hash = blk.get_hash()
+        height = blk.get_height()
+        for pos, tx in enumerate(blk.txs):
+            txid = tx.get_txid()
+            self.txs[txid] = (block_hash, pos)
+            for pubkey, delta in self.get_deltas(tx).items():
+                self.history.setdefault(pubkey, []).append(
+                    (height, txid, delta))
+
+    def disconnect_block(self, blk):
+        """ Remove the block at the tip of the main chain """
+        height = blk.get_height()
+        for tx in reversed(blk.txs):
+            txid = tx.get_txid()
+            self.txs.pop(txid, None)
+            for pubkey in self.get_deltas(tx):
+                entries = self.history.get(pubkey)
+                # The block is the newest one, so its entries are at the end
+                while entries and entries[-1][0] == height:
+                    entries.pop()
+                if not entries:
+                    self.history.pop(pubkey, None)
+
+    @staticmethod
+    def get_deltas(tx):
+        """ Get how much a transaction changes the balance of each pubkey.
+        The inputs must have been validated, so the spent outputs are known.
+
+        Returns:
+            dict of pubkey -> amount, negative if the pubkey pays
+        """
+        deltas = {}
+        for inp in tx.inputs:
+            if inp.txid == NO_HASH:  # skip dummy inputs
+                continue
+            pubkey = inp.spent_output.pubkey
+            deltas[pubkey] = deltas.get(pubkey, 0) - inp.spent_output.amount
+        for out in tx.outputs:
+            deltas[out.pubkey] = deltas.get(out.pubkey, 0) + out.amount
+        return deltas
+
+    def get_transaction(self, txid):
+        """ Returns: tuple (block hash, position) or None, if not in the main
+        chain """
+        return self.txs.get(txid)
+
+    def get_history(self, pubkey):
+        """ Returns: list of tuples (height, txid, delta), oldest first """
+        return list(self.history.get(pubkey, ()))
@@ -1,16 +1,67 @@
+from bisect import bisect_left, insort
+from collections import deque
 from functools import partial
+from threading import Lock
 
-from .crypto import NO_HASH, verify_sig
+from .crypto import NO_HASH, verify_sig_batch
 from .exceptions import UTXONotFound
+from .settings import BLOCK_MAX_SIZE, BLOCK_MAX_TXS, MEMPOOL_MAX_SIZE
+
+
+class MempoolEntry:
+    """ A transaction in the mempool together with the data used to rank it.
+    Parents and children are the txids of other mempool transactions, which
+    this one spends from or which spend from this one. """
+    def __init__(self, tx, txid, fee, size, sequence):
+        self.tx = tx
+        self.txid = txid
+        self.fee = fee
+        self.size = size  # serialized size in bytes
+        self.sequence = sequence  # parents always have a lower sequence
+
+        self.parents = set()
+        self.children = set()
+
+        # Fee and size of this transaction together with all of its
+        # descendants
+        self.descendant_fee = fee
+        self.descendant_size = size
+
+    def get_fee_rate(self):
+        return self.fee / self.size
+
+    def get_descendant_score(self):
+        """ Get the rank for eviction. Children paying a high fee make their
+        parent worth mining, so it is ranked by the fee rate of the package
+        with its descendants, unless it pays better on its own. """
+        return max(self.get_fee_rate(),
+                   self.descendant_fee / self.descendant_size)
 
 
 class Mempool:
-    """ List of transactions, which are not included in any block yet. """
-    def __init__(self, blockchain):
+    """ List of transactions, which are not included in any block yet.
+
+    Every transaction is indexed by its descendant score, the fee rate (fee
+    per serialized byte) of it together with everything spending from it. If
+    the mempool grows beyond max_size bytes, the transactions with the lowest
+    score are evicted together with their descendants, so packages a miner
+    would pick stay in.
+
+    Transactions are added by the network and the RPC threads, while the
+    miner builds templates from it, so the state is protected by a lock.
+    The dicts of transactions and entries are only changed under the lock,
+    they can be read without it. """
+    def __init__(self, blockchain, max_size=MEMPOOL_MAX_SIZE):
         self.blockchain = blockchain
+        self.max_size = max_size
+        self.lock = Lock()
         self.transactions = {}  # txid -> Transaction
+        self.entries = {}  # txid -> MempoolEntry
+        self.by_descendant_score = []  # sorted list of (score, txid)
         self.utxos = blockchain.utxos.copy()
         self.total_fees = 0
+        self.total_size = 0
+        self.sequence = 0
 
         self.blockchain.register_new_block_callback(
             partial(Mempool.incoming_block, self))
@@ -19,61 +70,336 @@ class Mempool:
         self.new_tx_callbacks = []
 
     def add_transaction(self, transaction, inform_callbacks=True):
-        txid = transaction.get_txid()
+        """ Validate and add a single transaction.
+
+        Returns:
+            True if the transaction was added to the mempool
+        """
+        return bool(self.add_transactions([transaction], inform_callbacks))
+
+    def add_transactions(self, transactions, inform_callbacks=True):
+        """ Validate and add a batch of transactions. The batch is checked
+        against a single copy of the mempool utxo set, transactions spending
+        from each other inside the batch may come in any order, and all
+        signatures are verified in one go. Callbacks are informed once about
+        all added transactions.
+
+        Args:
+            transactions: iterable of Transactions
+
+        Returns:
+            List of the added Transactions
+        """
+        # Signatures are checked without the lock, the inputs are resolved
+        # again when the transactions are added
+        with self.lock:
+            resolved = self._resolve_transactions(transactions)
+        bad_txids = self._check_signatures(resolved)
+        with self.lock:
+            added = self._add_resolved(resolved, bad_txids)
+
+        # Inform callbacks
+        if inform_callbacks and added:
+            for func in self.new_tx_callbacks:
+                func(added)
 
-        if txid in self.transactions:
-            return
+        return added
 
-        # Validate transaction
+    def _resolve_transactions(self, transactions):
+        """ Find the fees of the transactions, which are new and can be
+        applied to the mempool.
+
+        Returns:
+            List of tuples (txid, Transaction, fee) in a valid order
+        """
+        batch = {}
+        for tx in transactions:
+            txid = tx.get_txid()
+            if txid not in self.transactions:
+                batch.setdefault(txid, tx)
+
+        # Resolve the inputs against one overlay. Transactions paying too
+        # little are taken out again, so nothing can build on top of them.
+        overlay = self.utxos.copy()
+        resolved = []
+        for txid in self._sort_batch(batch):
+            tx = batch[txid]
+            try:
+                fee = overlay.apply_transaction(tx)
+            except UTXONotFound:
+                continue
+
+            # Only mine transaction, which pay at least 10 fee
+            if fee < 10:
+                overlay.revert_transaction(tx)
+                continue
+            resolved.append((txid, tx, fee))
+        return resolved
+
+    @staticmethod
+    def _check_signatures(resolved):
+        """ Returns: set of the txids with a bad signature """
+        sig_owners = []
+        sig_checks = []
+        for txid, tx, _ in resolved:
+            for inp in tx.inputs:
+                if inp.txid == NO_HASH:  # skip dummy inputs
+                    continue
+                sig_owners.append(txid)
+                sig_checks.append((txid, inp.spent_output.pubkey,
+                                   inp.signature))
+        return {txid for txid, valid
+                in zip(sig_owners, verify_sig_batch(sig_checks))
+                if not valid}
+
+    def _add_resolved(self, resolved, bad_txids):
+        """ Add the resolved transactions with valid signatures.
+
+        Returns:
+            List of the added Transactions
+        """
+        # Children of rejected transactions can not be applied to the
+        # mempool utxo set and are skipped. So are transactions added or
+        # double spent by another thread since they were resolved.
+        added = []
+        for txid, tx, fee in resolved:
+            if (txid not in bad_txids and txid not in self.transactions
+                    and self._add_entry(tx, txid, fee)):
+                added.append(txid)
+
+        # Make room if we are over the limit. This might throw out some of the
+        # new transactions again, if they pay the lowest fee rates.
+        self._trim()
+        return [self.transactions[txid] for txid in added
+                if txid in self.transactions]
+
+    @staticmethod
+    def _sort_batch(batch):
+        """ Order the txids of a dict txid -> Transaction, so that every
+        transaction comes after the ones it spends from. """
+        children = {}
+        missing_parents = {}
+        for txid, tx in batch.items():
+            parents = {inp.txid for inp in tx.inputs if inp.txid in batch}
+            missing_parents[txid] = len(parents)
+            for parent in parents:
+                children.setdefault(parent, []).append(txid)
+
+        ready = deque(txid for txid, n in missing_parents.items() if n == 0)
+        ordered = []
+        while ready:
+            txid = ready.popleft()
+            ordered.append(txid)
+            for child in children.get(txid, []):
+                missing_parents[child] -= 1
+                if missing_parents[child] == 0:
+                    ready.append(child)
+        return ordered
+
+    def _add_entry(self, transaction, txid, fee):
+        """ Apply a validated transaction to the mempool and index it.
+
+        Returns:
+            False if some input could not be resolved
+        """
         try:
-            temp_utxos = self.utxos.copy()
-            fee = temp_utxos.apply_transaction(transaction)
+            self.utxos.apply_transaction(transaction)
         except UTXONotFound:
-            return
+            return False
 
-        # Check signatures
+        entry = MempoolEntry(transaction, txid, fee,
+                             len(transaction.serialize().get_bytes()),
+                             self.sequence)
+        self.sequence += 1
         for inp in transaction.inputs:
-            if inp.txid == NO_HASH:  # skip dummy inputs
-                continue
-            if not verify_sig(txid, inp.spent_output.pubkey,
-                              inp.signature):
-                return False
+            if inp.txid in self.entries:
+                entry.parents.add(inp.txid)
+                self.entries[inp.txid].children.add(txid)
 
-        # Only mine transaction, which pay at least 10 fee
-        if fee < 10:
-            return
-
-        # Transaction is valid, save it
         self.transactions[txid] = transaction
+        self.entries[txid] = entry
+        insort(self.by_descendant_score, (entry.get_descendant_score(), txid))
+        for ancestor in self.get_ancestors(txid):
+            self._add_to_descendants(self.entries[ancestor], fee, entry.size)
         self.total_fees += fee
-        self.utxos.apply_transaction(transaction)
+        self.total_size += entry.size
+        return True
 
-        # Inform callbacks
-        if inform_callbacks:
-            for func in self.new_tx_callbacks:
-                func(transaction)
+    def remove_transaction(self, txid):
+        """ Remove a transaction and all of its descendants from the mempool.
+
+        Returns:
+            List of the removed txids
+        """
+        with self.lock:
+            return self._remove_transaction(txid)
+
+    def _remove_transaction(self, txid):
+        if txid not in self.entries:
+            return []
+
+        # Remove the descendants first, their outputs have to be unspent to
+        # revert the transactions in the utxo set
+        removed = self.get_descendants(txid) + [txid]
+        removed.sort(key=lambda t: self.entries[t].sequence, reverse=True)
+
+        # The ancestors, which stay, lose these descendants
+        removed_set = set(removed)
+        for t in removed:
+            entry = self.entries[t]
+            for ancestor in self.get_ancestors(t):
+                if ancestor not in removed_set:
+                    self._add_to_descendants(self.entries[ancestor],
+                                             -entry.fee, -entry.size)
+
+        for t in removed:
+            entry = self.entries.pop(t)
+            self.transactions.pop(t)
+            self.by_descendant_score.pop(bisect_left(
+                self.by_descendant_score, (entry.get_descendant_score(), t)))
+            self.total_fees -= entry.fee
+            self.total_size -= entry.size
+            self.utxos.revert_transaction(entry.tx)
+            for parent in entry.parents:
+                if parent in self.entries:
+                    self.entries[parent].children.discard(t)
+        return removed
+
+    def _add_to_descendants(self, entry, fee, size):
+        """ Change the descendant fee and size of an entry and move it in the
+        index accordingly """
+        scores = self.by_descendant_score
+        scores.pop(bisect_left(scores,
+                               (entry.get_descendant_score(), entry.txid)))
+        entry.descendant_fee += fee
+        entry.descendant_size += size
+        insort(scores, (entry.get_descendant_score(), entry.txid))
+
+    def trim(self):
+        """ Evict the transactions with the lowest descendant score, until the
+        mempool fits into max_size again.
+
+        Returns:
+            List of the evicted txids
+        """
+        with self.lock:
+            return self._trim()
+
+    def _trim(self):
+        evicted = []
+        while self.total_size > self.max_size:
+            _, txid = self.by_descendant_score[0]
+            evicted += self._remove_transaction(txid)
+        return evicted
+
+    def get_ancestors(self, txid):
+        """ Get the txids of all unconfirmed transactions, which have to be
+        mined before the given one. """
+        ancestors = set()
+        stack = list(self.entries[txid].parents)
+        while stack:
+            t = stack.pop()
+            if t not in ancestors:
+                ancestors.add(t)
+                stack.extend(self.entries[t].parents)
+        return list(ancestors)
+
+    def get_descendants(self, txid):
+        """ Get the txids of all transactions spending from the given one,
+        directly or indirectly. """
+        descendants = set()
+        stack = list(self.entries[txid].children)
+        while stack:
+            t = stack.pop()
+            if t not in descendants:
+                descendants.add(t)
+                stack.extend(self.entries[t].children)
+        return list(descendants)
+
+    def get_package_fee_rate(self, txid):
+        """ Get the fee rate of a transaction together with all of its
+        unconfirmed ancestors. A child paying a high fee makes it worthwhile to
+        mine its cheap parents. """
+        package = [self.entries[t]
+                   for t in self.get_ancestors(txid) + [txid]]
+        return (sum(e.fee for e in package)
+                / sum(e.size for e in package))
+
+    def get_block_template(self, max_size=BLOCK_MAX_SIZE,
+                           max_txs=BLOCK_MAX_TXS):
+        """ Pick the transactions for a new block. Packages of transactions
+        and their unconfirmed ancestors are added greedily by package fee rate,
+        as long as they fit into the limits.
+
+        Args:
+            max_size: Maximum serialized size of the picked transactions
+            max_txs: Maximum number of picked transactions
+
+        Returns:
+            Tuple (list of Transactions in a valid order, total fees)
+        """
+        with self.lock:
+            return self._get_block_template(max_size, max_txs)
+
+    def _get_block_template(self, max_size, max_txs):
+        candidates = sorted(self.entries, key=self.get_package_fee_rate,
+                            reverse=True)
+
+        selected = set()
+        txs = []
+        size = 0
+        fees = 0
+        for txid in candidates:
+            if txid in selected:
+                continue
+
+            package = [t for t in self.get_ancestors(txid)
+                       if t not in selected] + [txid]
+            package.sort(key=lambda t: self.entries[t].sequence)
+            package_size = sum(self.entries[t].size for t in package)
+            if (size + package_size > max_size
+                    or len(txs) + len(package) > max_txs):
+                continue
+
+            for t in package:
+                selected.add(t)
+                txs.append(self.entries[t].tx)
+                fees += self.entries[t].fee
+            size += package_size
+
+        return txs, fees
 
     def incoming_block(self, blk):
-        # Remove all transactions from mempool, which are now in the blockchain
-        for tx in blk.txs:
-            try:
-                self.transactions.pop(tx.get_txid())
-            except KeyError:
-                pass
-
-        # Recreate the mempool utxo set
-        txs = self.transactions
-        self.transactions = {}
-        self.utxos = self.blockchain.utxos.copy()
-        self.total_fees = 0
+        with self.lock:
+            # Remove all transactions from mempool, which are now in the
+            # blockchain
+            txs = dict(self.transactions)
+            for tx in blk.txs:
+                txs.pop(tx.get_txid(), None)
+
+            # Recreate the mempool utxo set
+            self.transactions = {}
+            self.entries = {}
+            self.by_descendant_score = []
+            self.utxos = self.blockchain.utxos.copy()
+            self.total_fees = 0
+            self.total_size = 0
 
-        # Readd all transactions, which can still be applied
-        # TODO: This ignores the order, so some might get excluded due to wrong
-        # ordering
-        for tx in txs.values():
-            self.add_transaction(tx, False)
+            # Readd all transactions, which can still be applied. The lock
+            # is kept, so templates never see the mempool half filled. The
+            # signatures were checked, when the transactions were admitted,
+            # and the txid they sign commits to the spent outpoints, so only
+            # the inputs are resolved again.
+            resolved = self._resolve_transactions(txs.values())
+            self._add_resolved(resolved, set())
 
     def register_new_tx_callback(self, func):
+        """ Register a function to be called, when transactions are added.
+
+        Args:
+            func(function): A function, which takes a list of the added
+                            Transactions
+        """
         self.new_tx_callbacks.append(func)
 
     def unregister_new_tx_callback(self, func):
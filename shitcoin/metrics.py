@@ -0,0 +1,261 @@
+""" Metrics of the node, served over HTTP in the Prometheus text format.
+
+Modules create their metrics at import time in the global REGISTRY and update
+them where things happen. Values, which are cheaper to read when asked for,
+like the size of the mempool, are metrics with a function instead, which is
+called for every scrape. See register_node for those. """
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+from threading import Lock, Thread
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the buckets of histograms of durations, in seconds
+TIME_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1., 5.)
+
+
+class Metric:
+    """ Base class of metrics. A metric has one value or, if it has label
+    names, one value for every combination of label values. """
+    typ = None
+
+    def __init__(self, name, description, labelnames=(), func=None):
+        """ Args:
+            name: Name of the metric, e.g. shitcoin_blocks_total
+            description: Help text
+            labelnames: Names of the labels
+            func: Function returning the value, when the metric is scraped.
+                With labels, it returns a dict of tuple of label values ->
+                value.
+        """
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.func = func
+        self.values = {}  # tuple of label values -> value
+        if not self.labelnames:
+            self.values[()] = 0
+        self.lock = Lock()
+
+    def get_samples(self):
+        """ Returns: list of tuples (suffix, dict of labels, value) """
+        if self.func is not None:
+            values = self.func()
+            if not self.labelnames:
+                values = {(): values}
+        else:
+            with self.lock:
+                values = dict(self.values)
+        return [('', dict(zip(self.labelnames, key)), value)
+                for key, value in values.items()]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s %s' % (self.name, self.typ)]
+        for suffix, labels, value in self.get_samples():
+            if labels:
+                labels = '{%s}' % ','.join(
+                    '%s="%s"' % (k, str(v).replace('\\', r'\\')
+                                 .replace('"', r'\"').replace('\n', r'\n'))
+                    for k, v in labels.items())
+            else:
+                labels = ''
+            lines.append('%s%s%s %s' % (self.name, suffix, labels,
+                                        _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    """ A value, which only goes up """
+    typ = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        with self.lock:
+            value = self.values.get(labelvalues, 0)
+            self.values[labelvalues] = value + amount
+
+
+class Gauge(Metric):
+    """ A value, which goes up and down """
+    typ = 'gauge'
+
+    def set(self, value, *labelvalues):
+        with self.lock:
+            self.values[labelvalues] = value
+
+
+class Histogram(Metric):
+    """ Counts observed values in buckets, e.g. durations """
+    typ = 'histogram'
+
+    def __init__(self, name, description, labelnames=(),
+                 buckets=TIME_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.values = {}
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, *labelvalues):
+        with self.lock:
+            state = self.values.get(labelvalues)
+            if state is None:
+                # counts per bucket, sum, count
+                state = [[0] * len(self.buckets), 0., 0]
+                self.values[labelvalues] = state
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def get_samples(self):
+        with self.lock:
+            values = {key: (counts[:], total, count)
+                      for key, (counts, total, count) in self.values.items()}
+        samples = []
+        for key, (counts, total, count) in values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                samples.append(('_bucket',
+                                dict(labels, le=_format_value(bound)),
+                                cumulative))
+            samples.append(('_sum', labels, total))
+            samples.append(('_count', labels, count))
+        return samples
+
+
+class Registry:
+    """ A set of metrics rendered together """
+    def __init__(self):
+        self.metrics = {}  # name -> Metric
+        self.lock = Lock()
+
+    def register(self, metric):
+        """ Add a metric. A metric of the same name is replaced, so objects
+        created again, e.g. a new node, can register their functions again.
+
+        Returns:
+            The metric
+        """
+        with self.lock:
+            self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        """ Returns: str in the Prometheus text format """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        parts = []
+        for metric in metrics:
+            try:
+                parts.append(metric.render())
+            except Exception:
+                log.exception('Failed to collect metric %s' % metric.name)
+        return ''.join(parts)
+
+
+REGISTRY = Registry()
+
+
+def counter(name, description, labelnames=(), func=None):
+    return REGISTRY.register(Counter(name, description, labelnames, func))
+
+
+def gauge(name, description, labelnames=(), func=None):
+    return REGISTRY.register(Gauge(name, description, labelnames, func))
+
+
+def histogram(name, description, labelnames=(), buckets=TIME_BUCKETS):
+    return REGISTRY.register(Histogram(name, description, labelnames,
+                                       buckets))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def register_node(blockchain, miner, p2p):
+    """ Add the metrics, which are read from the parts of a node, when they
+    are scraped. """
+    mempool = miner.mempool
+
+    def get_utxo_count():
+        with blockchain.lock:
+            return sum(len(outputs) for outputs in blockchain.utxos.values())
+
+    def get_queue_depths():
+        return {(name,): value
+                for name, value in p2p.get_queue_stats().items()
+                if not name.startswith('dropped_')}
+
+    def get_dropped():
+        return {(name[len('dropped_'):],): value
+                for name, value in p2p.get_queue_stats().items()
+                if name.startswith('dropped_')}
+
+    def get_worker_hashrates():
+        if miner.mining_thread is None:
+            return {}
+        return {(str(i),): rate
+                for i, rate in enumerate(miner.get_worker_hashrates())}
+
+    gauge('shitcoin_chain_height', 'Height of the longest chain',
+          func=lambda: blockchain.get_head().get_height())
+    gauge('shitcoin_orphan_blocks', 'Blocks waiting for their parent',
+          func=lambda: len(blockchain.unvalidated_blocks))
+    gauge('shitcoin_utxos', 'Unspent outputs of the longest chain',
+          func=get_utxo_count)
+    gauge('shitcoin_mempool_transactions', 'Transactions in the mempool',
+          func=lambda: len(mempool.entries))
+    gauge('shitcoin_mempool_bytes',
+          'Serialized size of the transactions in the mempool',
+          func=lambda: mempool.total_size)
+    gauge('shitcoin_mempool_fees', 'Fees of the transactions in the mempool',
+          func=lambda: mempool.total_fees)
+    gauge('shitcoin_peers', 'Connected peers',
+          func=lambda: len(p2p.get_peers()))
+    gauge('shitcoin_p2p_queue', 'Depth of the network queues and buffers',
+          ('queue',), get_queue_depths)
+    counter('shitcoin_p2p_dropped_total',
+            'Items dropped, because a network queue was full', ('queue',),
+            get_dropped)
+    gauge('shitcoin_miner_hashrate', 'Hashes per second of each worker',
+          ('worker',), get_worker_hashrates)
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+class MetricsServer:
+    """ Serves the metrics of a registry over HTTP in a background thread """
+    def __init__(self, host, port, registry=REGISTRY):
+        self.httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.registry = registry
+        self.port = self.httpd.server_address[1]
+        log.info('Metrics are served on port %i' % self.port)
+        Thread(target=self.httpd.serve_forever, name='metrics',
+               daemon=True).start()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -2,15 +2,19 @@ from binascii import hexlify
 from functools import partial
 import logging
 from os import urandom
-import struct
 from threading import Thread, Event, Lock
 import time
 
-from . import crypto
 from .block import Block
 from .crypto import HASH_LEN
 from .mempool import Mempool
-from .settings import INITIAL_REWARD, REWARD_HALVING_LEN
+from .mining import MiningBackend, create_backend
+from .settings import (
+    INITIAL_REWARD,
+    MINER_BACKEND,
+    MINER_PROCESSES,
+    REWARD_HALVING_LEN
+)
 from .transaction import Transaction, Output, Input
 from .validation import get_next_diff
 
@@ -26,7 +30,8 @@ class MinerIsNotRunningException(Exception):
 
 
 class Miner:
-    def __init__(self, blockchain, pubkey, reduce_local_diff=False):
+    def __init__(self, blockchain, pubkey, reduce_local_diff=False,
+                 backend=None):
         """ Creates a miner instance.
 
         Args:
@@ -38,6 +43,8 @@ class Miner:
                 leading zeros. Used for testing or to give a miner an advantage
                 over others. Note that the blocks are technically invalid, so
                 the validation must be explicitly told to accept them.
+            backend: MiningBackend or the name of one doing the hashing.
+                Defaults to MINER_BACKEND.
         """
         self.blockchain = blockchain
         self.mempool = Mempool(blockchain)
@@ -45,6 +52,12 @@ class Miner:
         self.reduce_local_diff = reduce_local_diff
         self.mining_thread = None
 
+        if backend is None:
+            backend = MINER_BACKEND
+        if not isinstance(backend, MiningBackend):
+            backend = create_backend(backend, MINER_PROCESSES)
+        self.backend = backend
+
         # Callback function
         self.retarget_callback = partial(Miner.retarget, self)
 
@@ -59,7 +72,10 @@ class Miner:
         self.retarget_event = Event()
 
     def add_transaction(self, tx):
-        self.mempool.add_transaction(tx)
+        return self.mempool.add_transaction(tx)
+
+    def add_transactions(self, txs):
+        return self.mempool.add_transactions(txs)
 
     def set_reward_address(self, pubkey):
         self.pubkey = pubkey
@@ -76,6 +92,9 @@ class Miner:
         self.stop_event.clear()
         self.retarget_event.clear()
 
+        # Start worker processes
+        self.backend.start()
+
         # Prepare new block
         self.retarget()
 
@@ -98,6 +117,7 @@ class Miner:
             log.error('Error stopping mining: Mining thread seems to be still '
                       'running after 10 seconds, giving up...')
 
+        self.backend.stop()
         self.mining_thread = None
 
     def get_hashrate(self):
@@ -107,6 +127,13 @@ class Miner:
         with self.lock:
             return self.hashrate
 
+    def get_worker_hashrates(self):
+        """ Get the hashrate of each worker process """
+        if self.mining_thread is None:
+            raise MinerIsNotRunningException('Miner is not running!')
+
+        return self.backend.get_hashrates()
+
     def mine(self):
         log.info("Miner thread starting...")
         nonce = int.from_bytes(urandom(4), byteorder='big')
@@ -133,31 +160,32 @@ class Miner:
                       % (target_hash, target_block.get_height()))
 
             while not self.retarget_event.is_set():
-                # Set up counters for hashrate
-                start_time = time.time()
-                start_nonce = nonce
-
-                for _ in range(100000):  # do 100k hashes
-                    h = crypto.h(prefix + struct.pack('>Q', nonce))
-                    if int.from_bytes(h, byteorder='big') < target_hash:
-                        log.info("Found a block: %s!" % hexlify(h))
-                        target_block.nonce = nonce
-                        with self.lock:
-                            self.mined_block = target_block
-                            self.target_block = None
-                            self.retarget_event.set()
-                        target_block = None
-                        break
-                    nonce += 1
+                count = self.backend.chunk_size
+                found = self.backend.search(prefix, target_hash, nonce, count,
+                                            self.is_cancelled)
+                nonce += count
+                hashrate = sum(self.backend.get_hashrates())
+
+                if found is not None:
+                    target_block.nonce = found
+                    log.info("Found a block: %s!"
+                             % hexlify(target_block.get_hash()))
+                    with self.lock:
+                        self.mined_block = target_block
+                        self.target_block = None
+                        self.retarget_event.set()
 
                 # Calculate hashrate
-                hashrate = (nonce - start_nonce) / (time.time() - start_time)
                 with self.lock:
                     self.hashrate = hashrate
 
                 if self.stop_event.is_set():
                     return
 
+    def is_cancelled(self):
+        """ Whether the current search should be given up """
+        return self.retarget_event.is_set() or self.stop_event.is_set()
+
     def get_mined_block(self):
         with self.lock:
             blk = self.mined_block
@@ -169,18 +197,19 @@ class Miner:
         # where the head changes during execution of this function
         blockchain_head = self.blockchain.get_head()
 
-        # Build a block from all known transactions
+        # Build a block from the best paying known transactions
+        txs, fees = self.mempool.get_block_template()
         blk = Block()
         blk.set_parent(blockchain_head)
         blk.prev_hash = blockchain_head.get_hash()
         blk.timestamp = int(time.time())
         blk.diff = get_next_diff(blockchain_head)
-        blk.add_transactions(self.mempool.transactions.values())
+        blk.add_transactions(txs)
 
         # Add coinbase
         reward = INITIAL_REWARD // (2 ** (
             blk.get_height() // REWARD_HALVING_LEN))
-        reward += self.mempool.total_fees
+        reward += fees
         coinbase_out = Output(reward, self.pubkey)
         coinbase_out.block = blk
         coinbase_inp = Input()  # dummy input to make the txid unique
@@ -0,0 +1,327 @@
+""" Mining backends searching for a Proof-of-Work.
+
+Every backend implements the MiningBackend interface, so the miner can use
+any of them and bench_mining.py can compare them on a host. """
+import hashlib
+import logging
+import multiprocessing
+from queue import Empty
+import struct
+from threading import Lock
+import time
+
+from . import crypto
+from .crypto import HASH_LEN
+from .workers import get_worker_context
+
+log = logging.getLogger(__name__)
+
+# Workers check for cancellation every x hashes
+CHECK_INTERVAL = 1024
+# Workers publish their hashrate and CPU time every x seconds
+HASHRATE_INTERVAL = 0.5
+# The pool polls for cancellation every x seconds while waiting for workers
+POLL_INTERVAL = 0.002
+
+NONCE = struct.Struct('>Q')
+
+
+def search_range(prefix, target, nonce_start, count, is_cancelled=None):
+    """ Search for a nonce, which gives a header hash below the target.
+
+    Args:
+        prefix(bytes): Block header without the nonce
+        target(int): The header hash has to be smaller than this
+        nonce_start: First nonce to try
+        count: Number of nonces to try
+        is_cancelled(function): Polled every CHECK_INTERVAL hashes, the search
+            stops when it returns True
+
+    Returns:
+        Tuple (found nonce or None, number of hashes done)
+    """
+    h = crypto.h
+    pack = struct.pack
+    nonce = nonce_start
+    end = nonce_start + count
+    while nonce < end:
+        stop = min(nonce + CHECK_INTERVAL, end)
+        for n in range(nonce, stop):
+            if int.from_bytes(h(prefix + pack('>Q', n)),
+                              byteorder='big') < target:
+                return n, n - nonce_start + 1
+        nonce = stop
+        if is_cancelled is not None and is_cancelled():
+            break
+    return None, nonce - nonce_start
+
+
+def search_midstate(prefix, target, nonce_start, count, is_cancelled=None):
+    """ Same as search_range, but faster. The prefix is hashed only once and
+    the SHA-256 state after it is cloned for every nonce. The nonce is packed
+    into a reused buffer and the digest is compared as bytes against the
+    target, so no new header, hash objects or integers are made per nonce. """
+    midstate = hashlib.sha256(prefix)
+    target_bytes = target.to_bytes(HASH_LEN, byteorder='big')
+    nonce_buf = bytearray(NONCE.size)
+
+    copy = midstate.copy
+    sha256 = hashlib.sha256
+    pack_into = NONCE.pack_into
+    nonce = nonce_start
+    end = nonce_start + count
+    while nonce < end:
+        stop = min(nonce + CHECK_INTERVAL, end)
+        for n in range(nonce, stop):
+            pack_into(nonce_buf, 0, n)
+            m = copy()
+            m.update(nonce_buf)
+            if sha256(m.digest()).digest() < target_bytes:
+                return n, n - nonce_start + 1
+        nonce = stop
+        if is_cancelled is not None and is_cancelled():
+            break
+    return None, nonce - nonce_start
+
+
+def _worker_main(index, kernel, jobs, results, generation, hashrates,
+                 hash_counts, cpu_times):
+    """ Main function of a worker process. Takes jobs until it gets None and
+    answers each one with exactly one (job id, nonce or None) result. A job is
+    cancelled as soon as the shared generation counter moves on. """
+    def is_cancelled():
+        return generation.value != job_id
+
+    search = KERNELS[kernel]
+    rate_time = time.time()
+    rate_hashes = 0
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        job_id, prefix, target, nonce, count = job
+
+        found = None
+        end = nonce + count
+        while nonce < end and not is_cancelled():
+            found, hashes = search(prefix, target, nonce,
+                                   min(CHECK_INTERVAL * 16, end - nonce),
+                                   is_cancelled)
+            nonce += hashes
+            rate_hashes += hashes
+            hash_counts[index] += hashes
+            if found is not None:
+                break
+
+            now = time.time()
+            if now - rate_time >= HASHRATE_INTERVAL:
+                hashrates[index] = rate_hashes / (now - rate_time)
+                cpu_times[index] = time.process_time()
+                rate_time = now
+                rate_hashes = 0
+
+        cpu_times[index] = time.process_time()
+        results.put((job_id, found))
+
+
+class MiningBackend:
+    """ Interface of a mining backend. A search is run by the mining thread,
+    which can abort it through the is_cancelled function. """
+    name = None
+
+    # Number of nonces the miner hands to one search call
+    chunk_size = 100000
+
+    def start(self):
+        """ Acquire resources like worker processes """
+        pass
+
+    def stop(self):
+        """ Release all resources """
+        pass
+
+    def search(self, prefix, target, nonce_start, count, is_cancelled=None):
+        """ Search for a nonce, which gives a header hash below the target.
+
+        Args:
+            prefix(bytes): Block header without the nonce
+            target(int): The header hash has to be smaller than this
+            nonce_start: First nonce to try
+            count: Number of nonces to try
+            is_cancelled(function): Polled regularly, the search stops soon
+                after it returns True
+
+        Returns:
+            The found nonce or None
+        """
+        raise NotImplementedError()
+
+    def get_hashrates(self):
+        """ Get the current hashrate of each worker """
+        raise NotImplementedError()
+
+    def get_hash_count(self):
+        """ Get the number of hashes done since the backend was created """
+        raise NotImplementedError()
+
+    def get_cpu_time(self):
+        """ Get the CPU time used outside of the calling thread """
+        return 0.
+
+
+class KernelBackend(MiningBackend):
+    """ Runs a search kernel in the calling thread """
+    kernel = None
+
+    def __init__(self):
+        self.hashrate = 0.
+        self.hash_count = 0
+
+    def search(self, prefix, target, nonce_start, count, is_cancelled=None):
+        start_time = time.time()
+        found, hashes = KERNELS[self.kernel](prefix, target, nonce_start,
+                                             count, is_cancelled)
+        self.hash_count += hashes
+        self.hashrate = hashes / max(time.time() - start_time, 1e-9)
+        return found
+
+    def get_hashrates(self):
+        return [self.hashrate]
+
+    def get_hash_count(self):
+        return self.hash_count
+
+
+class PythonBackend(KernelBackend):
+    """ The plain loop, hashing the whole header for every nonce """
+    name = 'python'
+    kernel = 'python'
+
+
+class MidstateBackend(KernelBackend):
+    """ Clones the SHA-256 state after the header prefix for every nonce """
+    name = 'midstate'
+    kernel = 'midstate'
+
+
+class MultiprocessBackend(MiningBackend):
+    """ A pool of worker processes, which search disjoint parts of a nonce
+    range in parallel. This gets around the GIL and keeps the hashing out of
+    the interpreter doing validation and networking. """
+    name = 'multiprocess'
+
+    def __init__(self, processes=None, kernel='midstate'):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.kernel = kernel
+        self.chunk_size = self.processes * 1000000
+
+        self.ctx = get_worker_context()
+        self.generation = self.ctx.RawValue('Q', 0)
+        self.hashrates = self.ctx.RawArray('d', self.processes)
+        self.hash_counts = self.ctx.RawArray('Q', self.processes)
+        self.cpu_times = self.ctx.RawArray('d', self.processes)
+        self.results = self.ctx.Queue()
+        self.job_queues = []
+        self.workers = []
+
+        # Protects the generation counter
+        self.lock = Lock()
+
+    def start(self):
+        log.info('Starting %i mining processes...' % self.processes)
+        for i in range(self.processes):
+            jobs = self.ctx.Queue()
+            worker = self.ctx.Process(
+                target=_worker_main, name='miner-%i' % i, daemon=True,
+                args=(i, self.kernel, jobs, self.results, self.generation,
+                      self.hashrates, self.hash_counts, self.cpu_times))
+            worker.start()
+            self.job_queues.append(jobs)
+            self.workers.append(worker)
+
+    def stop(self):
+        log.info('Stopping mining processes...')
+        self.cancel()
+        for jobs in self.job_queues:
+            jobs.put(None)
+        for worker in self.workers:
+            worker.join(10)
+            if worker.is_alive():
+                worker.terminate()
+        self.job_queues = []
+        self.workers = []
+
+    def cancel(self):
+        """ Abort the running search. Workers notice within CHECK_INTERVAL
+        hashes. This can be called from any thread. """
+        with self.lock:
+            self.generation.value += 1
+
+    def search(self, prefix, target, nonce_start, count, is_cancelled=None):
+        """ Split the nonce range over all workers and wait until one of them
+        finds a block, all are done or the search is cancelled. While waiting,
+        is_cancelled is polled every POLL_INTERVAL seconds. """
+        with self.lock:
+            self.generation.value += 1
+            job_id = self.generation.value
+
+        span = -(-count // self.processes)
+        for i, jobs in enumerate(self.job_queues):
+            start = nonce_start + i * span
+            jobs.put((job_id, prefix, target, start,
+                      max(0, min(span, nonce_start + count - start))))
+
+        pending = len(self.job_queues)
+        while pending:
+            try:
+                result_id, nonce = self.results.get(timeout=POLL_INTERVAL)
+            except Empty:
+                if is_cancelled is not None and is_cancelled():
+                    self.cancel()
+                if not all(w.is_alive() for w in self.workers):
+                    raise Exception('A mining process died!')
+                continue
+
+            # Ignore late answers to earlier jobs
+            if result_id != job_id:
+                continue
+            pending -= 1
+            if nonce is not None:
+                # Stop the others
+                self.cancel()
+                return nonce
+        return None
+
+    def get_hashrates(self):
+        """ Get the last hashrate reported by each worker """
+        return list(self.hashrates)
+
+    def get_hash_count(self):
+        return sum(self.hash_counts)
+
+    def get_cpu_time(self):
+        return sum(self.cpu_times)
+
+
+KERNELS = {
+    'python': search_range,
+    'midstate': search_midstate,
+}
+
+BACKENDS = {
+    backend.name: backend
+    for backend in (PythonBackend, MidstateBackend, MultiprocessBackend)
+}
+
+
+def create_backend(name, processes=None):
+    """ Create a mining backend by name.
+
+    Args:
+        name: One of the keys of BACKENDS
+        processes: Number of worker processes for the multiprocess backend,
+            all cores if None
+    """
+    if name == MultiprocessBackend.name:
+        return MultiprocessBackend(processes)
+    return BACKENDS[name]()
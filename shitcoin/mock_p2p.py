@@ -1,35 +1,268 @@
-""" Shitty P2P with a maximum of 2 nodes. """
+""" Shitty P2P. Every node relays blocks and transactions to all of its peers.
+New blocks are sent as compact blocks, which the peers rebuild from their
+mempools. Peers exchange their features with VER when connecting.
+"""
 from binascii import hexlify
+from collections import OrderedDict, deque
+import errno
+from itertools import islice
 import logging
-import select
+import selectors
 import socket
 import struct
 from threading import Thread, Lock, Event
-from time import sleep
+import time
+import zlib
 
-from shitcoin.block import Block
+from shitcoin import metrics
+from shitcoin.block import HEADER_LEN, Block
+from shitcoin.capture import Recorder
+from shitcoin.compact import CompactBlock
+from shitcoin.crypto import HASH_LEN
 from shitcoin.serialize import SerializationBuffer
+from shitcoin.settings import (
+    P2P_CAPTURE_PATH,
+    P2P_COMPRESSION,
+    P2P_COMPRESS_LEVEL,
+    P2P_COMPRESS_THRESHOLD,
+    P2P_GETDATA_TIMEOUT,
+    P2P_KNOWN_INVENTORY,
+    P2P_MAX_BLOCK_QUEUE,
+    P2P_MAX_FRAME_SIZE,
+    P2P_MAX_HEADERS,
+    P2P_MAX_INBOUND,
+    P2P_MAX_SEND_BUFFER,
+    P2P_MAX_TX_QUEUE,
+    P2P_PARTIAL_BLOCKS,
+    P2P_RECONNECT_INTERVAL,
+    P2P_RELAY_CACHE,
+    P2P_SYNC_IN_FLIGHT,
+    P2P_SYNC_WINDOW
+)
 from shitcoin.transaction import Transaction
 
 log = logging.getLogger(__name__)
 
+# Inventory types
+INV_BLOCK = 1
+INV_TX = 2
+
+PROTOCOL_VERSION = 1
+
+# Feature flags sent with VER
+FEATURE_COMPRESSION = 1
+
+# Maximum number of buffers passed to one sendmsg call
+SEND_BATCH = 512
+
+# Packages, which make us send data to the peer. They are held back, while
+# the peer does not read what we sent already.
+REQUEST_TYPES = (b'GDT', b'GHD', b'GTX', b'REQ')
+
+BYTES_SENT = metrics.counter('shitcoin_p2p_sent_bytes_total',
+                             'Bytes sent to peers')
+BYTES_RECEIVED = metrics.counter('shitcoin_p2p_received_bytes_total',
+                                 'Bytes received from peers')
+
+
+def write_inventory(buf, typ, items):
+    """ Write an INV or GDT package.
+
+    Args:
+        typ(bytes): b'INV' or b'GDT'
+        items: list of (inventory type, hash)
+    """
+    buf.write(typ)
+    buf.write_varuint(len(items))
+    for inv_type, h in items:
+        buf.write_u8(inv_type)
+        buf.write(h)
+    return buf
+
+
+def read_count(buf, item_len, maximum):
+    """ Read the number of items of a list sent by a peer and check, that
+    the package can hold that many.
+
+    Args:
+        item_len: Minimum serialized size of an item
+        maximum: Largest accepted number of items
+
+    Raises:
+        ValueError: If there are too many items or the package is too short
+    """
+    count = buf.read_varuint()
+    if count > maximum or count * item_len > len(buf.get_bytes()):
+        raise ValueError('Bad item count %i' % count)
+    return count
+
+
+def read_inventory(buf):
+    """ Read the items of an INV or GDT package after the type """
+    items = []
+    for _ in range(read_count(buf, 1 + HASH_LEN, P2P_KNOWN_INVENTORY)):
+        inv_type = buf.read_u8()
+        items.append((inv_type, buf.read(HASH_LEN)))
+    return items
+
+
+def write_hashes(buf, typ, hashes):
+    """ Write a package with a list of hashes, like GHD """
+    buf.write(typ)
+    buf.write_varuint(len(hashes))
+    for h in hashes:
+        buf.write(h)
+    return buf
+
+
+def read_hashes(buf, maximum):
+    """ Read the list of hashes of a package after the type """
+    return [buf.read(HASH_LEN)
+            for _ in range(read_count(buf, HASH_LEN, maximum))]
+
+
+class KnownSet:
+    """ Set of hashes, which forgets the oldest ones above a maximum size """
+    def __init__(self, max_size=P2P_KNOWN_INVENTORY):
+        self.max_size = max_size
+        self.hashes = OrderedDict()
+
+    def __contains__(self, h):
+        return h in self.hashes
+
+    def add(self, h, value=None):
+        self.hashes[h] = value
+        self.hashes.move_to_end(h)
+        if len(self.hashes) > self.max_size:
+            self.hashes.popitem(last=False)
+
+    def get(self, h, default=None):
+        return self.hashes.get(h, default)
+
+    def discard(self, h):
+        self.hashes.pop(h, None)
+
+
+class Peer:
+    """ Connection to another node. Only used by the network thread. """
+    def __init__(self, sock, addr, inbound):
+        self.sock = sock
+        self.addr = addr
+        self.inbound = inbound
+        self.connecting = False
+        self.recv_buf = bytearray()
+        self.send_queue = deque()  # buffers left to write
+        self.send_size = 0  # bytes in send_queue
+        self.held = deque()  # requests waiting for send_queue to shrink
+        self.held_size = 0  # bytes in held
+        self.closed = False
+        self.features = 0  # flags the peer announced in VER
+        self.events = 0  # selector events the socket is registered for
+
+        # Hashes of blocks and transactions the peer has, because it sent them
+        # to us or we sent them to it
+        self.known = KnownSet()
+
+        # Chain sync: Hashes of announced headers, which are still to be
+        # requested, and the requested windows as [request time, hash set]
+        self.getting_headers = False
+        self.sync_queue = deque()
+        self.sync_windows = []
+
+    def __repr__(self):
+        return '%s:%i' % self.addr[:2]
+
+    def send_pkg(self, data):
+        """ Queue a package. It is written, when the socket is writable. """
+        self.send_queue.append(struct.pack(">I", len(data)))
+        self.send_queue.append(data)
+        self.send_size += len(data) + 4
+
+    def pop_sent(self, sent):
+        """ Remove the first bytes of the send queue, which were written """
+        self.send_size -= sent
+        while sent:
+            data = self.send_queue[0]
+            if len(data) <= sent:
+                sent -= len(data)
+                self.send_queue.popleft()
+            else:
+                self.send_queue[0] = memoryview(data)[sent:]
+                sent = 0
+
 
 class P2P:
     def __init__(self, blockchain, miner, host='0.0.0.0', port=0,
-                 listen=False):
+                 listen=False, peers=(), max_inbound=P2P_MAX_INBOUND,
+                 capture_path=P2P_CAPTURE_PATH):
+        """ Starts the network thread.
+
+        Args:
+            host, port: Address to listen on, or the peer to connect to if
+                listen is False. No peer is dialed, if host is None.
+            listen: Accept connections from other nodes
+            peers: List of further (host, port) tuples to connect to. Lost
+                outbound connections are dialed again.
+            max_inbound: Maximum number of accepted connections
+            capture_path: File to record received packages to, for
+                replay.py
+        """
         self.blockchain = blockchain
         self.miner = miner
         self.listen = listen
         self.host = host
         self.port = port
+        self.max_inbound = max_inbound
 
-        # Communication to network thread
+        # Communication to network thread. The queues are bounded, see
+        # get_queue_stats for what happens when they are full.
         self.lock = Lock()
         self.stop_event = Event()
-        self.blocks_to_send = []
-        self.blocks_received = []
-        self.txs_to_send = []
-        self.txs_received = []
+        self.blocks_to_send = deque()
+        self.blocks_received = deque()
+        self.txs_to_send = deque()
+        self.txs_received = deque()
+        self.new_connections = []
+        self.dropped = {
+            'blocks_to_send': 0,
+            'txs_to_send': 0,
+            'txs_received': 0,
+            'tx_announcements': 0,
+        }
+
+        # Network thread state
+        self.selector = selectors.DefaultSelector()
+        self.srv = None
+        self.peers = []
+        self.outbound = list(peers)
+        if not listen and host is not None:
+            self.outbound.insert(0, (host, port))
+        self.last_dial = 0
+        self.receiving = True  # False while blocks_received is full
+
+        # Hashes of everything received from anyone, to pass each block and
+        # transaction to the node only once
+        self.seen = KnownSet()
+
+        # Packages of recently broadcasted items by hash, to answer GDT
+        self.relay_cache = KnownSet(P2P_RELAY_CACHE)
+        # Hash -> time of requested items, which did not arrive yet
+        self.requested = {}
+        # Hashes of blocks queued for download from some peer during sync
+        self.syncing = set()
+        # Compact blocks waiting for transactions: hash -> (CompactBlock,
+        # requested indexes)
+        self.partial_blocks = KnownSet(P2P_PARTIAL_BLOCKS)
+
+        # Writing to the wakeup socket interrupts the network thread waiting
+        # in select, so new packages are sent immediately
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_r.setblocking(False)
+        self.wakeup_w.setblocking(False)
+
+        self.recorder = None
+        if capture_path is not None:
+            self.recorder = Recorder(capture_path)
 
         self.net_thread = Thread(target=P2P.net_main, name='net',
                                  args=(self,), daemon=True)
@@ -39,17 +272,88 @@ class P2P:
         """ Disconnect and stop the network thread """
         log.info('Stopping p2p thread...')
         self.stop_event.set()
+        self.wakeup()
         self.net_thread.join(10)
         if self.net_thread.is_alive():
             raise Exception("Could not stop network thread!")
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def wakeup(self):
+        try:
+            self.wakeup_w.send(b'\0')
+        except BlockingIOError:
+            # Enough wakeups pending already
+            pass
 
     def broadcast_block(self, block):
+        """ Announce a block to every peer, which does not know it yet. If
+        P2P_MAX_BLOCK_QUEUE blocks are waiting already, the oldest one is
+        dropped. """
         with self.lock:
+            if len(self.blocks_to_send) >= P2P_MAX_BLOCK_QUEUE:
+                self.blocks_to_send.popleft()
+                self.dropped['blocks_to_send'] += 1
             self.blocks_to_send.append(block)
+        self.wakeup()
 
     def broadcast_transaction(self, tx):
+        """ Announce a transaction to every peer, which does not know it yet.
+        If P2P_MAX_TX_QUEUE transactions are waiting already, it is dropped.
+
+        Returns:
+            False if the transaction was dropped
+        """
         with self.lock:
+            if len(self.txs_to_send) >= P2P_MAX_TX_QUEUE:
+                self.dropped['txs_to_send'] += 1
+                return False
             self.txs_to_send.append(tx)
+        self.wakeup()
+        return True
+
+    def add_connection(self, sock, addr, inbound):
+        """ Use an already connected socket as a peer, e.g. one end of a
+        socketpair. Can be called from any thread.
+
+        Args:
+            addr: (host, port) tuple naming the peer
+        """
+        with self.lock:
+            self.new_connections.append((sock, addr, inbound))
+        self.wakeup()
+
+    def get_queue_stats(self):
+        """ Get the depths of the queues and how many items were dropped.
+
+        Full send queues drop the oldest block or the newest transaction. Tx
+        announcements are dropped for peers, which do not read what we send.
+        Received transactions are dropped when the node does not fetch them
+        fast enough, while a full block queue makes us stop reading from all
+        peers until the node catches up.
+
+        Returns:
+            dict of counters
+        """
+        with self.lock:
+            stats = {
+                'blocks_to_send': len(self.blocks_to_send),
+                'blocks_received': len(self.blocks_received),
+                'txs_to_send': len(self.txs_to_send),
+                'txs_received': len(self.txs_received),
+            }
+            for name, count in self.dropped.items():
+                stats['dropped_' + name] = count
+        peers = self.peers[:]
+        stats['recv_buffer_bytes'] = sum(len(p.recv_buf) for p in peers)
+        stats['send_buffer_bytes'] = sum(p.send_size for p in peers)
+        stats['held_request_bytes'] = sum(p.held_size for p in peers)
+        return stats
+
+    def get_peers(self):
+        """ Get a list of (host, port, inbound) of all connected peers """
+        return [(p.addr[0], p.addr[1], p.inbound) for p in self.peers
+                if not p.connecting]
 
     def net_main(self):
         if self.listen:
@@ -57,70 +361,634 @@ class P2P:
             self.srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             self.srv.bind((self.host, self.port))
             self.port = self.srv.getsockname()[1]
-            self.srv.listen(1)
-            self.sock, peer_addr = self.srv.accept()
-            log.info('Peer connected from %s:%i' % peer_addr)
+            self.srv.listen(self.max_inbound)
+            self.srv.setblocking(False)
+            self.selector.register(self.srv, selectors.EVENT_READ)
+        self.selector.register(self.wakeup_r, selectors.EVENT_READ)
+
+        try:
+            while not self.stop_event.is_set():
+                self.dial()
+                self.add_new_connections()
+                self.send_queued()
+                self.update_receiving()
+
+                # Wake up regularly to redial lost peers
+                timeout = None
+                if self.count_outbound() < len(self.outbound):
+                    timeout = P2P_RECONNECT_INTERVAL
+
+                for key, mask in self.selector.select(timeout):
+                    if key.fileobj is self.wakeup_r:
+                        self.wakeup_r.recv(4096)
+                    elif key.fileobj is self.srv:
+                        self.accept()
+                    else:
+                        peer = key.data
+                        if mask & selectors.EVENT_WRITE:
+                            self.write_peer(peer)
+                        if mask & selectors.EVENT_READ and not peer.closed:
+                            self.read_peer(peer)
+        finally:
+            for peer in self.peers[:]:
+                self.disconnect(peer)
+            if self.srv is not None:
+                self.selector.unregister(self.srv)
+                self.srv.close()
+            self.selector.close()
+
+    def count_inbound(self):
+        return sum(1 for p in self.peers if p.inbound)
+
+    def count_outbound(self):
+        return sum(1 for p in self.peers if not p.inbound)
+
+    def dial(self):
+        """ Connect to configured peers, which are not connected """
+        if self.count_outbound() == len(self.outbound):
+            return
+        now = time.time()
+        if now - self.last_dial < P2P_RECONNECT_INTERVAL:
+            return
+        self.last_dial = now
+
+        connected = {p.addr for p in self.peers if not p.inbound}
+        for addr in self.outbound:
+            if addr in connected:
+                continue
+            sock = socket.socket()
+            sock.setblocking(False)
+            err = sock.connect_ex(addr)
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                log.info('Could not connect to %s:%i: %s'
+                         % (addr[0], addr[1], errno.errorcode.get(err)))
+                sock.close()
+                continue
+            peer = self.add_peer(sock, addr, False)
+            if err != 0:
+                # Wait until the socket is writable to finish the connect
+                peer.connecting = True
+                self.update_events(peer)
+            else:
+                self.peer_connected(peer)
+
+    def add_new_connections(self):
+        with self.lock:
+            new_connections = self.new_connections
+            self.new_connections = []
+        for sock, addr, inbound in new_connections:
+            self.peer_connected(self.add_peer(sock, addr, inbound))
+
+    def accept(self):
+        try:
+            sock, peer_addr = self.srv.accept()
+        except BlockingIOError:
+            return
+
+        if self.count_inbound() >= self.max_inbound:
+            log.info('Refusing peer %s:%i, too many connections'
+                     % peer_addr[:2])
+            sock.close()
+            return
+
+        log.info('Peer connected from %s:%i' % peer_addr[:2])
+        peer = self.add_peer(sock, peer_addr, True)
+        self.peer_connected(peer)
+
+    def add_peer(self, sock, addr, inbound):
+        sock.setblocking(False)
+        peer = Peer(sock, addr, inbound)
+        self.peers.append(peer)
+        self.update_events(peer)
+        return peer
+
+    def peer_connected(self, peer):
+        """ Greet a new peer and start syncing from it """
+        features = 0
+        if P2P_COMPRESSION:
+            features |= FEATURE_COMPRESSION
+        buf = SerializationBuffer()
+        buf.write(b'VER')
+        buf.write_u32(PROTOCOL_VERSION)
+        buf.write_u64(features)
+        peer.send_pkg(buf.get_bytes())
+        self.send_getheaders(peer)
+        self.update_events(peer)
+
+    def update_events(self, peer):
+        """ Register a peer socket for the events we want to handle. We only
+        wait for writability, while there is something to write, and stop
+        reading while the node can not keep up. """
+        events = 0
+        if peer.connecting or peer.send_queue:
+            events |= selectors.EVENT_WRITE
+        if not peer.connecting and self.can_read(peer):
+            events |= selectors.EVENT_READ
+        if events == peer.events:
+            return
+
+        if peer.events == 0:
+            self.selector.register(peer.sock, events, peer)
+        elif events == 0:
+            self.selector.unregister(peer.sock)
         else:
-            self.sock = socket.socket()
-            self.sock.connect((self.host, self.port))
-        recv_buf = b''
+            self.selector.modify(peer.sock, events, peer)
+        peer.events = events
 
-        while True:
-            with self.lock:
-                blocks_to_send = self.blocks_to_send
-                self.blocks_to_send = []
+    def can_read(self, peer):
+        """ Whether to process more packages of a peer. Peers are read even
+        while they do not read what we send, else two nodes sending much to
+        each other could both stop reading. Only their requests are held
+        back then, see parse_frames. """
+        return self.receiving
+
+    def update_receiving(self):
+        """ Stop reading from all peers, while the node did not take the
+        received blocks, and continue with the buffered packages when it did.
+        """
+        with self.lock:
+            receiving = len(self.blocks_received) < P2P_MAX_BLOCK_QUEUE
+        self.set_receiving(receiving)
 
-            for blk in blocks_to_send:
-                buf = SerializationBuffer()
-                buf.write(b'BLK')
-                blk.serialize(buf)
+    def set_receiving(self, receiving):
+        if receiving == self.receiving:
+            return
+        self.receiving = receiving
+        if not receiving:
+            log.debug('Node is not keeping up, pausing receiving blocks.')
+        for peer in self.peers[:]:
+            if receiving:
+                self.parse_frames(peer)
+            if not peer.closed:
+                self.update_events(peer)
 
-                data = buf.get_bytes()
-                self.sock.send(struct.pack(">I", len(data)) + data)
+    def disconnect(self, peer):
+        log.info('Peer %s disconnected' % peer)
+        if peer.events:
+            self.selector.unregister(peer.sock)
+        peer.sock.close()
+        peer.closed = True
+        self.peers.remove(peer)
 
-            with self.lock:
-                txs_to_send = self.txs_to_send
-                self.txs_to_send = []
-
-            for tx in txs_to_send:
-                buf = SerializationBuffer()
-                buf.write(b'TXN')
-                tx.serialize(buf)
-                data = buf.get_bytes()
-                self.sock.send(struct.pack(">I", len(data)) + data)
-
-            r, _, _ = select.select([self.sock], [], [], 0)
-            if r:
-                recv_buf += self.sock.recv(100000)
-
-                while True:
-                    if len(recv_buf) < 4:
-                        break
-                    pkg_len = struct.unpack(">I", recv_buf[:4])[0]
-                    if len(recv_buf) < pkg_len + 4:
-                        break
-                    pkg = recv_buf[4:pkg_len+4]
-                    recv_buf = recv_buf[pkg_len+4:]
-                    self.parse_pkg(self.sock, pkg)
-
-            if self.stop_event.is_set():
+        # Let other peers deliver the blocks, we wanted from this one
+        self.syncing.difference_update(peer.sync_queue)
+        for _, window in peer.sync_windows:
+            self.syncing.difference_update(window)
+            for h in window:
+                self.requested.pop(h, None)
+
+    def send_queued(self):
+        """ Send the queued blocks as compact blocks and announce the queued
+        transactions to all peers, which do not know them yet. The peers fetch
+        what they need with GDT and GTX. """
+        with self.lock:
+            blocks_to_send = self.blocks_to_send
+            self.blocks_to_send = deque()
+            txs_to_send = self.txs_to_send
+            self.txs_to_send = deque()
+
+        for blk in blocks_to_send:
+            h = self.cache_item(INV_BLOCK, blk)
+            for peer in self.peers:
+                if h not in peer.known:
+                    peer.known.add(h)
+                    compact = CompactBlock.from_block(blk, peer.known)
+                    buf = SerializationBuffer()
+                    buf.write(b'CMP')
+                    peer.send_pkg(compact.serialize(buf).get_bytes())
+
+        announce = {peer: [] for peer in self.peers}
+        for tx in txs_to_send:
+            h = self.cache_item(INV_TX, tx)
+            for peer in self.peers:
+                if h not in peer.known:
+                    peer.known.add(h)
+                    announce[peer].append((INV_TX, h))
+
+        for peer, items in announce.items():
+            if not items:
+                continue
+            if peer.send_size > P2P_MAX_SEND_BUFFER:
+                # The peer does not read, do not make it worse
+                with self.lock:
+                    self.dropped['tx_announcements'] += len(items)
+                continue
+            peer.send_pkg(write_inventory(SerializationBuffer(), b'INV',
+                                          items).get_bytes())
+
+        # Try to get rid of it right away, saves a round through select
+        for peer in self.peers[:]:
+            if peer.send_queue and not peer.connecting:
+                self.write_peer(peer)
+
+    def cache_item(self, inv_type, item):
+        """ Serialize a block or transaction into the relay cache.
+
+        Returns:
+            The hash of the item
+        """
+        buf = SerializationBuffer()
+        if inv_type == INV_BLOCK:
+            h = item.get_hash()
+            buf.write(b'BLK')
+        else:
+            h = item.get_txid()
+            buf.write(b'TXN')
+        item.serialize(buf)
+        self.relay_cache.add(h, buf.get_bytes())
+        return h
+
+    def have_item(self, inv_type, h):
+        """ Check whether the node has or is fetching a block or transaction
+        """
+        if h in self.seen:
+            return True
+        requested = self.requested.get(h)
+        if requested is not None:
+            if time.time() - requested < P2P_GETDATA_TIMEOUT:
+                return True
+            self.requested.pop(h)
+        if inv_type == INV_BLOCK:
+            return (h in self.blockchain.blocks_by_hash
+                    or h in self.blockchain.unvalidated_blocks)
+        return h in self.miner.mempool.transactions
+
+    def expire_requests(self):
+        """ Forget requests, which were not answered in time """
+        now = time.time()
+        self.requested = {h: t for h, t in self.requested.items()
+                          if now - t < P2P_GETDATA_TIMEOUT}
+
+    def get_item(self, inv_type, h):
+        """ Get the serialized package for a requested item or None """
+        data = self.relay_cache.get(h)
+        if data is not None:
+            return data
+
+        item = None
+        if inv_type == INV_BLOCK:
+            item = self.blockchain.blocks_by_hash.get(h)
+        elif inv_type == INV_TX:
+            item = self.miner.mempool.transactions.get(h)
+        if item is None:
+            return None
+        self.cache_item(inv_type, item)
+        return self.relay_cache.get(h)
+
+    def compress_pkg(self, peer, data):
+        """ Compress a BLK package, if it is large and the peer supports it
+        """
+        if (not data.startswith(b'BLK')
+                or len(data) < P2P_COMPRESS_THRESHOLD
+                or not P2P_COMPRESSION
+                or not peer.features & FEATURE_COMPRESSION):
+            return data
+        compressed = zlib.compress(memoryview(data)[3:], P2P_COMPRESS_LEVEL)
+        if len(compressed) + 3 >= len(data):
+            return data
+        return b'BLZ' + compressed
+
+    def send_getheaders(self, peer, start=()):
+        """ Ask a peer for the headers of its longest chain, which follow the
+        fork point with our chain.
+
+        Args:
+            start: Hashes to put in front of our block locator, to continue
+                after headers we got already
+        """
+        if peer.getting_headers:
+            return
+        peer.getting_headers = True
+        locator = list(start) + self.blockchain.get_block_locator()
+        peer.send_pkg(write_hashes(SerializationBuffer(), b'GHD',
+                                   locator).get_bytes())
+
+    def request_blocks(self, peer):
+        """ Keep up to P2P_SYNC_IN_FLIGHT windows of blocks requested from a
+        peer, while there are headers to download """
+        now = time.time()
+        for window in peer.sync_windows[:]:
+            if now - window[0] > P2P_GETDATA_TIMEOUT:
+                # The peer does not answer, give up on the rest
+                peer.sync_windows.remove(window)
+                self.syncing.difference_update(window[1])
+
+        while (len(peer.sync_windows) < P2P_SYNC_IN_FLIGHT
+               and peer.sync_queue):
+            hashes = []
+            while len(hashes) < P2P_SYNC_WINDOW and peer.sync_queue:
+                h = peer.sync_queue.popleft()
+                self.requested[h] = now
+                hashes.append(h)
+            peer.sync_windows.append([now, set(hashes)])
+            peer.send_pkg(write_inventory(
+                SerializationBuffer(), b'GDT',
+                [(INV_BLOCK, h) for h in hashes]).get_bytes())
+
+    def block_arrived(self, peer, block_hash):
+        """ Account a block to the sync window, which requested it """
+        self.syncing.discard(block_hash)
+        for window in peer.sync_windows:
+            if block_hash in window[1]:
+                window[1].discard(block_hash)
+                if not window[1]:
+                    peer.sync_windows.remove(window)
+                    self.request_blocks(peer)
+                break
+
+    def receive_block(self, peer, blk):
+        """ Queue a block, which arrived complete or was rebuilt from a
+        compact block, for the blockchain """
+        block_hash = blk.get_hash()
+        peer.known.add(block_hash)
+        self.requested.pop(block_hash, None)
+        self.block_arrived(peer, block_hash)
+        if block_hash in self.seen:
+            return
+        self.seen.add(block_hash)
+
+        # We are missing the parent, find out what else we are missing
+        if not (self.have_item(INV_BLOCK, blk.prev_hash)
+                or blk.prev_hash in self.syncing):
+            self.send_getheaders(peer)
+        log.debug("Received block %s" % hexlify(block_hash))
+        with self.lock:
+            self.blocks_received.append(blk)
+
+    def complete_compact(self, peer, compact):
+        """ Assemble a compact block, whose transactions are all known. If
+        that fails, the full block is requested. """
+        blk = compact.get_block()
+        if blk is None:
+            log.info('Compact block %s does not match its merkle root, '
+                     'requesting the full block.'
+                     % hexlify(compact.get_hash()))
+            peer.send_pkg(write_inventory(
+                SerializationBuffer(), b'GDT',
+                [(INV_BLOCK, compact.get_hash())]).get_bytes())
+            return
+        self.receive_block(peer, blk)
+
+    def write_peer(self, peer):
+        if peer.connecting:
+            err = peer.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err != 0:
+                log.info('Could not connect to %s: %s'
+                         % (peer, errno.errorcode.get(err)))
+                self.disconnect(peer)
+                return
+            log.info('Connected to peer %s' % peer)
+            peer.connecting = False
+            self.peer_connected(peer)
+
+        # Write as many queued packages as possible with one syscall
+        try:
+            sent = peer.sock.sendmsg(list(islice(peer.send_queue,
+                                                 SEND_BATCH)))
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.disconnect(peer)
+            return
+        peer.pop_sent(sent)
+        BYTES_SENT.inc(amount=sent)
+
+        # Continue with the requests we held back
+        self.handle_held(peer)
+        if not peer.closed:
+            self.update_events(peer)
+
+    def read_peer(self, peer):
+        try:
+            data = peer.sock.recv(100000)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.disconnect(peer)
+            return
+        BYTES_RECEIVED.inc(amount=len(data))
+
+        peer.recv_buf += data
+        self.parse_frames(peer)
+        if not peer.closed:
+            self.update_events(peer)
+
+    def parse_frames(self, peer):
+        """ Handle the complete packages in the receive buffer of a peer.
+        Stops early when the node can not take more blocks. """
+        buf = peer.recv_buf
+        offset = 0
+        while not peer.closed and self.can_read(peer):
+            if len(buf) - offset < 4:
+                break
+            pkg_len = struct.unpack_from(">I", buf, offset)[0]
+            if pkg_len > P2P_MAX_FRAME_SIZE:
+                log.info('Peer %s sent a package of %i bytes, disconnecting.'
+                         % (peer, pkg_len))
+                self.disconnect(peer)
                 return
-            sleep(0.1)
+            if len(buf) - offset < pkg_len + 4:
+                break
+            pkg = bytes(buf[offset+4:offset+4+pkg_len])
+            offset += pkg_len + 4
+            if self.recorder is not None:
+                self.recorder.record(peer, pkg)
+
+            if pkg[:3] in REQUEST_TYPES and (
+                    peer.held or peer.send_size > P2P_MAX_SEND_BUFFER):
+                # The peer does not read our answers, answer later
+                peer.held.append(pkg)
+                peer.held_size += len(pkg)
+                if peer.held_size > P2P_MAX_SEND_BUFFER:
+                    log.info('Peer %s requests more than it reads, '
+                             'disconnecting.' % peer)
+                    self.disconnect(peer)
+                    return
+            elif not self.process_pkg(peer, pkg):
+                return
+
+            with self.lock:
+                full = len(self.blocks_received) >= P2P_MAX_BLOCK_QUEUE
+            if full:
+                self.set_receiving(False)
+        del buf[:offset]
+
+    def handle_held(self, peer):
+        """ Answer the held back requests of a peer, as far as its send
+        buffer allows """
+        while (peer.held and not peer.closed
+               and peer.send_size <= P2P_MAX_SEND_BUFFER):
+            pkg = peer.held.popleft()
+            peer.held_size -= len(pkg)
+            self.process_pkg(peer, pkg)
+
+    def process_pkg(self, peer, pkg):
+        """ Handle a package and drop the peer, if it is invalid.
+
+        Returns:
+            False if the peer was disconnected
+        """
+        try:
+            self.parse_pkg(peer, pkg)
+        except Exception as e:
+            log.warning('Invalid package from peer %s: %r' % (peer, e))
+            self.disconnect(peer)
+            return False
+        return True
 
-    def parse_pkg(self, sock, pkg):
+    def parse_pkg(self, peer, pkg):
         buf = SerializationBuffer(pkg)
         typ = buf.read(3)
 
         if typ == b'BLK':
-            blk = Block.unserialize(buf)
-            log.debug("Received block %s" % hexlify(blk.get_hash()))
-            with self.lock:
-                self.blocks_received.append(blk)
+            self.receive_block(peer, Block.unserialize(buf))
+        elif typ == b'BLZ':
+            # Compressed block. Do not inflate more than a package may hold.
+            decompressor = zlib.decompressobj()
+            data = decompressor.decompress(buf.get_bytes(),
+                                           P2P_MAX_FRAME_SIZE)
+            if decompressor.unconsumed_tail or not decompressor.eof:
+                raise ValueError('Bad compressed block')
+            self.receive_block(peer,
+                               Block.unserialize(SerializationBuffer(data)))
+        elif typ == b'VER':
+            version = buf.read_u32()
+            peer.features = buf.read_u64()
+            log.debug('Peer %s speaks version %i with features %x'
+                      % (peer, version, peer.features))
+        elif typ == b'CMP':
+            # Rebuild the block from our mempool
+            compact = CompactBlock.unserialize(buf)
+            block_hash = compact.get_hash()
+            peer.known.add(block_hash)
+            if self.have_item(INV_BLOCK, block_hash):
+                return
+            self.requested[block_hash] = time.time()
+
+            compact.fill_from_mempool(self.miner.mempool.transactions.copy())
+            missing = compact.get_missing()
+            if not missing:
+                self.complete_compact(peer, compact)
+                return
+
+            # Ask for the transactions we do not have
+            log.debug('Requesting %i of %i transactions of block %s'
+                      % (len(missing), compact.tx_count,
+                         hexlify(block_hash)))
+            self.partial_blocks.add(block_hash, (compact, missing))
+            resp_buf = SerializationBuffer()
+            resp_buf.write(b'GTX')
+            resp_buf.write(block_hash)
+            resp_buf.write_varuint(len(missing))
+            for index in missing:
+                resp_buf.write_varuint(index)
+            peer.send_pkg(resp_buf.get_bytes())
+        elif typ == b'GTX':
+            # Send transactions of a block
+            block_hash = buf.read(HASH_LEN)
+            indexes = [buf.read_varuint() for _ in range(buf.read_varuint())]
+            blk = (self.blockchain.blocks_by_hash.get(block_hash)
+                   or self.blockchain.unvalidated_blocks.get(block_hash))
+            if blk is None or any(i >= len(blk.txs) for i in indexes):
+                log.info('Peer %s requested unknown transactions.' % peer)
+                return
+            resp_buf = SerializationBuffer()
+            resp_buf.write(b'BTX')
+            resp_buf.write(block_hash)
+            resp_buf.write_varuint(len(indexes))
+            for index in indexes:
+                blk.txs[index].serialize(resp_buf)
+            peer.send_pkg(resp_buf.get_bytes())
+        elif typ == b'BTX':
+            # Transactions for a compact block
+            block_hash = buf.read(HASH_LEN)
+            partial = self.partial_blocks.get(block_hash)
+            if partial is None:
+                return
+            compact, missing = partial
+            txs = [Transaction.unserialize(buf)
+                   for _ in range(buf.read_varuint())]
+            if len(txs) != len(missing):
+                log.info('Peer %s sent the wrong transactions for block %s'
+                         % (peer, hexlify(block_hash)))
+                return
+            self.partial_blocks.add(block_hash, None)
+            compact.fill(missing, txs)
+            self.complete_compact(peer, compact)
         elif typ == b'TXN':
             tx = Transaction.unserialize(buf)
-            log.debug("Received tx %s" % hexlify(tx.get_txid()))
+            txid = tx.get_txid()
+            peer.known.add(txid)
+            self.requested.pop(txid, None)
+            if txid in self.seen:
+                return
+            self.seen.add(txid)
+            log.debug("Received tx %s" % hexlify(txid))
             with self.lock:
+                if len(self.txs_received) >= P2P_MAX_TX_QUEUE:
+                    # Forget it, so we can get it again later
+                    self.seen.discard(txid)
+                    self.dropped['txs_received'] += 1
+                    return
                 self.txs_received.append(tx)
+        elif typ == b'INV':
+            # Request the announced items, which we do not have
+            wanted = []
+            for inv_type, h in read_inventory(buf):
+                peer.known.add(h)
+                if not self.have_item(inv_type, h):
+                    self.requested[h] = time.time()
+                    wanted.append((inv_type, h))
+            if len(self.requested) > P2P_KNOWN_INVENTORY:
+                self.expire_requests()
+            if wanted:
+                peer.send_pkg(write_inventory(SerializationBuffer(), b'GDT',
+                                              wanted).get_bytes())
+        elif typ == b'GDT':
+            # Send the requested items, which we have
+            for inv_type, h in read_inventory(buf):
+                data = self.get_item(inv_type, h)
+                if data is not None:
+                    peer.known.add(h)
+                    peer.send_pkg(self.compress_pkg(peer, data))
+        elif typ == b'GHD':
+            # Send the headers following the fork point with the peer
+            locator = read_hashes(buf, P2P_MAX_HEADERS)
+            headers = self.blockchain.get_headers(locator, P2P_MAX_HEADERS)
+            resp_buf = SerializationBuffer()
+            resp_buf.write(b'HDR')
+            resp_buf.write_varuint(len(headers))
+            for blk in headers:
+                blk.serialize_header(resp_buf)
+            peer.send_pkg(resp_buf.get_bytes())
+        elif typ == b'HDR':
+            # Queue the blocks we do not know for download
+            peer.getting_headers = False
+            headers = [Block.unserialize_header(buf)
+                       for _ in range(read_count(buf, HEADER_LEN,
+                                                 P2P_MAX_HEADERS))]
+            prev_hash = None
+            for blk in headers:
+                if prev_hash is not None and blk.prev_hash != prev_hash:
+                    log.info('Peer %s sent headers, which do not connect.'
+                             % peer)
+                    break
+                prev_hash = blk.get_hash()
+                peer.known.add(prev_hash)
+                if (prev_hash not in self.syncing
+                        and not self.have_item(INV_BLOCK, prev_hash)):
+                    self.syncing.add(prev_hash)
+                    peer.sync_queue.append(prev_hash)
+
+            if len(headers) == P2P_MAX_HEADERS:
+                # The peer has more, continue after the last one
+                self.send_getheaders(peer, [headers[-1].get_hash()])
+            if peer.sync_queue:
+                log.info('Syncing %i blocks from %s'
+                         % (len(peer.sync_queue), peer))
+            self.request_blocks(peer)
         elif typ == b'REQ':
             # block request
             try:
@@ -128,24 +996,29 @@ class P2P:
                 log.debug('Peer requested block %s' % hexlify(block_hash))
                 blk = self.blockchain.blocks_by_hash[block_hash]
             except KeyError:
-                sock.send('Shitty peer.')
-                sock.close()
+                log.info('Shitty peer requested an unknown block.')
+                self.disconnect(peer)
+                return
             resp_buf = SerializationBuffer()
             resp_buf.write(b'BLK')
             blk.serialize(resp_buf)
-            data = resp_buf.get_bytes()
-            sock.send(struct.pack(">I", len(data)) + data)
+            peer.known.add(block_hash)
+            peer.send_pkg(resp_buf.get_bytes())
 
     def get_incoming_transactions(self):
         with self.lock:
-            txs_received = self.txs_received
-            self.txs_received = []
+            txs_received = list(self.txs_received)
+            self.txs_received.clear()
 
         return txs_received
 
     def get_incoming_blocks(self):
         with self.lock:
-            blocks_received = self.blocks_received
-            self.blocks_received = []
+            blocks_received = list(self.blocks_received)
+            self.blocks_received.clear()
+            paused = not self.receiving
 
+        # Let the network thread continue reading
+        if paused:
+            self.wakeup()
         return blocks_received
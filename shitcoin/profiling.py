@@ -0,0 +1,144 @@
+""" Timing of the stages of block processing.
+
+Code wraps a stage in a span:
+
+    with profiling.span('validate.signatures', block):
+        ...
+
+When the span ends, its wall and CPU time are passed to every registered sink.
+Without sinks, span returns a shared object doing nothing, so the hooks can
+stay in the code paths without slowing them down. """
+from binascii import hexlify
+from collections import deque
+import logging
+from threading import Lock
+import time
+
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+# Registered sinks. The list is only replaced as a whole, so it can be read
+# without the lock.
+_sinks = []
+_sinks_lock = Lock()
+
+
+class Span:
+    """ Measures one stage, use span() to create it """
+    __slots__ = ('stage', 'block', 'wall', 'cpu')
+
+    def __init__(self, stage, block):
+        self.stage = stage
+        self.block = block
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        for sink in _sinks:
+            sink.record(self.stage, self.block, wall, cpu)
+
+
+class NullSpan:
+    """ Span used while profiling is disabled """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(stage, block=None):
+    """ Get a context manager measuring a stage.
+
+    Args:
+        stage: Name of the stage, e.g. validate.signatures
+        block: Block being processed, if any
+    """
+    if not _sinks:
+        return NULL_SPAN
+    return Span(stage, block)
+
+
+def add_sink(sink):
+    """ Start passing spans to a sink. A sink has a method record(stage,
+    block, wall seconds, cpu seconds), which may be called from any
+    thread. """
+    global _sinks
+    with _sinks_lock:
+        _sinks = _sinks + [sink]
+
+
+def remove_sink(sink):
+    global _sinks
+    with _sinks_lock:
+        _sinks = [s for s in _sinks if s is not sink]
+
+
+def _block_name(block):
+    if block is None:
+        return '-'
+    return hexlify(block.get_hash()).decode()
+
+
+class LogSink:
+    """ Logs every span """
+    def __init__(self, level=logging.DEBUG):
+        self.level = level
+
+    def record(self, stage, block, wall, cpu):
+        log.log(self.level, '%s of block %s took %.3f ms (%.3f ms cpu)'
+                % (stage, _block_name(block), wall * 1000, cpu * 1000))
+
+
+class RingBufferSink:
+    """ Keeps the latest spans in memory """
+    def __init__(self, size=10000):
+        self.records = deque(maxlen=size)
+
+    def record(self, stage, block, wall, cpu):
+        self.records.append({
+            'stage': stage,
+            'block': None if block is None else block.get_hash(),
+            'wall': wall,
+            'cpu': cpu,
+        })
+
+    def get_records(self, block_hash=None):
+        """ Get the kept spans, oldest first.
+
+        Args:
+            block_hash: Only get the spans of this block
+
+        Returns:
+            list of dicts with stage, block hash, wall and cpu seconds
+        """
+        records = list(self.records)
+        if block_hash is not None:
+            records = [r for r in records if r['block'] == block_hash]
+        return records
+
+
+class MetricsSink:
+    """ Counts the spans in histograms by stage """
+    def __init__(self):
+        self.wall = metrics.histogram(
+            'shitcoin_stage_seconds', 'Wall time of block processing stages',
+            ('stage',))
+        self.cpu = metrics.histogram(
+            'shitcoin_stage_cpu_seconds',
+            'CPU time of block processing stages', ('stage',))
+
+    def record(self, stage, block, wall, cpu):
+        self.wall.observe(wall, stage)
+        self.cpu.observe(cpu, stage)
@@ -0,0 +1,126 @@
+""" Feed a capture file into a fresh node and time how long it takes to
+handle the packages. """
+import logging
+import time
+
+from . import profiling
+from .blockchain import Blockchain
+from .capture import read_capture
+from .crypto import NO_PUBKEY
+from .miner import Miner
+from .mock_p2p import P2P, Peer
+
+log = logging.getLogger(__name__)
+
+# Stages timed for every package, block or batch of transactions. The stages
+# of the profiling spans within are added as they occur.
+STAGES = ('parse', 'add_block', 'add_transactions')
+
+
+class Replayer:
+    def __init__(self, path, reduce_diff=True):
+        """ Creates a node without peers to replay a capture file into.
+
+        Args:
+            path: Capture file written by a Recorder
+            reduce_diff: Accept blocks with 10 less leading zeros, like
+                client.py does
+        """
+        self.path = path
+        self.reduce_diff = reduce_diff
+
+        self.blockchain = Blockchain()
+        self.miner = Miner(self.blockchain, NO_PUBKEY)
+        self.p2p = P2P(self.blockchain, self.miner, host=None)
+
+        self.timings = {stage: [] for stage in STAGES}
+        self.packages = 0
+        self.errors = 0
+
+    def run(self, realtime=False):
+        """ Replay all packages. The answers of the node are dropped.
+
+        Args:
+            realtime: Keep the delays between packages from the recording,
+                instead of replaying as fast as possible
+
+        Returns:
+            dict of results, see get_results
+        """
+        peers = {}
+        start = time.perf_counter()
+        offset = 0.
+        profiling.add_sink(self)
+        try:
+            for delay, peer_id, pkg in read_capture(self.path):
+                offset += delay
+                if realtime:
+                    time.sleep(max(start + offset - time.perf_counter(), 0))
+
+                peer = peers.get(peer_id)
+                if peer is None:
+                    peer = Peer(None, ('replay', peer_id), True)
+                    peers[peer_id] = peer
+
+                self.packages += 1
+                t = time.perf_counter()
+                try:
+                    self.p2p.parse_pkg(peer, pkg)
+                except Exception as e:
+                    log.info('Package %i failed: %r' % (self.packages, e))
+                    self.errors += 1
+                self.timings['parse'].append(time.perf_counter() - t)
+                peer.pop_sent(peer.send_size)
+
+                self.process_received()
+            elapsed = time.perf_counter() - start
+        finally:
+            profiling.remove_sink(self)
+            self.p2p.shutdown()
+        return self.get_results(elapsed)
+
+    def record(self, stage, block, wall, cpu):
+        """ Profiling sink, collects the spans of the node """
+        self.timings.setdefault(stage, []).append(wall)
+
+    def process_received(self):
+        """ Pass what the package produced to the node, like client.py """
+        for blk in self.p2p.get_incoming_blocks():
+            blk.reduce_diff = self.reduce_diff
+            t = time.perf_counter()
+            self.blockchain.add_block(blk)
+            self.timings['add_block'].append(time.perf_counter() - t)
+
+        txs = self.p2p.get_incoming_transactions()
+        if txs:
+            t = time.perf_counter()
+            self.miner.add_transactions(txs)
+            self.timings['add_transactions'].append(time.perf_counter() - t)
+
+    def get_results(self, elapsed):
+        """ Summarize the timings.
+
+        Returns:
+            dict with packages, errors, elapsed seconds, the height of the
+            replayed chain and for every stage a dict with count, total,
+            mean, p50, p99 and max seconds
+        """
+        results = {
+            'packages': self.packages,
+            'errors': self.errors,
+            'elapsed': elapsed,
+            'height': self.blockchain.get_head().get_height(),
+            'stages': {},
+        }
+        for stage, timings in self.timings.items():
+            timings = sorted(timings)
+            count = len(timings)
+            results['stages'][stage] = {
+                'count': count,
+                'total': sum(timings),
+                'mean': sum(timings) / count if count else 0.,
+                'p50': timings[count // 2] if count else 0.,
+                'p99': timings[count * 99 // 100] if count else 0.,
+                'max': timings[-1] if count else 0.,
+            }
+        return results
@@ -15,3 +15,51 @@ WALLET_PATH = path.join(DATA_FOLDER, 'wallet')
 
 # Wallet settings
 MIN_CONFIRMATIONS = 10
+WALLET_MIN_CHANGE = 50  # Smaller change is left to the miner as fee
+WALLET_CONSOLIDATE_INPUTS = 100  # Utxos merged by one consolidation
+WALLET_PAYOUT_OUTPUTS = 500  # Recipients per payout transaction
+WALLET_FSYNC_BATCH = 100  # New keys appended before syncing the wallet file
+WALLET_FSYNC_INTERVAL = 1.0  # Sync at the next new key after x seconds
+WALLET_RESCAN_CHUNK = 500  # Blocks between progress reports of a rescan
+
+# RPC settings
+RPC_HOST = '127.0.0.1'
+RPC_PORT = 7839  # Text commands, e.g. with nc
+RPC_JSON_PORT = 7840  # JSON lines for scripts
+
+# Metrics settings
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9839  # Prometheus metrics over HTTP, None to disable
+
+# Profiling settings
+PROFILE_LOG = False  # Log the time of every stage of block processing
+
+# Miner settings
+MINER_BACKEND = 'midstate'  # python, midstate or multiprocess
+MINER_PROCESSES = None  # Processes of the multiprocess backend, None = all
+
+# Mempool settings
+MEMPOOL_MAX_SIZE = 32 * 1024 * 1024  # Bytes of serialized transactions
+
+# Block template settings. These are a policy of the local miner, not consensus
+BLOCK_MAX_SIZE = 1024 * 1024  # Bytes of serialized transactions per block
+BLOCK_MAX_TXS = 5000  # Transactions per block, excluding the coinbase
+
+# P2P settings
+P2P_MAX_INBOUND = 32  # Accepted connections at the same time
+P2P_RECONNECT_INTERVAL = 5.0  # Seconds between dialing lost outbound peers
+P2P_KNOWN_INVENTORY = 10000  # Hashes remembered per peer to avoid resending
+P2P_RELAY_CACHE = 1000  # Recently broadcasted packages kept for GDT requests
+P2P_GETDATA_TIMEOUT = 30.0  # Seconds until a requested item is asked again
+P2P_MAX_HEADERS = 2000  # Headers per HDR package
+P2P_SYNC_WINDOW = 16  # Blocks requested per GDT while syncing
+P2P_SYNC_IN_FLIGHT = 8  # Unanswered GDT requests per peer while syncing
+P2P_PARTIAL_BLOCKS = 16  # Compact blocks waiting for missing transactions
+P2P_MAX_FRAME_SIZE = 4 * 1024 * 1024  # Larger packages get a peer disconnected
+P2P_MAX_SEND_BUFFER = 4 * 1024 * 1024  # Bytes queued before holding requests
+P2P_MAX_BLOCK_QUEUE = 256  # Blocks queued to or from the node
+P2P_MAX_TX_QUEUE = 10000  # Transactions queued to or from the node
+P2P_COMPRESSION = True  # Offer peers zlib compressed blocks
+P2P_COMPRESS_LEVEL = 6  # zlib level 1 (fast) to 9 (small)
+P2P_COMPRESS_THRESHOLD = 1024  # Smaller blocks are sent uncompressed
+P2P_CAPTURE_PATH = None  # Record all received packages to this file
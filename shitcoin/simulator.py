@@ -0,0 +1,419 @@
+""" In-process network simulator. Several nodes run in one process and talk
+over socketpairs through a relay, which delays and throttles the traffic of
+every link. simulate.py uses it to measure block propagation, orphan rate,
+confirmed transactions per second and CPU use of the nodes. """
+from collections import deque
+import heapq
+import logging
+import selectors
+import socket
+from threading import Event, Lock, Thread
+import time
+
+from . import crypto
+from .blockchain import Blockchain
+from .miner import Miner
+from .mock_p2p import P2P
+from .transaction import Input, Output, Transaction
+
+log = logging.getLogger(__name__)
+
+# Fee paid by generated transactions
+TX_FEE = 20
+# Seconds between polls of a node
+POLL_INTERVAL = 0.01
+# The relay checks for the stop event every x seconds
+RELAY_TIMEOUT = 0.1
+
+TOPOLOGIES = ('ring', 'line', 'full')
+
+
+def get_thread_cpu_time(thread):
+    """ Get the CPU time used so far by a running thread, 0 if unknown """
+    if thread is None or thread.ident is None:
+        return 0.
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+    except (AttributeError, OSError):
+        return 0.
+
+
+class RelayEnd:
+    """ The relay side of a socketpair, the other side belongs to a node.
+    Data read from it is delivered to the other end of the link. """
+    def __init__(self, sock, latency, bandwidth):
+        self.sock = sock
+        self.latency = latency
+        self.bandwidth = bandwidth  # bytes per second, None = unlimited
+        self.other = None
+        self.busy_until = 0.  # the link is sending earlier data until then
+        self.out = bytearray()  # delivered data not written yet
+        self.events = selectors.EVENT_READ
+        self.closed = False
+
+
+class Network:
+    """ Relays the traffic of all links in one thread """
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        self.deliveries = []  # heap of (time, sequence, RelayEnd, data)
+        self.sequence = 0
+        self.bytes_sent = 0
+        self.stop_event = Event()
+        self.thread = None
+
+    def connect(self, p2p_a, p2p_b, addr_a, addr_b, latency, bandwidth):
+        """ Link two nodes. Must be called before start.
+
+        Args:
+            p2p_a, p2p_b: P2P instances of the nodes, a is the dialing side
+            addr_a, addr_b: (host, port) tuples naming the nodes
+            latency: One way delay in seconds
+            bandwidth: Bytes per second in each direction or None
+        """
+        a_sock, a_relay = socket.socketpair()
+        b_sock, b_relay = socket.socketpair()
+        end_a = RelayEnd(a_relay, latency, bandwidth)
+        end_b = RelayEnd(b_relay, latency, bandwidth)
+        end_a.other = end_b
+        end_b.other = end_a
+        for end in (end_a, end_b):
+            end.sock.setblocking(False)
+            self.selector.register(end.sock, end.events, end)
+
+        p2p_a.add_connection(a_sock, addr_b, False)
+        p2p_b.add_connection(b_sock, addr_a, True)
+
+    def start(self):
+        self.thread = Thread(target=Network.relay_main, name='relay',
+                             args=(self,), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join(10)
+
+    def relay_main(self):
+        try:
+            while not self.stop_event.is_set():
+                now = time.perf_counter()
+                while self.deliveries and self.deliveries[0][0] <= now:
+                    _, _, end, data = heapq.heappop(self.deliveries)
+                    if not end.closed:
+                        end.out += data
+                        self.flush(end)
+
+                timeout = RELAY_TIMEOUT
+                if self.deliveries:
+                    timeout = min(timeout, self.deliveries[0][0] - now)
+                for key, mask in self.selector.select(max(timeout, 0)):
+                    end = key.data
+                    if mask & selectors.EVENT_WRITE and not end.closed:
+                        self.flush(end)
+                    if mask & selectors.EVENT_READ and not end.closed:
+                        self.receive(end)
+        finally:
+            for key in list(self.selector.get_map().values()):
+                key.fileobj.close()
+            self.selector.close()
+
+    def receive(self, end):
+        """ Schedule the delivery of data a node sent """
+        try:
+            data = end.sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not data:
+            # The node is gone, disconnect the other one too
+            self.close(end)
+            self.close(end.other)
+            return
+
+        now = time.perf_counter()
+        start = max(now, end.busy_until)
+        if end.bandwidth:
+            end.busy_until = start + len(data) / end.bandwidth
+        else:
+            end.busy_until = start
+        self.sequence += 1
+        heapq.heappush(self.deliveries, (end.busy_until + end.latency,
+                                         self.sequence, end.other, data))
+        self.bytes_sent += len(data)
+
+    def flush(self, end):
+        try:
+            sent = end.sock.send(end.out)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.close(end)
+            return
+        del end.out[:sent]
+
+        events = selectors.EVENT_READ
+        if end.out:
+            events |= selectors.EVENT_WRITE
+        if events != end.events:
+            self.selector.modify(end.sock, events, end)
+            end.events = events
+
+    def close(self, end):
+        if end.closed:
+            return
+        end.closed = True
+        self.selector.unregister(end.sock)
+        end.sock.close()
+
+
+class SimNode:
+    """ A node like client.py, which mines and sends transactions between its
+    own outputs. """
+    def __init__(self, index, sim, backend, reduce_diff, tx_rate):
+        """ Creates a node.
+
+        Args:
+            index: Number of the node in the simulation
+            sim(Simulation): Records what happens
+            backend: Name of the mining backend
+            reduce_diff: Mine and accept blocks with 10 less leading zeros
+            tx_rate: Transactions created per second
+        """
+        self.index = index
+        self.addr = ('sim', index)
+        self.sim = sim
+        self.reduce_diff = reduce_diff
+        self.tx_rate = tx_rate
+        self.privkey, self.pubkey = crypto.generate_keypair()
+
+        self.blockchain = Blockchain()
+        self.miner = Miner(self.blockchain, self.pubkey, reduce_diff, backend)
+        self.p2p = P2P(self.blockchain, self.miner, host=None)
+
+        # (txid, index, amount) of outputs we can spend
+        self.spendable = deque()
+
+        self.stop_event = Event()
+        self.thread = None
+        self.loop_cpu_time = 0.
+        self.cpu_time = 0.
+
+    def start(self):
+        self.miner.start_mining()
+        self.thread = Thread(target=SimNode.node_main,
+                             name='node-%i' % self.index, args=(self,),
+                             daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join(10)
+
+        # Sample the other threads, before they are gone
+        self.cpu_time = (self.loop_cpu_time
+                         + get_thread_cpu_time(self.p2p.net_thread)
+                         + get_thread_cpu_time(self.miner.mining_thread)
+                         + self.miner.backend.get_cpu_time())
+        self.miner.stop_mining()
+        self.p2p.shutdown()
+
+    def node_main(self):
+        next_tx = time.perf_counter()
+        while not self.stop_event.is_set():
+            self.poll_net()
+            self.poll_miner()
+
+            if self.tx_rate:
+                # Do not try to catch up for more than a second
+                now = time.perf_counter()
+                next_tx = max(next_tx, now - 1.)
+                while next_tx <= now:
+                    self.send_transaction()
+                    next_tx += 1. / self.tx_rate
+
+            self.stop_event.wait(POLL_INTERVAL)
+        self.loop_cpu_time = time.thread_time()
+
+    def poll_net(self):
+        for blk in self.p2p.get_incoming_blocks():
+            blk.reduce_diff = self.reduce_diff
+            if self.blockchain.add_block(blk):
+                self.sim.record_block(self.index, blk.get_hash())
+                self.p2p.broadcast_block(blk)
+
+        txs_received = self.p2p.get_incoming_transactions()
+        if txs_received:
+            for tx in self.miner.add_transactions(txs_received):
+                self.p2p.broadcast_transaction(tx)
+
+    def poll_miner(self):
+        mined_block = self.miner.get_mined_block()
+        if mined_block is None:
+            return
+        mined_block.reduce_diff = self.reduce_diff
+        if not self.blockchain.add_block(mined_block):
+            return
+        self.sim.record_block(self.index, mined_block.get_hash(), True)
+        self.p2p.broadcast_block(mined_block)
+
+        coinbase = mined_block.txs[-1]
+        self.spendable.append((coinbase.get_txid(), 0,
+                               coinbase.outputs[0].amount))
+
+    def send_transaction(self):
+        """ Split one of our outputs into two """
+        if not self.spendable:
+            return
+        txid, index, amount = self.spendable.popleft()
+        half = (amount - TX_FEE) // 2
+        if half <= 0:
+            return
+
+        tx = Transaction()
+        tx.inputs = [Input(txid, index)]
+        tx.outputs = [Output(half, self.pubkey),
+                      Output(amount - TX_FEE - half, self.pubkey)]
+        new_txid = tx.get_txid()
+        tx.inputs[0].signature = crypto.sign(new_txid, self.privkey)
+        if not self.miner.add_transaction(tx):
+            # The output is gone, e.g. in a reorg
+            return
+
+        self.sim.record_transaction(new_txid)
+        self.p2p.broadcast_transaction(tx)
+        for i, out in enumerate(tx.outputs):
+            self.spendable.append((new_txid, i, out.amount))
+
+
+class Simulation:
+    def __init__(self, nodes=4, topology='ring', latency=0.05,
+                 bandwidth=None, tx_rate=0., backend='midstate',
+                 reduce_diff=True):
+        """ Creates a network of nodes.
+
+        Args:
+            nodes: Number of nodes
+            topology: 'ring', 'line' or 'full' mesh. Further links can be
+                added with connect.
+            latency: Default one way delay of a link in seconds
+            bandwidth: Default bytes per second of a link, None = unlimited
+            tx_rate: Transactions created per second by each node
+            backend: Name of the mining backend of each node
+            reduce_diff: Mine with 10 less leading zeros
+        """
+        if topology not in TOPOLOGIES:
+            raise ValueError('Unknown topology %s' % topology)
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+        # Protects the records
+        self.lock = Lock()
+        self.mined = {}  # block hash -> (node index, time)
+        self.arrivals = {}  # block hash -> {node index: time}
+        self.submitted = {}  # txid -> time
+
+        self.network = Network()
+        self.nodes = [SimNode(i, self, backend, reduce_diff, tx_rate)
+                      for i in range(nodes)]
+
+        links = [(i, i + 1) for i in range(nodes - 1)]
+        if topology == 'ring' and nodes > 2:
+            links.append((nodes - 1, 0))
+        elif topology == 'full':
+            links = [(i, j) for i in range(nodes) for j in range(i + 1, nodes)]
+        for a, b in links:
+            self.connect(a, b)
+
+    def connect(self, a, b, latency=None, bandwidth=None):
+        """ Link two nodes by index. Must be called before run. """
+        if latency is None:
+            latency = self.latency
+        if bandwidth is None:
+            bandwidth = self.bandwidth
+        node_a = self.nodes[a]
+        node_b = self.nodes[b]
+        self.network.connect(node_a.p2p, node_b.p2p, node_a.addr,
+                             node_b.addr, latency, bandwidth)
+
+    def record_block(self, index, block_hash, mined=False):
+        now = time.perf_counter()
+        with self.lock:
+            if mined:
+                self.mined[block_hash] = (index, now)
+            self.arrivals.setdefault(block_hash, {}).setdefault(index, now)
+
+    def record_transaction(self, txid):
+        with self.lock:
+            self.submitted[txid] = time.perf_counter()
+
+    def run(self, duration):
+        """ Run the network for some seconds.
+
+        Returns:
+            dict of results, see get_results
+        """
+        log.info('Simulating %i nodes for %.1f seconds...'
+                 % (len(self.nodes), duration))
+        self.network.start()
+        for node in self.nodes:
+            node.start()
+        try:
+            time.sleep(duration)
+        finally:
+            for node in self.nodes:
+                node.stop()
+            self.network.stop()
+        return self.get_results(duration)
+
+    def get_results(self, duration):
+        """ Evaluate the records.
+
+        Returns:
+            dict with
+            - blocks_mined, orphan_rate: Blocks found by all nodes and the
+              share of them not on the longest chain of node 0
+            - propagation_mean, propagation_max: Seconds until a block was
+              known to all nodes
+            - txs_submitted, txs_confirmed, tps: Transactions created, the
+              ones in the longest chain of node 0 and those per second
+            - confirmation_mean: Seconds from creating a transaction until
+              node 0 got the block including it
+            - cpu: CPU seconds used by each node
+            - bytes_sent: Bytes sent over all links
+        """
+        observer = self.nodes[0]
+        main_chain = observer.blockchain.main_chain[1:]
+        main_hashes = {blk.get_hash() for blk in main_chain}
+
+        propagation = []
+        for block_hash, (_, mined_time) in self.mined.items():
+            arrivals = self.arrivals[block_hash]
+            if len(arrivals) == len(self.nodes):
+                propagation.append(max(arrivals.values()) - mined_time)
+
+        confirmations = []
+        for blk in main_chain:
+            confirmed_time = self.arrivals.get(blk.get_hash(), {}).get(0)
+            if confirmed_time is None:
+                continue
+            for tx in blk.txs:
+                submitted_time = self.submitted.get(tx.get_txid())
+                if submitted_time is not None:
+                    confirmations.append(confirmed_time - submitted_time)
+
+        orphans = sum(1 for h in self.mined if h not in main_hashes)
+        return {
+            'blocks_mined': len(self.mined),
+            'orphan_rate': orphans / max(len(self.mined), 1),
+            'propagation_mean': (sum(propagation) / len(propagation)
+                                 if propagation else 0.),
+            'propagation_max': max(propagation, default=0.),
+            'txs_submitted': len(self.submitted),
+            'txs_confirmed': len(confirmations),
+            'tps': len(confirmations) / duration,
+            'confirmation_mean': (sum(confirmations) / len(confirmations)
+                                  if confirmations else 0.),
+            'cpu': [node.cpu_time for node in self.nodes],
+            'bytes_sent': self.network.bytes_sent,
+        }
@@ -3,9 +3,10 @@ import math
 from statistics import median
 import time
 
-from . import crypto
+from . import crypto, metrics
 from .crypto import HASH_LEN, NO_HASH
 from .exceptions import UTXONotFound
+from .profiling import span
 from .settings import (
     BLOCK_TIME,
     DIFF_PERIOD_LEN,
@@ -16,30 +17,60 @@ from .settings import (
 
 log = logging.getLogger(__name__)
 
+BLOCKS_VALIDATED = metrics.counter(
+    'shitcoin_blocks_validated_total', 'Blocks validated by result',
+    ('result',))
+
 
 def validate_block(block, utxos):
     """ Validates the block with the given UTXO set. This applies the block to
     the utxos, so if you just want to validate the block without applying the
     transactions, copy the utxo set first. """
-    if not validate_block_header(block):
-        log.info("Invalid block header!")
-        return False
+    valid = _validate_block(block, utxos)
+    BLOCKS_VALIDATED.inc('valid' if valid else 'invalid')
+    return valid
+
+
+def _validate_block(block, utxos):
+    with span('validate.header', block):
+        if not validate_block_header(block):
+            log.info("Invalid block header!")
+            return False
 
     # Check Merkle root
-    if block.merkle_root != crypto.merkle_root([tx.serialize().get_bytes()
-                                                for tx in block.txs]):
-        log.info("Incorrect merkle root!")
-        return False
+    with span('validate.merkle', block):
+        if block.merkle_root != crypto.merkle_root(
+                [tx.serialize().get_bytes() for tx in block.txs]):
+            log.info("Incorrect merkle root!")
+            return False
 
     # Check transactions
-    utxos.move_on_chain(block.get_parent())
     try:
-        money_created = utxos.apply_block(block)
+        with span('validate.utxo_move', block):
+            utxos.move_on_chain(block.get_parent())
+        with span('validate.utxo_apply', block):
+            money_created = utxos.apply_block(block)
     except UTXONotFound:
         log.info("Invalid transaction in block!")
         return False
 
     # Check signatures
+    with span('validate.signatures', block):
+        if not _check_signatures(block):
+            return False
+
+    # Check block reward
+    with span('validate.reward', block):
+        reward = INITIAL_REWARD // (2 ** (
+            block.get_height() // REWARD_HALVING_LEN))
+        if money_created > reward:
+            log.info("Block creates too much money!")
+            return False
+
+    return True
+
+
+def _check_signatures(block):
     for tx in block.txs:
         txid = tx.get_txid()
         for inp in tx.inputs:
@@ -49,14 +80,6 @@ def validate_block(block, utxos):
                                      inp.signature):
                 log.info("Invalid signature on transaction %s!" % txid)
                 return False
-
-    # Check block reward
-    reward = INITIAL_REWARD // (2 ** (
-        block.get_height() // REWARD_HALVING_LEN))
-    if money_created > reward:
-        log.info("Block creates too much money!")
-        return False
-
     return True
 
 
@@ -1,59 +1,264 @@
 from binascii import hexlify, unhexlify
 from collections import deque
+from functools import partial
+import logging
+import os
+from threading import Lock
+import time
 
 from . import crypto
+from .coinselection import select_coins
 from .crypto import NO_HASH
 from .exceptions import NotEnoughFunds
-from .settings import WALLET_PATH, MIN_CONFIRMATIONS
+from .settings import (
+    MIN_CONFIRMATIONS,
+    WALLET_CONSOLIDATE_INPUTS,
+    WALLET_FSYNC_BATCH,
+    WALLET_FSYNC_INTERVAL,
+    WALLET_MIN_CHANGE,
+    WALLET_PATH,
+    WALLET_PAYOUT_OUTPUTS,
+    WALLET_RESCAN_CHUNK
+)
 from .transaction import Transaction, Input, Output
 
+log = logging.getLogger(__name__)
+
 
 class Wallet:
-    def __init__(self, blockchain, autoload=True):
+    def __init__(self, blockchain, autoload=True, path=WALLET_PATH,
+                 mempool=None):
         """ Creates a wallet.
 
         Args:
-            key_list: list of tuples (priv_key, pub_key)
+            blockchain: Blockchain to follow
+            autoload: Load the keys from the wallet file
+            path: Wallet file, None to keep the keys in memory only
+            mempool: Mempool our transactions are sent to. Without it, the
+                inputs of sent transactions are only available again, when
+                they are released or spent in a block.
         """
         self.keys = []
+        self.privkeys = {}  # pubkey -> privkey
+
+        # The wallet file is a journal of keys. New keys are appended and
+        # synced to disk in batches. Appending never leaves stale lines, so
+        # the file only needs compacting, i.e. rewriting with the keys in
+        # memory, when it is loaded with torn, invalid or duplicate lines,
+        # or when it does not match the keys in memory anymore.
+        self.path = path
+        self.journal = None  # File object to append to, opened on demand
+        self.journal_valid = False  # Whether the file has all our keys
+        self.unsynced = 0  # Keys appended since the last sync
+        self.last_sync = time.monotonic()
+        self.journal_lock = Lock()
 
         self.blockchain = blockchain
 
         # Cache our utxos to reduce the time searching for our money
-        self.utxos = []  # known utxos
+        self.utxos = {}  # (txid, index) -> utxo dict
+        self.totals = {}  # pubkey -> amount of all utxos
+        self.height_amounts = {}  # blockheight -> {pubkey -> amount}
         self.current_block = None
 
+        # Outpoints spent by transactions we made, which are not in a block
+        # yet. They are not used again, while the transaction is waiting to
+        # be sent or in the mempool.
+        self.reserved = {}  # (txid, index) -> txid of the spending tx
+        self.pending = set()  # txids of our txs, not in the mempool yet
+        self.mempool = mempool
+
+        # Protects the cache. The balances are only replaced as a whole, so
+        # they can be read without the lock.
+        self.lock = Lock()
+        self.balances = {}  # pubkey -> confirmed amount
+        self.balance = 0  # confirmed amount of all addresses
+
         if autoload:
             self.load()
 
+        # Follow the blockchain as it changes
+        self.update_utxos()
+        self.blockchain.register_new_block_callback(
+            partial(Wallet.new_block, self))
+        if mempool is not None:
+            mempool.register_new_tx_callback(
+                partial(Wallet.transactions_added, self))
+
     def save(self):
-        with open(WALLET_PATH, 'wb') as f:
-            for priv_key, pub_key in self.keys:
-                f.write(hexlify(priv_key))
-                f.write(b':')
-                f.write(hexlify(pub_key))
-                f.write(b'\n')
+        """ Rewrite the wallet file with all keys. The new file replaces the
+        old one only once it is complete, so a crash keeps the old one. """
+        with self.journal_lock:
+            self._save()
+
+    def _save(self):
+        if self.path is None:
+            return
+        self._close_journal()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(b''.join(self._format_key(priv_key, pub_key)
+                             for priv_key, pub_key in self.keys))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.journal_valid = True
 
     def load(self):
+        """ Read the keys from the wallet file. Torn lines, e.g. from a crash
+        while appending, and duplicate keys are dropped and the file is
+        compacted. """
+        if self.path is None:
+            self.new_address()
+            return
         try:
-            with open(WALLET_PATH) as f:
-                for line in f.readlines():
-                    priv_key, pub_key = line.rstrip('\n').split(':')
-                    self.keys.append((unhexlify(priv_key), unhexlify(pub_key)))
+            with open(self.path) as f:
+                lines = f.readlines()
         except FileNotFoundError:
             # No wallet yet, create one
             self.new_address()
-            self.save()
+            return
+
+        self.journal_valid = True
+        stale = 0  # Lines, which are no keys of ours
+        for line in lines:
+            try:
+                if not line.endswith('\n'):
+                    raise ValueError('Line is not complete')
+                priv_key, pub_key = line.rstrip('\n').split(':')
+                priv_key, pub_key = unhexlify(priv_key), unhexlify(pub_key)
+            except ValueError as e:
+                log.warning('Dropping invalid line of %s: %s'
+                            % (self.path, e))
+                stale += 1
+                continue
+            if pub_key in self.privkeys:
+                stale += 1
+                continue
+            self.add_key(priv_key, pub_key)
+        if stale:
+            log.info('Compacting %s, dropping %i stale lines'
+                     % (self.path, stale))
+            with self.journal_lock:
+                self._save()
+        if not self.keys:
+            self.new_address()
+
+    def close(self):
+        """ Sync and close the wallet file """
+        with self.journal_lock:
+            self._close_journal()
+
+    def add_key(self, priv_key, pub_key):
+        self.keys.append((priv_key, pub_key))
+        self.privkeys[pub_key] = priv_key
+
+    @staticmethod
+    def _format_key(priv_key, pub_key):
+        return hexlify(priv_key) + b':' + hexlify(pub_key) + b'\n'
+
+    def _append_key(self, priv_key, pub_key):
+        """ Append a key to the wallet file. It is handed to the OS right
+        away, but only synced to disk every WALLET_FSYNC_BATCH keys or
+        WALLET_FSYNC_INTERVAL seconds. """
+        if self.path is None:
+            return
+        if not self.journal_valid:
+            # The file was not loaded or is damaged, start it over. This
+            # writes the new key too.
+            self._save()
+            return
+
+        if self.journal is None:
+            self.journal = open(self.path, 'ab')
+        self.journal.write(self._format_key(priv_key, pub_key))
+        self.journal.flush()
+        self.unsynced += 1
+        if (self.unsynced >= WALLET_FSYNC_BATCH
+                or time.monotonic() - self.last_sync >= WALLET_FSYNC_INTERVAL):
+            self._sync_journal()
+
+    def _sync_journal(self):
+        if self.journal is not None and self.unsynced:
+            os.fsync(self.journal.fileno())
+        self.unsynced = 0
+        self.last_sync = time.monotonic()
+
+    def _close_journal(self):
+        if self.journal is not None:
+            self._sync_journal()
+            self.journal.close()
+            self.journal = None
+
+    def add_utxo(self, txid, index, output, blockheight):
+        """ Add an output to the cache, if it belongs to us """
+        if output.pubkey not in self.privkeys:
+            return
+        self.utxos[(txid, index)] = {
+            'txid': txid,
+            'index': index,
+            'pubkey': output.pubkey,
+            'amount': output.amount,
+            'blockheight': blockheight
+        }
+        self._add_amount(output.pubkey, blockheight, output.amount)
+
+    def remove_utxo(self, txid, index):
+        """ Remove an output from the cache, if it is there """
+        utxo = self.utxos.pop((txid, index), None)
+        self.reserved.pop((txid, index), None)
+        if utxo is not None:
+            self._add_amount(utxo['pubkey'], utxo['blockheight'],
+                             -utxo['amount'])
+
+    def _add_amount(self, pubkey, blockheight, amount):
+        self.totals[pubkey] = self.totals.get(pubkey, 0) + amount
+        amounts = self.height_amounts.setdefault(blockheight, {})
+        amounts[pubkey] = amounts.get(pubkey, 0) + amount
+        if not amounts[pubkey]:
+            del amounts[pubkey]
+            if not amounts:
+                del self.height_amounts[blockheight]
+
+    def apply_block(self, blk):
+        for tx in blk.txs:
+            # Remove referenced utxos
+            for inp in tx.inputs:
+                self.remove_utxo(inp.txid, inp.index)
+            # Add outputs with known pubkey
+            txid = tx.get_txid()
+            for index, out in enumerate(tx.outputs):
+                self.add_utxo(txid, index, out, blk.get_height())
+
+    def revert_block(self, blk):
+        for tx in reversed(blk.txs):
+            # Remove the outputs of the transaction
+            txid = tx.get_txid()
+            for index in range(len(tx.outputs)):
+                self.remove_utxo(txid, index)
+            # Readd utxos spent by the inputs
+            for inp in tx.inputs:
+                if inp.txid == NO_HASH:  # skip dummy inputs
+                    continue
+                output = inp.spent_output
+                self.add_utxo(inp.txid, inp.index, output,
+                              output.block.get_height())
+
+    def new_block(self, _=None):
+        """ Callback of the blockchain, when the head changed """
+        self.update_utxos()
 
     def update_utxos(self):
         """ Update the utxos to reflect the current blockchain state.
-        If some state is known, this will parse new transactions to update the
-        state. Otherwise it will search through all known utxos for those where
-        we know the private key.
-
-        Args:
-            blockchain(Blockchain): the blockchain instance to parse
+        If some state is known, only the blocks disconnected from and connected
+        to the chain since the last update are parsed. Otherwise it will search
+        through all known utxos for those where we know the private key.
         """
+        with self.lock:
+            self._update_utxos()
+            self._update_balances()
+
+    def _update_utxos(self):
         # Get the blockchain state we are going to use. (The head might change
         # during the execution of this function, so stick with the one we get)
         with self.blockchain.lock:
@@ -61,23 +266,15 @@ class Wallet:
             if self.current_block == blockchain_head:
                 # Nothing to do
                 return
-            full_utxos = self.blockchain.utxos.copy()
-
-        # The pubkeys we will be looking for
-        pubkeys = [key[1] for key in self.keys]
+            if self.current_block is None:
+                full_utxos = self.blockchain.utxos.copy()
 
         if self.current_block is None:
             # No state yet, parse all utxos
             for txid, output_dict in full_utxos.items():
                 for index, output in output_dict.items():
-                    if output.pubkey in pubkeys:
-                        self.utxos.append({
-                            'txid': txid,
-                            'index': index,
-                            'pubkey': output.pubkey,
-                            'amount': output.amount,
-                            'blockheight': output.block.get_height()
-                        })
+                    self.add_utxo(txid, index, output,
+                                  output.block.get_height())
             self.current_block = blockchain_head
             return
 
@@ -99,64 +296,124 @@ class Wallet:
             cur = cur.get_parent()
 
             # Revert the block on the old side of the fork
-            for tx in self.current_block.txs:
-                txid = tx.get_txid()
-                # Remove all outputs with matching txids
-                self.utxos = list(filter(lambda utxo: utxo['txid'] == txid,
-                                         self.utxos))
-                # Readd utxos spent by the inputs
-                for inp in tx.inputs:
-                    if inp.txid == NO_HASH:  # skip dummy inputs
-                        continue
-                    output = inp.spent_output
-                    if output.pubkey in pubkeys:
-                        self.utxos.append({
-                            'txid': inp.txid,
-                            'index': inp.index,
-                            'pubkey': output.pubkey,
-                            'amount': output.amount,
-                            'blockheight': output.block.get_height()
-                        })
+            self.revert_block(self.current_block)
             self.current_block = self.current_block.get_parent()
 
         # Apply the new blocks
         for blk in blocks_to_apply:
-            for tx in blk.txs:
-                # Remove referenced utxos
-                for inp in tx.inputs:
-                    self.utxos = list(filter(
-                        lambda utxo: utxo['txid'] != inp.txid or
-                        utxo['index'] != inp.index, self.utxos))
-                # Add outputs with known pubkey
-                for out in tx.outputs:
-                    if out.pubkey in pubkeys:
-                        self.utxos.append({
-                            'txid': tx.get_txid(),
-                            'index': tx.outputs.index(out),
-                            'pubkey': out.pubkey,
-                            'amount': out.amount,
-                            'blockheight': out.block.get_height()
-                        })
-        self.current_block = blocks_to_apply[-1]
+            self.apply_block(blk)
+        self.current_block = blockchain_head
+
+    def rescan(self, progress=None):
+        """ Rebuild the utxo cache from the blocks of the main chain, e.g.
+        after keys were added. The chain is scanned in chunks without
+        holding any lock, first for outputs paying to our keys, then for
+        inputs spending them.
+
+        Args:
+            progress: Called with (blocks done, blocks total) after every
+                chunk. Both passes count, so total is twice the chain length.
+
+        Returns:
+            dict with the number of blocks scanned, outputs received, of
+            those spent and unspent
+        """
+        with self.blockchain.lock:
+            blocks = list(self.blockchain.main_chain)
+        with self.journal_lock:
+            pubkeys = set(self.privkeys)
+
+        total = 2 * len(blocks)
+        done = 0
+
+        def get_chunks():
+            """ Yield tuples (start height, blocks) and report the progress
+            after each """
+            nonlocal done
+            for start in range(0, len(blocks), WALLET_RESCAN_CHUNK):
+                chunk = blocks[start:start + WALLET_RESCAN_CHUNK]
+                yield start, chunk
+                done += len(chunk)
+                if progress is not None:
+                    progress(done, total)
+
+        # Find the outputs paying to our keys
+        received = {}  # (txid, index) -> (pubkey, amount, blockheight)
+        for start, chunk in get_chunks():
+            for height, blk in enumerate(chunk, start):
+                for tx in blk.txs:
+                    txid = None
+                    for index, out in enumerate(tx.outputs):
+                        if out.pubkey in pubkeys:
+                            if txid is None:
+                                txid = tx.get_txid()
+                            received[(txid, index)] = (out.pubkey,
+                                                       out.amount, height)
+
+        # Find the inputs spending them
+        spent = set()
+        for _, chunk in get_chunks():
+            for blk in chunk:
+                for tx in blk.txs:
+                    for inp in tx.inputs:
+                        if (inp.txid, inp.index) in received:
+                            spent.add((inp.txid, inp.index))
+
+        with self.lock:
+            self.utxos = {}
+            self.totals = {}
+            self.height_amounts = {}
+            for (txid, index), (pubkey, amount, height) in received.items():
+                if (txid, index) in spent:
+                    continue
+                self.utxos[(txid, index)] = {
+                    'txid': txid,
+                    'index': index,
+                    'pubkey': pubkey,
+                    'amount': amount,
+                    'blockheight': height
+                }
+                self._add_amount(pubkey, height, amount)
+            self.reserved = {outpoint: txid
+                             for outpoint, txid in self.reserved.items()
+                             if outpoint in self.utxos}
+
+            # Catch up with blocks added during the scan
+            self.current_block = blocks[-1]
+            self._update_utxos()
+            self._update_balances()
+
+        return {
+            'blocks': len(blocks),
+            'received': len(received),
+            'spent': len(spent),
+            'unspent': len(received) - len(spent),
+        }
 
     def new_address(self):
         priv_key, pub_key = crypto.generate_keypair()
-        self.keys.append((priv_key, pub_key))
-        self.save()
+        with self.journal_lock:
+            self.add_key(priv_key, pub_key)
+            self._append_key(priv_key, pub_key)
         return pub_key
 
-    def get_balance(self, address=None):
-        self.update_utxos()
+    def _update_balances(self):
+        """ Precompute the balances for the current block """
+        # Subtract the utxos in the newest blocks, which are too fresh
+        height = self.current_block.get_height()
+        balances = dict(self.totals)
+        for h in range(height - MIN_CONFIRMATIONS + 1, height + 1):
+            for addr, amount in self.height_amounts.get(h, {}).items():
+                balances[addr] -= amount
+        self.balances = balances
+        self.balance = sum(balances.values())
 
-        balance = 0
-        for utxo in self.utxos:
-            if address is not None and utxo['pubkey'] != address:
-                continue
-            # Filter utxos with too few confirmations
-            if (utxo['blockheight'] <=
-                    self.current_block.get_height() - MIN_CONFIRMATIONS):
-                balance += utxo['amount']
-        return balance
+    def get_balance(self, address=None):
+        """ Get the amount of the utxos with at least MIN_CONFIRMATIONS
+        confirmations, of one address or of the whole wallet """
+        if address is None:
+            return self.balance
+        return self.balances.get(address, 0)
 
     def get_addresses(self):
         """ Returns the list of addresses """
@@ -168,39 +425,171 @@ class Wallet:
         Args:
             receivers(dict): dict pubkey -> amount of the receivers.
         """
-        self.update_utxos()
+        with self.lock:
+            tx = self._create_transaction(receivers.items(), fee,
+                                          self.new_address)
+            items = self._get_sign_items([tx])
+        self._sign_transactions([tx], items)
+        return tx
 
-        cur_balance = fee
+    def create_payouts(self, payouts, fee=100,
+                       max_outputs=WALLET_PAYOUT_OUTPUTS):
+        """ Creates transactions paying many receivers. They are packed into
+        as few transactions as possible, which share one change address, and
+        all inputs are signed in one batch.
+
+        Args:
+            payouts: list of tuples (pubkey, amount)
+            fee: Fee of every transaction
+            max_outputs: Maximum number of receivers per transaction
+
+        Raises:
+            NotEnoughFunds: If the wallet can not pay all of them. No
+                transaction is created then.
+
+        Returns:
+            List of Transactions
+        """
+        payouts = list(payouts)
+        chunks = [payouts[i:i + max_outputs]
+                  for i in range(0, len(payouts), max_outputs)]
+
+        change_address = []
+
+        def get_change_address():
+            if not change_address:
+                change_address.append(self.new_address())
+            return change_address[0]
+
+        with self.lock:
+            txs = []
+            try:
+                for chunk in chunks:
+                    txs.append(self._create_transaction(chunk, fee,
+                                                        get_change_address))
+            except NotEnoughFunds:
+                for tx in txs:
+                    self._release(tx)
+                raise
+            items = self._get_sign_items(txs)
+        self._sign_transactions(txs, items)
+        return txs
+
+    def _create_transaction(self, receivers, fee, get_change_address):
+        """ Make an unsigned transaction and reserve its inputs """
+        target = fee
         outputs = []
-        for pubkey, amount in receivers.items():
+        for pubkey, amount in receivers:
             outputs.append(Output(amount, pubkey))
-            cur_balance += amount
+            target += amount
+
+        # Pick few UTXOs, which combine to the correct value
+        utxos = select_coins(self._get_spendable(), target, WALLET_MIN_CHANGE)
+
+        # Add change, unless it is too small to be worth it
+        change = sum(utxo['amount'] for utxo in utxos) - target
+        if change >= WALLET_MIN_CHANGE:
+            outputs.append(Output(change, get_change_address()))
+
+        return self._build_transaction(utxos, outputs)
+
+    def consolidate(self, max_inputs=WALLET_CONSOLIDATE_INPUTS, fee=100):
+        """ Merge the smallest utxos into one. Every input costs validation
+        time when the utxos are spent, so this is best done when the network
+        is quiet.
+
+        Returns:
+            The Transaction or None, if there is nothing worth merging
+        """
+        with self.lock:
+            utxos = sorted(self._get_spendable(), key=lambda u: u['amount'])
+            utxos = utxos[:max_inputs]
+            amount = sum(utxo['amount'] for utxo in utxos) - fee
+            if len(utxos) < 2 or amount <= 0:
+                return None
+            tx = self._build_transaction(
+                utxos, [Output(amount, self.new_address())])
+            items = self._get_sign_items([tx])
+        self._sign_transactions([tx], items)
+        return tx
+
+    def release(self, tx):
+        """ Make the inputs of a transaction, which will not be sent,
+        available again """
+        with self.lock:
+            self._release(tx)
+
+    def _release(self, tx):
+        self.pending.discard(tx.get_txid())
+        for inp in tx.inputs:
+            self.reserved.pop((inp.txid, inp.index), None)
 
-        # Pick some UTXOs, which combine to the correct value
-        inputs = []
-        inp_pubkeys = []
-        for utxo in self.utxos:
-            inputs.append(Input(utxo['txid'], utxo['index']))
-            inp_pubkeys.append(utxo['pubkey'])
-            cur_balance -= utxo['amount']
-            if cur_balance <= 0:
-                break
+    def transactions_added(self, txs):
+        """ Callback of the mempool, when transactions were added """
+        with self.lock:
+            for tx in txs:
+                self.pending.discard(tx.get_txid())
 
-        if cur_balance > 0:
-            # Not enough money
-            raise NotEnoughFunds()
+    def _expire_reservations(self):
+        """ Release the inputs of sent transactions, which left the mempool
+        without being mined, e.g. evicted or dropped after a reorg """
+        if self.mempool is None:
+            return
+        if self.current_block != self.blockchain.get_head():
+            # Mined transactions left the mempool already, but their inputs
+            # are only removed with the next update
+            return
+        spending = set(self.reserved.values())
+        with self.mempool.lock:
+            live = {txid for txid in spending
+                    if txid in self.mempool.transactions}
+        live |= self.pending & spending
+        self.pending &= spending
+        if len(live) < len(spending):
+            self.reserved = {outpoint: txid
+                             for outpoint, txid in self.reserved.items()
+                             if txid in live}
 
-        # Add change
-        outputs.append(Output(-cur_balance, self.new_address()))
+    def _get_spendable(self):
+        self._expire_reservations()
+        return [utxo for outpoint, utxo in self.utxos.items()
+                if outpoint not in self.reserved]
 
+    def _build_transaction(self, utxos, outputs):
+        """ Make a transaction spending the utxos. It is pending, until the
+        mempool takes it or it is released. """
         tx = Transaction()
-        tx.inputs = inputs
+        tx.inputs = [Input(utxo['txid'], utxo['index']) for utxo in utxos]
         tx.outputs = outputs
-
-        # Insert signatures
         txid = tx.get_txid()
-        for i, inp in enumerate(tx.inputs):
-            priv_key = next(k[0] for k in self.keys if k[1] == inp_pubkeys[i])
-            inp.signature = crypto.sign(txid, priv_key)
-
+        for utxo in utxos:
+            self.reserved[(utxo['txid'], utxo['index'])] = txid
+        self.pending.add(txid)
         return tx
+
+    def _get_sign_items(self, txs):
+        """ Get the tuples (message, privkey) to sign the inputs of some
+        transactions with, in the order of the inputs """
+        items = []
+        for tx in txs:
+            txid = tx.get_txid()
+            for inp in tx.inputs:
+                pubkey = self.utxos[(inp.txid, inp.index)]['pubkey']
+                items.append((txid, self.privkeys[pubkey]))
+        return items
+
+    def _sign_transactions(self, txs, items):
+        """ Insert the signatures of all inputs. Called without the lock,
+        as large batches start a pool of processes. The inputs are already
+        reserved, so nobody else spends them meanwhile. If signing fails,
+        they are released again. """
+        try:
+            sigs = iter(crypto.sign_batch(items))
+        except BaseException:
+            with self.lock:
+                for tx in txs:
+                    self._release(tx)
+            raise
+        for tx in txs:
+            for inp in tx.inputs:
+                inp.signature = next(sigs)
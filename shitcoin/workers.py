@@ -0,0 +1,9 @@
+""" Worker processes, which take load off the threads of the node """
+import multiprocessing
+
+
+def get_worker_context():
+    """ Get the multiprocessing context to start workers with. Workers run
+    in fresh interpreters, as forking a process with running threads is
+    asking for trouble. """
+    return multiprocessing.get_context('spawn')
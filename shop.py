@@ -81,6 +81,7 @@ class Shop(socketserver.StreamRequestHandler):
                     log.info('Remote disconnected.')
                     self.miner.stop_mining()
                     self.p2p.shutdown()
+                    self.wallet.close()
                     return
 
             sleep(0.01)
@@ -88,11 +89,14 @@ class Shop(socketserver.StreamRequestHandler):
     def poll_net(self):
         blocks_received = self.p2p.get_incoming_blocks()
         for blk in blocks_received:
-            self.blockchain.add_block(blk)
+            if self.blockchain.add_block(blk):
+                # Relay to the other peers
+                self.p2p.broadcast_block(blk)
 
         txs_received = self.p2p.get_incoming_transactions()
-        for tx in txs_received:
-            self.miner.add_transaction(tx)
+        if txs_received:
+            for tx in self.miner.add_transactions(txs_received):
+                self.p2p.broadcast_transaction(tx)
 
     def poll_miner(self):
         mined_block = self.miner.get_mined_block()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+""" Run a network of nodes in this process and report how it performs.
+
+The nodes mine with reduced difficulty and talk through links with the given
+latency and bandwidth. Reported are the block propagation time, the orphan
+rate, confirmed transactions per second and the CPU use of each node. """
+
+import argparse
+import logging
+
+from shitcoin.mining import BACKENDS
+from shitcoin.simulator import TOPOLOGIES, Simulation
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--nodes', type=int, default=4,
+                        help='number of nodes (default: 4)')
+    parser.add_argument('--topology', choices=TOPOLOGIES, default='ring',
+                        help='how the nodes are linked (default: ring)')
+    parser.add_argument('--latency', type=float, default=50.,
+                        help='one way delay of a link in ms (default: 50)')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='kB/s of a link in each direction '
+                             '(default: unlimited)')
+    parser.add_argument('--tx-rate', type=float, default=0.,
+                        help='transactions per second created by each node '
+                             '(default: 0)')
+    parser.add_argument('--backend', choices=BACKENDS, default='midstate',
+                        help='mining backend of the nodes (default: midstate)')
+    parser.add_argument('--duration', type=float, default=30.,
+                        help='seconds to simulate (default: 30)')
+    parser.add_argument('--verbose', action='store_true',
+                        help='log what the nodes do')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose
+                        else logging.WARNING)
+
+    bandwidth = None
+    if args.bandwidth is not None:
+        bandwidth = args.bandwidth * 1000
+    sim = Simulation(args.nodes, args.topology, args.latency / 1000,
+                     bandwidth, args.tx_rate, args.backend)
+    results = sim.run(args.duration)
+
+    print('blocks mined       %8i' % results['blocks_mined'])
+    print('orphan rate        %8.2f %%' % (results['orphan_rate'] * 100))
+    print('propagation mean   %8.1f ms' % (results['propagation_mean'] * 1000))
+    print('propagation max    %8.1f ms' % (results['propagation_max'] * 1000))
+    print('txs submitted      %8i' % results['txs_submitted'])
+    print('txs confirmed      %8i' % results['txs_confirmed'])
+    print('tx/s confirmed     %8.2f' % results['tps'])
+    print('confirmation mean  %8.2f s' % results['confirmation_mean'])
+    print('kB sent            %8.1f' % (results['bytes_sent'] / 1000))
+    for i, cpu in enumerate(results['cpu']):
+        print('cpu node %-3i       %8.2f s' % (i, cpu))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+""" Building blocks for tests """
+from shitcoin import crypto
+from shitcoin.block import Block
+from shitcoin.settings import BLOCK_TIME, INITIAL_REWARD
+from shitcoin.transaction import Input, Output, Transaction
+from shitcoin.validation import get_next_diff, validate_block_header
+
+
+def make_block(parent, pubkey, txs=(), nonce_seed=0):
+    """ Mine a block on top of parent. The timestamps follow BLOCK_TIME, so
+    the difficulty stays as low as at the genesis block.
+
+    Args:
+        parent: Block to build on
+        pubkey: Receiver of the block reward
+        txs: Transactions to include, their fees are not claimed
+        nonce_seed: Makes the coinbase unique, to build competing blocks
+    """
+    blk = Block()
+    blk.set_parent(parent)
+    blk.prev_hash = parent.get_hash()
+    blk.timestamp = parent.timestamp + int(BLOCK_TIME)
+    blk.diff = get_next_diff(parent)
+    blk.add_transactions(list(txs))
+
+    coinbase_inp = Input()  # dummy input to make the txid unique
+    coinbase_inp.index = blk.get_height() << 16 | nonce_seed
+    coinbase = Transaction()
+    coinbase.inputs = [coinbase_inp]
+    coinbase.outputs = [Output(INITIAL_REWARD, pubkey)]
+    blk.add_transactions([coinbase])
+    blk.update_merkle_root()
+
+    while not validate_block_header(blk):
+        blk.nonce += 1
+    return blk
+
+
+def extend_chain(blockchain, pubkey, count, parent=None, nonce_seed=0):
+    """ Mine blocks and add them to the blockchain.
+
+    Returns:
+        List of the new blocks
+    """
+    if parent is None:
+        parent = blockchain.get_head()
+    blocks = []
+    for _ in range(count):
+        parent = make_block(parent, pubkey, nonce_seed=nonce_seed)
+        assert blockchain.add_block(parent)
+        blocks.append(parent)
+    return blocks
+
+
+def spend(outputs, priv_key, receivers):
+    """ Make a signed transaction.
+
+    Args:
+        outputs: list of tuples (txid, index) paying to the key
+        priv_key: Key to sign with
+        receivers: list of tuples (pubkey, amount)
+    """
+    tx = Transaction()
+    tx.inputs = [Input(txid, index) for txid, index in outputs]
+    tx.outputs = [Output(amount, pubkey) for pubkey, amount in receivers]
+    sig = crypto.sign(tx.get_txid(), priv_key)
+    for inp in tx.inputs:
+        inp.signature = sig
+    return tx
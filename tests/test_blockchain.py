@@ -0,0 +1,74 @@
+import unittest
+
+from shitcoin import crypto
+from shitcoin.blockchain import Blockchain
+from shitcoin.crypto import NO_PUBKEY
+from shitcoin.exceptions import IndexDisabled
+from shitcoin.settings import INITIAL_REWARD
+
+from .helpers import extend_chain, make_block, spend
+
+
+class ChainIndexTest(unittest.TestCase):
+    def test_lookups_without_index(self):
+        blockchain = Blockchain()
+        with self.assertRaises(IndexDisabled):
+            blockchain.get_transaction(b'\1' * 32)
+        with self.assertRaises(IndexDisabled):
+            blockchain.get_history(NO_PUBKEY)
+
+    def test_lookups_with_index(self):
+        blockchain = Blockchain(index=True)
+        self.assertIsNone(blockchain.get_transaction(b'\1' * 32))
+        self.assertEqual(blockchain.get_history(NO_PUBKEY), [])
+
+
+class ChainIndexReorgTest(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = Blockchain(index=True)
+        self.priv_key, self.miner = crypto.generate_keypair()
+        self.receiver = b'\2' * 32
+
+    def test_reorg(self):
+        first, second = extend_chain(self.blockchain, self.miner, 2)
+        coinbase = first.txs[-1].get_txid()
+        tx = spend([(coinbase, 0)], self.priv_key,
+                   [(self.receiver, 600), (self.miner, 300)])
+        blk = make_block(second, self.miner, [tx])
+        self.assertTrue(self.blockchain.add_block(blk))
+
+        self.assertEqual(self.blockchain.get_transaction(tx.get_txid()),
+                         (blk, 0))
+        self.assertEqual(self.blockchain.get_history(self.receiver),
+                         [(3, tx.get_txid(), 600)])
+        self.assertEqual(
+            [delta for _, _, delta
+             in self.blockchain.get_history(self.miner)],
+            [INITIAL_REWARD, INITIAL_REWARD, -INITIAL_REWARD + 300,
+             INITIAL_REWARD])
+
+        # A longer chain forking after the first block drops the spend
+        fork = extend_chain(self.blockchain, self.receiver, 3, parent=first,
+                            nonce_seed=1)
+        self.assertIs(self.blockchain.get_head(), fork[-1])
+        self.assertIsNone(self.blockchain.get_transaction(tx.get_txid()))
+        self.assertIsNone(self.blockchain.get_transaction(
+            second.txs[-1].get_txid()))
+        self.assertEqual(self.blockchain.get_transaction(coinbase),
+                         (first, 0))
+        self.assertEqual(self.blockchain.get_history(self.miner),
+                         [(1, coinbase, INITIAL_REWARD)])
+        self.assertEqual(self.blockchain.get_history(self.receiver),
+                         [(b.get_height(), b.txs[-1].get_txid(),
+                           INITIAL_REWARD) for b in fork])
+
+        # And back to the old chain
+        extend_chain(self.blockchain, self.miner, 2, parent=blk)
+        self.assertEqual(self.blockchain.get_transaction(tx.get_txid()),
+                         (blk, 0))
+        self.assertEqual(self.blockchain.get_history(self.receiver),
+                         [(3, tx.get_txid(), 600)])
+
+
+if __name__ == '__main__':
+    unittest.main()
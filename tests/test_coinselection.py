@@ -0,0 +1,120 @@
+import unittest
+
+from shitcoin import crypto
+from shitcoin.blockchain import Blockchain
+from shitcoin.coinselection import (
+    branch_and_bound,
+    largest_first,
+    select_coins
+)
+from shitcoin.exceptions import NotEnoughFunds
+from shitcoin.settings import WALLET_MIN_CHANGE
+from shitcoin.transaction import Output
+from shitcoin.wallet import Wallet
+
+
+def make_utxos(*amounts):
+    return [{'txid': bytes([i + 1]) * 32, 'index': 0, 'amount': amount}
+            for i, amount in enumerate(amounts)]
+
+
+class BranchAndBoundTest(unittest.TestCase):
+    def test_exact_match(self):
+        self.assertEqual(sorted(branch_and_bound([7, 5, 4, 3], 8, 0)),
+                         [1, 3])
+
+    def test_fewest_inputs_win(self):
+        selected = branch_and_bound([1, 2, 3, 4, 5, 6], 11, 0)
+        self.assertEqual(sorted(selected), [4, 5])
+
+    def test_smallest_excess_among_equal_counts(self):
+        selected = branch_and_bound([20, 12, 11], 10, 5)
+        self.assertEqual(selected, [2])
+
+    def test_no_solution(self):
+        self.assertIsNone(branch_and_bound([10, 10], 15, 2))
+        self.assertIsNone(branch_and_bound([7, 5, 4, 3], 20, 0))
+
+    def test_max_tries(self):
+        # The search reaches 5 + 3 in its 13th step
+        self.assertIsNone(branch_and_bound([7, 5, 4, 3], 8, 0,
+                                           max_tries=12))
+        self.assertEqual(sorted(branch_and_bound([7, 5, 4, 3], 8, 0,
+                                                 max_tries=13)), [1, 3])
+
+    def test_largest_first(self):
+        self.assertEqual(largest_first([1, 9, 5], 12), [1, 2])
+        self.assertIsNone(largest_first([1, 9, 5], 16))
+
+
+class SelectCoinsTest(unittest.TestCase):
+    def test_exact_match_without_change(self):
+        utxos = make_utxos(70, 50, 40, 30)
+        selected = select_coins(utxos, 80, WALLET_MIN_CHANGE)
+        self.assertEqual(sorted(u['amount'] for u in selected), [30, 50])
+
+    def test_excess_below_min_change(self):
+        utxos = make_utxos(100, 45)
+        selected = select_coins(utxos, 40, 10)
+        self.assertEqual([u['amount'] for u in selected], [45])
+
+    def test_fallback_to_largest_first(self):
+        utxos = make_utxos(100, 100, 1)
+        selected = select_coins(utxos, 150, 10)
+        self.assertEqual([u['amount'] for u in selected], [100, 100])
+
+    def test_not_enough_funds(self):
+        with self.assertRaises(NotEnoughFunds):
+            select_coins(make_utxos(10, 20), 31, 10)
+
+
+class WalletCoinsTest(unittest.TestCase):
+    def setUp(self):
+        self.wallet = Wallet(Blockchain(), path=None)
+        self.pubkey = self.wallet.get_addresses()[0]
+        self.receiver = crypto.generate_keypair()[1]
+
+    def add_utxos(self, *amounts):
+        for i, amount in enumerate(amounts):
+            self.wallet.add_utxo(bytes([i + 1]) * 32, 0,
+                                 Output(amount, self.pubkey), 0)
+
+    def test_transaction_without_change(self):
+        self.add_utxos(600, 300, 500)
+        tx = self.wallet.create_transaction({self.receiver: 700}, fee=100)
+        self.assertEqual(len(tx.inputs), 2)
+        self.assertEqual([(o.pubkey, o.amount) for o in tx.outputs],
+                         [(self.receiver, 700)])
+
+    def test_transaction_with_change(self):
+        self.add_utxos(1000)
+        tx = self.wallet.create_transaction({self.receiver: 500}, fee=100)
+        self.assertEqual([o.amount for o in tx.outputs], [500, 400])
+        self.assertIn(tx.outputs[1].pubkey, self.wallet.privkeys)
+
+    def test_not_enough_funds(self):
+        self.add_utxos(100)
+        with self.assertRaises(NotEnoughFunds):
+            self.wallet.create_transaction({self.receiver: 100}, fee=100)
+
+    def test_consolidate_smallest(self):
+        self.add_utxos(5000, 200, 300, 400)
+        tx = self.wallet.consolidate(max_inputs=2, fee=100)
+        self.assertEqual(sorted(inp.txid[0] for inp in tx.inputs), [2, 3])
+        self.assertEqual([o.amount for o in tx.outputs], [400])
+
+        # The merged utxos are reserved now
+        tx = self.wallet.consolidate(max_inputs=2, fee=100)
+        self.assertEqual(sorted(inp.txid[0] for inp in tx.inputs), [1, 4])
+
+    def test_single_utxo_is_not_consolidated(self):
+        self.add_utxos(1000)
+        self.assertIsNone(self.wallet.consolidate())
+
+    def test_dust_is_not_consolidated(self):
+        self.add_utxos(60, 30)
+        self.assertIsNone(self.wallet.consolidate(fee=100))
+
+
+if __name__ == '__main__':
+    unittest.main()
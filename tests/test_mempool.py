@@ -0,0 +1,242 @@
+from threading import Thread
+import unittest
+from unittest import mock
+
+from shitcoin import crypto
+from shitcoin.blockchain import Blockchain
+from shitcoin.mempool import Mempool
+from shitcoin.transaction import Input, Output, Transaction
+
+# Amount of every funding output
+FUNDS = 1000
+
+
+class MempoolTestCase(unittest.TestCase):
+    max_size = 20000
+
+    def setUp(self):
+        self.blockchain = Blockchain()
+        self.priv_key, self.pub_key = crypto.generate_keypair()
+        # Outputs to spend, as if they were mined
+        self.fund_txid = b'\1' * 32
+        self.blockchain.utxos[self.fund_txid] = {
+            i: Output(FUNDS, self.pub_key) for i in range(500)}
+        self.mempool = Mempool(self.blockchain, max_size=self.max_size)
+
+    def spend(self, inputs, *amounts):
+        """ Make a signed transaction.
+
+        Args:
+            inputs: list of tuples (txid, index) of our outputs
+            amounts: Amounts of the outputs
+        """
+        tx = Transaction()
+        tx.inputs = [Input(txid, index) for txid, index in inputs]
+        tx.outputs = [Output(amount, self.pub_key) for amount in amounts]
+        sig = crypto.sign(tx.get_txid(), self.priv_key)
+        for inp in tx.inputs:
+            inp.signature = sig
+        return tx
+
+    def fund(self, index, fee):
+        """ Make a transaction spending a funding output """
+        return self.spend([(self.fund_txid, index)], FUNDS - fee)
+
+    def assert_consistent(self):
+        """ Check the indexes against the entries """
+        mempool = self.mempool
+        entries = mempool.entries
+        self.assertEqual(set(entries), set(mempool.transactions))
+        self.assertEqual(mempool.total_size,
+                         sum(e.size for e in entries.values()))
+        self.assertEqual(mempool.total_fees,
+                         sum(e.fee for e in entries.values()))
+        self.assertEqual(
+            mempool.by_descendant_score,
+            sorted((e.get_descendant_score(), txid)
+                   for txid, e in entries.items()))
+        for txid, entry in entries.items():
+            package = [entries[t]
+                       for t in mempool.get_descendants(txid) + [txid]]
+            self.assertEqual(entry.descendant_fee,
+                             sum(e.fee for e in package))
+            self.assertEqual(entry.descendant_size,
+                             sum(e.size for e in package))
+
+
+class MempoolEvictionTest(MempoolTestCase):
+    def test_parent_paid_by_child_is_kept(self):
+        parent = self.fund(0, 10)
+        child = self.spend([(parent.get_txid(), 0)], FUNDS - 10 - 500)
+        other = self.fund(1, 100)
+        self.assertEqual(len(self.mempool.add_transactions([parent, child])),
+                         2)
+        self.assertTrue(self.mempool.add_transaction(other))
+
+        # Room for two of them
+        self.mempool.max_size = self.mempool.total_size - 1
+        evicted = self.mempool.trim()
+
+        self.assertEqual(evicted, [other.get_txid()])
+        self.assertIn(parent.get_txid(), self.mempool.entries)
+        self.assertIn(child.get_txid(), self.mempool.entries)
+        self.assert_consistent()
+
+    def test_cheap_child_is_evicted_first(self):
+        parent = self.fund(0, 500)
+        child = self.spend([(parent.get_txid(), 0)], FUNDS - 500 - 10)
+        other = self.fund(1, 100)
+        self.mempool.add_transactions([parent, child, other])
+
+        self.mempool.max_size = self.mempool.total_size - 1
+        self.assertEqual(self.mempool.trim(), [child.get_txid()])
+        self.assert_consistent()
+
+    def test_removal_updates_ancestors(self):
+        parent = self.fund(0, 10)
+        child = self.spend([(parent.get_txid(), 0)], FUNDS - 10 - 500)
+        grandchild = self.spend([(child.get_txid(), 0)],
+                                FUNDS - 10 - 500 - 20)
+        self.mempool.add_transactions([parent, child, grandchild])
+        self.assert_consistent()
+
+        self.assertEqual(self.mempool.remove_transaction(child.get_txid()),
+                         [grandchild.get_txid(), child.get_txid()])
+        entry = self.mempool.entries[parent.get_txid()]
+        self.assertEqual(entry.descendant_fee, 10)
+        self.assert_consistent()
+
+
+class MempoolBatchTest(MempoolTestCase):
+    def make_chain(self, length, fee=10):
+        """ Make transactions each spending the previous one """
+        txs = [self.fund(0, fee)]
+        for i in range(1, length):
+            txs.append(self.spend([(txs[-1].get_txid(), 0)],
+                                  FUNDS - (i + 1) * fee))
+        return txs
+
+    def test_children_before_parents(self):
+        chain = self.make_chain(4)
+        informed = []
+        self.mempool.register_new_tx_callback(informed.append)
+
+        added = self.mempool.add_transactions(reversed(chain))
+        self.assertEqual(added, chain)
+        self.assertEqual(informed, [chain])
+        self.assert_consistent()
+
+    def test_bad_signature_skips_descendants(self):
+        chain = self.make_chain(3)
+        chain[1].inputs[0].signature = bytes(len(
+            chain[1].inputs[0].signature))
+        other = self.fund(1, 10)
+
+        added = self.mempool.add_transactions(chain + [other])
+        self.assertEqual(added, [chain[0], other])
+        self.assert_consistent()
+
+    def test_low_fee_skips_descendants(self):
+        parent = self.fund(0, 9)
+        child = self.spend([(parent.get_txid(), 0)], FUNDS - 9 - 100)
+        self.assertEqual(self.mempool.add_transactions([child, parent]), [])
+
+    def test_duplicates_and_known(self):
+        tx = self.fund(0, 10)
+        self.assertEqual(self.mempool.add_transactions([tx, tx]), [tx])
+        self.assertEqual(self.mempool.add_transactions([tx]), [])
+
+    def test_double_spend_in_batch(self):
+        first = self.fund(0, 10)
+        second = self.fund(0, 20)
+        self.assertEqual(len(self.mempool.add_transactions([first, second])),
+                         1)
+        self.assert_consistent()
+
+
+class MempoolTemplateTest(MempoolTestCase):
+    max_size = 10 ** 6
+
+    def test_packages_by_fee_rate(self):
+        parent = self.fund(0, 10)
+        child = self.spend([(parent.get_txid(), 0)], FUNDS - 10 - 500)
+        other = self.fund(1, 100)
+        cheap = self.fund(2, 20)
+        self.mempool.add_transactions([child, other, parent, cheap])
+
+        txs, fees = self.mempool.get_block_template()
+        self.assertEqual(txs, [parent, child, other, cheap])
+        self.assertEqual(fees, 10 + 500 + 100 + 20)
+
+    def test_max_txs(self):
+        txs = [self.fund(i, 10 + i) for i in range(10)]
+        self.mempool.add_transactions(txs)
+        picked, fees = self.mempool.get_block_template(max_txs=3)
+        self.assertEqual(picked, txs[:-4:-1])
+        self.assertEqual(fees, 19 + 18 + 17)
+
+    def test_max_size_skips_packages(self):
+        parent = self.fund(0, 10)
+        child = self.spend([(parent.get_txid(), 0)], FUNDS - 10 - 500)
+        other = self.fund(1, 100)
+        self.mempool.add_transactions([parent, child, other])
+        size = self.mempool.entries[other.get_txid()].size
+
+        # The package does not fit, but the single transaction does
+        txs, fees = self.mempool.get_block_template(max_size=size)
+        self.assertEqual(txs, [other])
+        self.assertEqual(fees, 100)
+
+    def test_empty(self):
+        self.assertEqual(self.mempool.get_block_template(), ([], 0))
+
+
+class MempoolBlockTest(MempoolTestCase):
+    def test_incoming_block_keeps_signatures(self):
+        parent = self.fund(0, 10)
+        child = self.spend([(parent.get_txid(), 0)], FUNDS - 20)
+        mined = self.fund(1, 10)
+        self.mempool.add_transactions([parent, child, mined])
+
+        # The block confirms one of them. Pretend it does not change the
+        # chain, which has all the funding outputs already.
+        blk = mock.Mock(txs=[mined])
+        with mock.patch('shitcoin.mempool.verify_sig_batch') as verify:
+            self.mempool.incoming_block(blk)
+        verify.assert_not_called()
+        self.assertEqual(set(self.mempool.entries),
+                         {parent.get_txid(), child.get_txid()})
+        self.assert_consistent()
+
+
+class MempoolLockTest(MempoolTestCase):
+    def test_templates_while_adding(self):
+        txs = [self.fund(i, 10 + i) for i in range(500)]
+        stop = []
+        errors = []
+
+        def build_templates():
+            try:
+                while not stop:
+                    self.mempool.get_block_template()
+            except Exception as e:
+                errors.append(e)
+
+        thread = Thread(target=build_templates)
+        thread.start()
+        try:
+            for tx in txs:
+                self.mempool.add_transaction(tx)
+        finally:
+            stop.append(True)
+            thread.join()
+        self.assertEqual(errors, [])
+
+        # Trimmed to the best paying ones
+        self.assertTrue(self.mempool.entries)
+        self.assertLessEqual(self.mempool.total_size, self.max_size)
+        self.assert_consistent()
+
+
+if __name__ == '__main__':
+    unittest.main()
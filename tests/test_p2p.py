@@ -0,0 +1,136 @@
+import socket
+import struct
+import time
+import unittest
+
+from shitcoin.blockchain import Blockchain
+from shitcoin.compact import MAX_BLOCK_TXS, SHORT_ID_LEN, CompactBlock
+from shitcoin.crypto import NO_PUBKEY
+from shitcoin.miner import Miner
+from shitcoin.mock_p2p import P2P, Peer, read_hashes
+from shitcoin.serialize import SerializationBuffer
+from shitcoin.settings import (P2P_MAX_BLOCK_QUEUE, P2P_MAX_HEADERS,
+                               P2P_MAX_SEND_BUFFER)
+from shitcoin.transaction import Transaction
+
+
+def frame(pkg):
+    return struct.pack('>I', len(pkg)) + pkg
+
+
+class P2PTest(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = Blockchain()
+        self.miner = Miner(self.blockchain, NO_PUBKEY)
+        self.p2p = P2P(self.blockchain, self.miner, host=None)
+
+    def tearDown(self):
+        self.p2p.shutdown()
+
+    def wait_closed(self, sock, timeout=5):
+        """ Read from our end of a peer connection until the node closes it.
+
+        Returns:
+            True if it was closed within the timeout
+        """
+        sock.settimeout(timeout)
+        deadline = time.time() + timeout
+        try:
+            while time.time() < deadline:
+                if sock.recv(65536) == b'':
+                    return True
+        except socket.timeout:
+            pass
+        return False
+
+    def test_block_queue_overflow_after_send_queued(self):
+        self.p2p.send_queued()
+        blk = self.blockchain.get_head()
+        for _ in range(P2P_MAX_BLOCK_QUEUE + 44):
+            self.p2p.broadcast_block(blk)
+        self.assertLessEqual(len(self.p2p.blocks_to_send),
+                             P2P_MAX_BLOCK_QUEUE)
+
+    def test_requests_held_while_peer_does_not_read(self):
+        # A peer, which the network thread does not know of
+        peer = Peer(None, ('test', 1), True)
+        peer.send_size = P2P_MAX_SEND_BUFFER + 1
+        self.assertTrue(self.p2p.can_read(peer))
+
+        req = SerializationBuffer()
+        req.write(b'GHD')
+        req.write_varuint(0)
+        txn = SerializationBuffer()
+        txn.write(b'TXN')
+        Transaction().serialize(txn)
+        peer.recv_buf += frame(req.get_bytes()) + frame(txn.get_bytes())
+        self.p2p.parse_frames(peer)
+
+        # The transaction is taken, the request waits
+        self.assertEqual(len(self.p2p.txs_received), 1)
+        self.assertEqual(len(peer.held), 1)
+        self.assertFalse(peer.recv_buf)
+
+        peer.send_size = 0
+        self.p2p.handle_held(peer)
+        self.assertFalse(peer.held)
+        self.assertEqual(peer.held_size, 0)
+        self.assertTrue(peer.send_queue)
+
+    def test_getheaders_with_huge_count_drops_peer(self):
+        ours, theirs = socket.socketpair()
+        self.p2p.add_connection(ours, ('test', 1), True)
+        buf = SerializationBuffer()
+        buf.write(b'GHD')
+        buf.write_varuint(10 ** 9)
+        theirs.sendall(frame(buf.get_bytes()))
+        self.assertTrue(self.wait_closed(theirs))
+        theirs.close()
+
+
+class ReadCountTest(unittest.TestCase):
+    def test_hash_count_above_maximum(self):
+        buf = SerializationBuffer()
+        buf.write_varuint(P2P_MAX_HEADERS + 1)
+        buf.write(b'\0' * 32 * (P2P_MAX_HEADERS + 1))
+        with self.assertRaises(ValueError):
+            read_hashes(SerializationBuffer(buf.get_bytes()),
+                        P2P_MAX_HEADERS)
+
+    def test_hashes_truncated(self):
+        buf = SerializationBuffer()
+        buf.write_varuint(3)
+        buf.write(b'\0' * 32 * 2)
+        with self.assertRaises(ValueError):
+            read_hashes(SerializationBuffer(buf.get_bytes()),
+                        P2P_MAX_HEADERS)
+
+
+class CompactBlockTest(unittest.TestCase):
+    def compact_pkg(self, tx_count, short_ids):
+        buf = Blockchain().get_head().serialize_header()
+        buf.write_u64(0)
+        buf.write_varuint(tx_count)
+        buf.write_varuint(0)
+        buf.write(b'\0' * SHORT_ID_LEN * short_ids)
+        return SerializationBuffer(buf.get_bytes())
+
+    def test_roundtrip(self):
+        compact = CompactBlock.unserialize(self.compact_pkg(3, 3))
+        self.assertEqual(len(compact.short_ids), 3)
+
+    def test_too_many_transactions(self):
+        with self.assertRaises(ValueError):
+            CompactBlock.unserialize(self.compact_pkg(MAX_BLOCK_TXS + 1, 0))
+
+    def test_huge_transaction_count(self):
+        with self.assertRaises(ValueError):
+            CompactBlock.unserialize(self.compact_pkg(10 ** 12, 1))
+
+    def test_truncated_short_ids(self):
+        with self.assertRaises(ValueError):
+            CompactBlock.unserialize(self.compact_pkg(5, 4))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+from binascii import hexlify
+import json
+import unittest
+from unittest import mock
+
+import client
+from shitcoin import crypto
+from shitcoin.blockchain import Blockchain
+from shitcoin.crypto import NO_PUBKEY
+from shitcoin.miner import Miner
+from shitcoin.mock_p2p import P2P
+from shitcoin.transaction import Output
+from shitcoin.wallet import Wallet
+
+from .helpers import extend_chain
+
+
+class RPCTestCase(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = Blockchain(index=True)
+        self.wallet = Wallet(self.blockchain, path=None)
+
+        # One coin, as if it was mined
+        out = Output(1000, self.wallet.get_addresses()[0])
+        self.fund_txid = b'\1' * 32
+        self.blockchain.utxos[self.fund_txid] = {0: out}
+        self.wallet.add_utxo(self.fund_txid, 0, out, 0)
+
+        self.miner = Miner(self.blockchain, NO_PUBKEY)
+        self.p2p = P2P(self.blockchain, self.miner, host=None)
+        with mock.patch('client.RPC_PORT', 0), \
+                mock.patch('client.RPC_JSON_PORT', 0):
+            self.rpc = client.RPC(self.blockchain, self.miner, self.wallet,
+                                  self.p2p)
+
+    def tearDown(self):
+        for server in self.rpc.servers:
+            server.shutdown()
+            server.server_close()
+        self.p2p.shutdown()
+
+    def call(self, request):
+        return json.loads(self.rpc.handle_json(
+            json.dumps(request).encode()))
+
+
+class JSONRPCTest(RPCTestCase):
+    def test_single_request(self):
+        self.assertEqual(self.call({'id': 7, 'method': 'get_height'}),
+                         {'id': 7, 'result': 0})
+
+    def test_errors(self):
+        self.assertEqual(self.call({'id': 1, 'method': 'nonsense'}),
+                         {'id': 1, 'error': 'Unknown method nonsense'})
+        response = json.loads(self.rpc.handle_json(b'{"id": '))
+        self.assertIsNone(response['id'])
+        self.assertIn('error', response)
+
+    def test_batch(self):
+        receiver = hexlify(crypto.generate_keypair()[1]).decode()
+        with mock.patch.object(self.miner, 'add_transactions',
+                               wraps=self.miner.add_transactions) as add:
+            responses = self.call([
+                {'id': 1, 'method': 'send', 'params': [receiver, 300]},
+                {'id': 2, 'method': 'get_height'},
+                {'id': 3, 'method': 'send', 'params': [receiver, 5000]},
+                {'id': 4, 'method': 'get_transaction', 'params': ['00']},
+                {'id': 5},
+            ])
+
+        # Answered in order, the transactions were sent together
+        self.assertEqual([r['id'] for r in responses], [1, 2, 3, 4, 5])
+        add.assert_called_once()
+        sent, = add.call_args[0]
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(responses[0],
+                         {'id': 1,
+                          'result': [hexlify(sent[0].get_txid()).decode()]})
+        self.assertEqual(responses[1], {'id': 2, 'result': 0})
+        self.assertEqual(responses[2],
+                         {'id': 3, 'error': 'insufficient funds'})
+        self.assertEqual(responses[3], {'id': 4, 'result': None})
+        self.assertIn('error', responses[4])
+        self.assertIn(sent[0].get_txid(), self.miner.mempool.transactions)
+
+    def test_rejected_transactions_are_released(self):
+        receiver = hexlify(crypto.generate_keypair()[1]).decode()
+        with mock.patch.object(self.miner, 'add_transactions',
+                               return_value=[]):
+            responses = self.call([
+                {'id': 1, 'method': 'send', 'params': [receiver, 300]}])
+        self.assertEqual(responses,
+                         [{'id': 1, 'error': '1 of 1 transactions rejected'}])
+
+        # The coin can be spent again
+        response = self.call({'id': 2, 'method': 'send',
+                              'params': [receiver, 300]})
+        self.assertIn('result', response)
+
+
+class AsciiArtTest(RPCTestCase):
+    def setUp(self):
+        super().setUp()
+        self.pubkey = crypto.generate_keypair()[1]
+        self.blocks = extend_chain(self.blockchain, self.pubkey, 5)
+
+    def test_one_page_per_block(self):
+        pages = list(self.rpc.asciiart(3, 1))
+        self.assertEqual(len(pages), 3)
+        for height, page in zip((1, 2, 3), pages):
+            blk = self.blocks[height - 1]
+            self.assertTrue(page.startswith(
+                b'BLK %i %s\n' % (height, hexlify(blk.get_hash()))))
+            self.assertIn(b'---- OUT %s 1000\n' % hexlify(self.pubkey), page)
+
+    def test_last_blocks(self):
+        pages = list(self.rpc.asciiart(2, summary=True))
+        self.assertEqual([page.split()[:2] for page in pages],
+                         [[b'BLK', b'4'], [b'BLK', b'5']])
+        self.assertTrue(all(page.count(b'\n') == 1 for page in pages))
+
+    def test_stops_at_head(self):
+        self.assertEqual(len(list(self.rpc.asciiart(10, 4))), 2)
+        self.assertEqual(list(self.rpc.asciiart(10, 6)), [])
+
+    def test_stops_at_reorg(self):
+        pages = self.rpc.asciiart(4, 1, summary=True)
+        self.assertTrue(next(pages).startswith(b'BLK 1 '))
+
+        # A longer fork replaces all blocks, including the rendered one
+        extend_chain(self.blockchain, self.pubkey, 6,
+                     parent=self.blockchain.get_block_at_height(0),
+                     nonce_seed=1)
+        self.assertEqual(list(pages),
+                         [b'Chain reorganized at height 2, stopping.\n'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,29 @@
+import unittest
+
+from shitcoin.blockchain import Blockchain
+from shitcoin.crypto import NO_PUBKEY
+from shitcoin.exceptions import UTXONotFound
+from shitcoin.miner import Miner
+from shitcoin.utxoset import UTXOSet
+from shitcoin.validation import validate_block, validate_block_header
+
+
+class BrokenUTXOSet(UTXOSet):
+    """ Fails to reach the parent, like a replay of a bad side chain """
+    def move_on_chain(self, to_block):
+        raise UTXONotFound()
+
+
+class ValidateBlockTest(unittest.TestCase):
+    def test_failed_utxo_move_is_invalid(self):
+        blockchain = Blockchain()
+        miner = Miner(blockchain, NO_PUBKEY)
+        miner.retarget()
+        blk = miner.target_block
+        while not validate_block_header(blk):
+            blk.nonce += 1
+        self.assertFalse(validate_block(blk, BrokenUTXOSet()))
+
+
+if __name__ == '__main__':
+    unittest.main()
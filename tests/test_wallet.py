@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from shitcoin import crypto
+from shitcoin.blockchain import Blockchain
+from shitcoin.exceptions import NotEnoughFunds
+from shitcoin.mempool import Mempool
+from shitcoin.transaction import Output
+from shitcoin.wallet import Wallet
+
+from .helpers import extend_chain, make_block, spend
+
+
+class WalletJournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'wallet')
+        self.blockchain = Blockchain()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_appended_keys_are_loaded(self):
+        wallet = Wallet(self.blockchain, path=self.path)
+        wallet.new_address()
+        wallet.close()
+        loaded = Wallet(self.blockchain, path=self.path)
+        self.assertEqual(loaded.get_addresses(), wallet.get_addresses())
+
+    def test_load_compacts_stale_lines(self):
+        keys = [crypto.generate_keypair() for _ in range(2)]
+        lines = [Wallet._format_key(*key) for key in keys]
+        with open(self.path, 'wb') as f:
+            f.write(lines[0] + lines[1] + b'nonsense\n' + lines[0]
+                    + lines[1][:20])
+
+        wallet = Wallet(self.blockchain, path=self.path)
+        self.assertEqual(wallet.get_addresses(), [key[1] for key in keys])
+        with open(self.path, 'rb') as f:
+            self.assertEqual(f.read(), lines[0] + lines[1])
+
+
+class WalletRescanTest(unittest.TestCase):
+    def test_rescan_finds_unspent_outputs(self):
+        blockchain = Blockchain()
+        wallet = Wallet(blockchain, path=None)
+        pubkey = wallet.get_addresses()[0]
+        mined = extend_chain(blockchain, pubkey, 4)
+
+        # Spend the first reward, keep some change
+        coinbase = mined[0].txs[-1].get_txid()
+        tx = spend([(coinbase, 0)], wallet.privkeys[pubkey],
+                   [(b'\2' * 32, 300), (pubkey, 600)])
+        blk = make_block(blockchain.get_head(), b'\2' * 32, [tx])
+        self.assertTrue(blockchain.add_block(blk))
+        expected = dict(wallet.utxos)
+        self.assertNotIn((coinbase, 0), expected)
+        self.assertIn((tx.get_txid(), 1), expected)
+
+        # Forget everything and scan again in small chunks
+        wallet.utxos = {}
+        progress = []
+        with mock.patch('shitcoin.wallet.WALLET_RESCAN_CHUNK', 2):
+            result = wallet.rescan(lambda done, total: progress.append(
+                (done, total)))
+
+        self.assertEqual(wallet.utxos, expected)
+        self.assertEqual(result, {'blocks': 6, 'received': 5, 'spent': 1,
+                                  'unspent': 4})
+        self.assertEqual(progress, [(2, 12), (4, 12), (6, 12), (8, 12),
+                                    (10, 12), (12, 12)])
+        self.assertEqual(wallet.get_balance(), 0)  # Not confirmed yet
+
+
+class WalletReservationTest(unittest.TestCase):
+    def setUp(self):
+        self.blockchain = Blockchain()
+        self.mempool = Mempool(self.blockchain)
+        self.wallet = Wallet(self.blockchain, path=None,
+                             mempool=self.mempool)
+
+        # One coin, as if it was mined
+        out = Output(1000, self.wallet.get_addresses()[0])
+        fund_txid = b'\1' * 32
+        self.blockchain.utxos[fund_txid] = {0: out}
+        self.mempool.utxos[fund_txid] = {0: out}
+        self.wallet.add_utxo(fund_txid, 0, out, 0)
+        self.receiver = crypto.generate_keypair()[1]
+
+    def send(self):
+        return self.wallet.create_transaction({self.receiver: 500})
+
+    def test_unsent_transaction_keeps_inputs(self):
+        self.send()
+        with self.assertRaises(NotEnoughFunds):
+            self.send()
+
+    def test_mempool_transaction_keeps_inputs(self):
+        self.assertTrue(self.mempool.add_transaction(self.send()))
+        with self.assertRaises(NotEnoughFunds):
+            self.send()
+
+    def test_evicted_transaction_releases_inputs(self):
+        tx = self.send()
+        self.assertTrue(self.mempool.add_transaction(tx))
+        self.mempool.remove_transaction(tx.get_txid())
+
+        again = self.send()
+        self.assertEqual([(i.txid, i.index) for i in again.inputs],
+                         [(i.txid, i.index) for i in tx.inputs])
+        self.assertEqual(self.wallet.pending, {again.get_txid()})
+
+    def test_rejected_transaction_releases_inputs(self):
+        tx = self.send()
+        self.wallet.release(tx)
+        self.send()
+
+
+if __name__ == '__main__':
+    unittest.main()